@@ -137,6 +137,12 @@ class PaletteImage {
             return;
         }
 
+        this.remove(ctx, layer, index);
+    }
+
+    // delete the segment with palette value index, and rerender
+    remove(ctx, layer, index) {
+        this.reverseMap[index] = { data: [], deleted: [] };
         // 找到所有具有相同索引值的像素并高亮显示
         const height = this.palette.length;
         const width = this.palette[0].length;
@@ -164,7 +170,8 @@ class PaletteImage {
     }
 
     // add a new segment according to mask, and rerender. also maintains reverse map
-    update(ctx, layer, mask, invasive = false) {
+    // with box = [top, left, bottom, right), mask only covers the box
+    update(ctx, layer, mask, invasive = false, box = null) {
         console.log('update activated for ', this.numSegs);
 
         this.numSegs = this.numSegs + 1     // NOTE: not actually the number of segments, because some are deleted.
@@ -174,10 +181,11 @@ class PaletteImage {
         this.colorMap[this.numSegs] = { r: r, g: g, b: b };
         this.reverseMap[this.numSegs] = { data: [], deleted: [] };
 
+        const [top, left, bottom, right] = box ?? [0, 0, this.height, this.width];
         var imageData = ctx.getImageData(0, 0, this.width, this.height);
-        for (let i = 0; i < this.height; i++) {
-            for (let j = 0; j < this.width; j++) {
-                if (mask[i][j] != 0) {
+        for (let i = top; i < bottom; i++) {
+            for (let j = left; j < right; j++) {
+                if (mask[i - top][j - left] != 0) {
                     if (invasive || this.palette[i][j] == 0) {
                         this.palette[i][j] = this.numSegs;
                         const pixelIndex = (i * this.width + j) * 4;
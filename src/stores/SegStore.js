@@ -3,6 +3,7 @@ import { defineStore } from 'pinia'
 export const useSegStore = defineStore('seg', {
     state: () => ({
         palette: [],
+        sessionId: null,
         showMask: true,
         showIndex: true,
         k: 6,
@@ -20,6 +21,9 @@ export const useSegStore = defineStore('seg', {
         setPalette(value) {
             this.palette = value
         },
+        setSessionId(value) {
+            this.sessionId = value
+        },
         setColorMap(value) {
             this.colorMap = value
         },
@@ -1,54 +1,67 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+import time
+_import_start = time.time()
+from fastapi import FastAPI, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sam2.sam2_image_predictor import SAM2ImagePredictor
-from sam2.build_sam import build_sam2
-from transformers import AutoImageProcessor, AutoModel
 import base64
 import uvicorn
 import cv2
 import numpy as np
-import io
 import gzip
 import torch
 from pydantic import BaseModel
+from typing import List, Optional
 import logging
-from torch.utils.data import DataLoader
-from sklearn.cluster import KMeans
-from scipy import sparse
 
-from utils import *
-from feature import FeatureExtractionDataset
-import time
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler, normalize
-import umap
-from tqdm import tqdm
+from session import bind_predictor, predictor_lock
+from jobs import JobManager, JobQueueFull
+from codec import decode_palette, encode_palette
+from palette import PALETTE_OPS, PaletteConflict
+from tiling import open_mosaic
+from prompt import MASK_SELECTIONS, decode_prompts
+from startup import ModelsNotReady
+from inference import autocast, profile
+from pipeline import (
+    SegmentationRequest, cluster_error, feature_cache, model_timeout, run_cluster, run_segmentation,
+    segmentation_error, session_segment_index, session_store, startup,
+)
+import pipeline
+import metrics
+import os
+import json
+import asyncio
+from contextlib import asynccontextmanager
+
+# TREEDECT_LOG_LEVEL, INFO by default. every request logs its trace (stage timings, sizes) as one json line
+logging.basicConfig(level=os.environ.get("TREEDECT_LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 # ------------------------------------------------------------
 # global states
 # ------------------------------------------------------------
-predictor = None
-preprocessor = None
-extractor = None
-img = None
-
-def load_model(model_name = "facebook/sam2-hiera-small"):
-    global predictor
-    predictor = SAM2ImagePredictor.from_pretrained("facebook/sam2-hiera-small", local_files_only=True)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    predictor.model.to(device)
-
-def load_feature_extractor(model_name = "facebook/dinov2-small"):
-    global preprocessor, extractor
-    preprocessor = AutoImageProcessor.from_pretrained(model_name, local_files_only=True, use_fast=True)
-    extractor = AutoModel.from_pretrained(model_name, local_files_only=True)
+# uploaded mosaics and their memory-mapped RGB conversions
+mosaic_dir = os.environ.get("TREEDECT_MOSAIC_DIR", os.path.expanduser("~/.cache/treedect/mosaics"))
+# Server-Timing header with the stage timings on every response. clients can also ask for it per request
+# by sending "X-Treedect-Timing: 1"
+timing_header = os.environ.get("TREEDECT_TIMING_HEADER", "0") != "0"
+job_manager = JobManager(
+    max_workers=int(os.environ.get("TREEDECT_JOB_WORKERS", 1)),
+    max_pending=int(os.environ.get("TREEDECT_JOB_QUEUE", 8)),
+)
 
+# TREEDECT_DEVICE, TREEDECT_QUANTIZE, TREEDECT_THREADS, TREEDECT_INTEROP_THREADS, see InferenceProfile
+profile.configure_threads()
+startup.phases["imports"] = round(time.time() - _import_start, 3)
 
-load_model()
-load_feature_extractor()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the models load when the server starts, not when this module is imported. TREEDECT_STARTUP, see Startup
+    if startup.mode != "lazy":
+        startup.start()
+    yield
+    if pipeline.decoder_pool is not None:
+        pipeline.decoder_pool.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 添加CORS middleware
 app.add_middleware(
@@ -57,11 +70,53 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    '''
+    every request but /metrics and the job event streams runs under a metrics.Trace, which the endpoints fill
+    with their stages. an event stream lasts as long as its job, whose work is traced by the job itself
+    '''
+    path = request.url.path
+    if path == "/metrics" or (path.startswith("/jobs/") and path.endswith("/events")):
+        return await call_next(request)
+    with metrics.tracing(request.url.path) as trace:
+        if request.headers.get("content-length"):
+            trace.payload("request", int(request.headers["content-length"]))
+        try:
+            response = await call_next(request)
+        except Exception:
+            trace.finish("500", route_template(request))
+            raise
+        if response.headers.get("content-length"):
+            trace.payload("response", int(response.headers["content-length"]))
+        trace.finish(str(response.status_code), route_template(request))
+    if timing_header or request.headers.get("x-treedect-timing") == "1":
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+def route_template(request: Request) -> str:
+    '''
+    /jobs/{job_id} rather than the requested path, to bound the number of metric series
+    '''
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+@app.get("/metrics")
+def get_metrics():
+    '''
+    Prometheus text format: request and stage timings per endpoint, decoder calls, payload sizes, memory
+    '''
+    metrics.registry.set("treedect_ready", {}, int(startup.ready))
+    metrics.registry.set("treedect_sessions", {}, len(session_store))
+    metrics.registry.set("treedect_session_bytes", {}, session_store.nbytes)
+    metrics.registry.set("treedect_feature_cache_bytes", {}, feature_cache.nbytes)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/load_image")
 async def load_image(file: UploadFile = File(...)):
-    global img
     try:
         # 读取上传的文件内容
         contents = await file.read()
@@ -70,205 +125,444 @@ async def load_image(file: UploadFile = File(...)):
         nparr = np.frombuffer(contents, np.uint8)
         
         # 使用 cv2 解码图像
-        img_cv2 = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        # 转换为 RGB 格式
-        img = cv2.cvtColor(img_cv2, cv2.COLOR_BGR2RGB)
+        with metrics.stage("decode"):
+            img_cv2 = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         
         # 检查图像是否成功加载
-        if img is None:
+        if img_cv2 is None:
             return JSONResponse(content={"error": "图像加载失败"}, status_code=400)
         
+        # 转换为 RGB 格式
+        img = cv2.cvtColor(img_cv2, cv2.COLOR_BGR2RGB)
+        session = session_store.create(img)
+        
         # 返回成功信息
-        return JSONResponse(content={"message": "图像加载成功", "height": img.shape[0], "width": img.shape[1]})
+        return JSONResponse(content={"message": "图像加载成功", "session_id": session.session_id, "height": img.shape[0], "width": img.shape[1]})
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-class SegmentationRequest(BaseModel):
-    row_sample_interval: int
-    col_sample_interval: int
-    overlap_ratio: float
+@app.post("/load_mosaic")
+async def load_mosaic(file: UploadFile = File(...)):
+    '''
+    /load_image for large orthomosaics. the upload is streamed to disk and the image memory-mapped instead of
+    decoded (see tiling.open_mosaic); segment it with tile_size set in /generate_segmentation.
+    '''
+    os.makedirs(mosaic_dir, exist_ok=True)
+    ext = os.path.splitext(file.filename or "")[1].lower()
+    path = os.path.join(mosaic_dir, f"upload-{os.urandom(8).hex()}{ext}")
+    try:
+        with open(path, "wb") as f:
+            while chunk := await file.read(16 * 1024 ** 2):
+                f.write(chunk)
+        with metrics.stage("convert"):
+            img, files = await asyncio.to_thread(open_mosaic, path, mosaic_dir)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    if len(files) > 0:
+        # converted to a .npy, the upload itself is no longer needed
+        os.remove(path)
+    else:
+        files = [path]
+    session = session_store.create(img, files)
+    return JSONResponse(content={"message": "图像加载成功", "session_id": session.session_id, "height": img.shape[0], "width": img.shape[1]})
+
+@app.get("/ready")
+def ready():
+    '''
+    readiness probe. 200 once the models are loaded, 503 with the startup phase while loading
+    '''
+    return JSONResponse(content={**startup.status(), "profile": profile.describe()}, status_code=200 if startup.ready else 503)
+
+def get_session(session_id):
+    '''
+    session_id None falls back to the only open session, for clients that do not track sessions. with several
+    sessions open it finds none, and the request gets a 400
+    '''
+    try:
+        return session_store.get(session_id)
+    except KeyError:
+        return None
 
 @app.post("/generate_segmentation")
-async def generate_segmentation(request: SegmentationRequest):
-    row_sample_interval = request.row_sample_interval
-    col_sample_interval = request.col_sample_interval
-    overlap_ratio = request.overlap_ratio
-    global img
-    
-    if img is None:
+def generate_segmentation(request: SegmentationRequest):
+    session = get_session(request.session_id)
+    if session is None:
         return JSONResponse(content={"error": "No image loaded"}, status_code=400)
+    error = segmentation_error(request, session)
+    if error is not None:
+        return JSONResponse(content={"error": error}, status_code=400)
+    try:
+        return JSONResponse(content=run_segmentation(session, request))
+    except ModelsNotReady as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
 
-    height, width = img.shape[:2]
-    print('start prefilling, height:', height, 'width:', width)
-    point_grid = generation_sample_grid(height, width, row_sample_interval, col_sample_interval)
-    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-        predictor.set_image(img)
-    print("prefilling complete")
-
-    masks = []
-    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-        total_points = point_grid.shape[0] * point_grid.shape[1]
-        processed_points = 0
-        pbar = tqdm(total=total_points, desc="Processing points")
-        for j in range(point_grid.shape[1]):
-            for i in range(point_grid.shape[0]):
-                point_coord = np.expand_dims(point_grid[i, j], axis=0)
-                point_label = np.array([1])
-                current_masks, _, _ = predictor.predict(point_coords=point_coord, point_labels=point_label, multimask_output=True)
-                # Convert to sparse CSR matrix to save memory
-                mask_bool = current_masks[0].astype(bool)
-                mask_sparse = sparse.csr_matrix(mask_bool)
-                masks.append(mask_sparse)
-                processed_points += 1
-                pbar.update(1)
-        pbar.close()
-        print("prediction complete")
-    
-    filtered_grids, filtered_masks = filter_overlap_segments(point_grid, masks, height, width, overlap_ratio)
-    print("filter complete")
-
-    num_masks = len(filtered_masks)
-    
-    palette = masks_to_palette(filtered_masks, height, width)
-
-    # 使用gzip压缩数据而不是np.save
-    buffer = io.BytesIO()
-    # 将palette数据以原始二进制形式写入缓冲区
-    palette_bytes = palette.tobytes()
-    # 使用gzip压缩
-    compressed_data = gzip.compress(palette_bytes)
-    # 进行base64编码
-    palette_base64 = base64.b64encode(compressed_data).decode('utf-8')
-    
-    return JSONResponse(content={
-        "palette": palette_base64,
-        "num_masks": num_masks,
-        "height": height,
-        "width": width
-    })
+class ClickPrompt(BaseModel):
+    points: List[List[int]] = []            # [[x, y], ...]
+    labels: List[int] = []                  # per point, 1 positive, 0 negative
+    box: Optional[List[int]] = None         # [x0, y0, x1, y1]
+    segment_id: Optional[str] = None        # refine the segment returned under this id, feeding back its last logits
 
 class PointSegmentRequest(BaseModel):
-    x: int
-    y: int
+    x: Optional[int] = None                 # single positive click, answered with the full-frame gzip int32 mask
+    y: Optional[int] = None
+    prompts: Optional[List[ClickPrompt]] = None     # several segments at once, answered with bit-packed crops
+    mask_selection: str = "best"            # prompts only, for lone clicks with multimask outputs
+    session_id: Optional[str] = None
+
+# low-res logits kept per session for refinement clicks, 256 KB each
+max_prompt_logits = 64
+
+def point_segment_error(request: PointSegmentRequest) -> Optional[str]:
+    if request.prompts is None:
+        if request.x is None or request.y is None:
+            return "Either x and y or prompts are required"
+        return None
+    if request.mask_selection not in MASK_SELECTIONS:
+        return f"Unknown mask selection: {request.mask_selection}"
+    for prompt in request.prompts:
+        if len(prompt.points) != len(prompt.labels) or any(len(point) != 2 for point in prompt.points):
+            return "Every point needs [x, y] and a label"
+        if len(prompt.points) == 0 and prompt.box is None:
+            return "Every prompt needs a point or a box"
+        if prompt.box is not None and len(prompt.box) != 4:
+            return "box must be [x0, y0, x1, y1]"
+    return None
 
 @app.post("/point_segment")
 def point_segment(request: PointSegmentRequest):
-    x = request.x
-    y = request.y
-    point_coord = np.array([[x, y]]) 
-    point_label = np.array([1])
-    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-        current_masks, _, _ = predictor.predict(point_coords=point_coord, point_labels=point_label)
-    mask = current_masks[0].astype(np.int32)
-    buffer = io.BytesIO()
-    mask_bytes = mask.tobytes()
-    compressed_data = gzip.compress(mask_bytes)
-    mask_base64 = base64.b64encode(compressed_data).decode('utf-8')
-    height, width = img.shape[:2]
-
-    return JSONResponse(content={
-        "mask": mask_base64,
-        "height": height,
-        "width": width
-    })
+    session = get_session(request.session_id)
+    if session is None:
+        return JSONResponse(content={"error": "No image loaded"}, status_code=400)
+    error = point_segment_error(request)
+    if error is not None:
+        return JSONResponse(content={"error": error}, status_code=400)
+    if session.is_mosaic:
+        return JSONResponse(content={"error": "Point prompts are not supported on mosaics"}, status_code=400)
+    try:
+        startup.wait(model_timeout)
+    except ModelsNotReady as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503)
+    height, width = session.image.shape[:2]
+
+    if request.prompts is None:
+        point_coord = np.array([[request.x, request.y]])
+        point_label = np.array([1])
+        with session.lock, predictor_lock:
+            with metrics.stage("set_image"):
+                bind_predictor(pipeline.predictor, session, session_store, pipeline.embedding_cache)
+            with metrics.stage("decode"), torch.inference_mode(), autocast():
+                current_masks, _, _ = pipeline.predictor.predict(point_coords=point_coord, point_labels=point_label)
+            metrics.count("decoder_calls")
+        with metrics.stage("encode"):
+            mask = current_masks[0].astype(np.int32)
+            mask_bytes = mask.tobytes()
+            compressed_data = gzip.compress(mask_bytes)
+            mask_base64 = base64.b64encode(compressed_data).decode('utf-8')
+        metrics.payload("mask", len(mask_base64))
+
+        return JSONResponse(content={
+            "mask": mask_base64,
+            "height": height,
+            "width": width
+        })
+
+    with session.lock:
+        segment_ids = [prompt.segment_id or os.urandom(8).hex() for prompt in request.prompts]
+        prompts = [{
+            "points": np.array(prompt.points, dtype=np.float32).reshape(-1, 2),
+            "labels": np.array(prompt.labels, dtype=np.int32),
+            "box": prompt.box,
+            "mask_input": session.prompt_logits.get(segment_id),
+        } for prompt, segment_id in zip(request.prompts, segment_ids)]
+        with predictor_lock:
+            with metrics.stage("set_image"):
+                bind_predictor(pipeline.predictor, session, session_store, pipeline.embedding_cache)
+            with metrics.stage("decode"), torch.inference_mode(), autocast():
+                results = decode_prompts(pipeline.predictor, prompts, request.mask_selection)
+        masks = []
+        with metrics.stage("encode"):
+            for segment_id, result in zip(segment_ids, results):
+                session.prompt_logits[segment_id] = result["logits"]
+                session.prompt_logits.move_to_end(segment_id)
+                masks.append({
+                    "segment_id": segment_id,
+                    "box": [int(v) for v in result["box"]],         # [top, left, bottom, right), as /palette/patch takes it
+                    "bits": base64.b64encode(np.packbits(result["crop"], axis=1).tobytes()).decode('utf-8'),
+                    "area": int(np.count_nonzero(result["crop"])),
+                    "score": result["score"],
+                })
+        metrics.payload("masks", sum(len(mask["bits"]) for mask in masks))
+        while len(session.prompt_logits) > max_prompt_logits:
+            session.prompt_logits.popitem(last=False)
+
+    return JSONResponse(content={"masks": masks, "height": height, "width": width})
 
 class ClusterRequest(BaseModel):
-    palette: list
+    palette: Optional[list] = None      # None clusters the palette kept by the server (see /palette/patch)
     k: int
     seg_ratio: int
+    session_id: Optional[str] = None
+    backend: str = "umap"                   # one of clustering.CLUSTER_BACKENDS
+    k_sweep: Optional[List[int]] = None     # also fit these k on the same embedding, see run_cluster
 
 @app.post("/cluster")
 def cluster(request: ClusterRequest):
+    session = get_session(request.session_id)
+    if session is None:
+        return JSONResponse(content={"error": "No image loaded"}, status_code=400)
     # 将传入的二维列表转换为numpy数组
-    palette = np.array(request.palette, dtype=np.int32)
-    n_patch = 224 / extractor.config.patch_size
-    dataset = FeatureExtractionDataset(palette, img, request.seg_ratio)
-    loader = DataLoader(dataset, batch_size=128, shuffle=False, collate_fn=FeatureExtractionDataset.collate_fn)
-    
-    start_time = time.time()
-    
-    cls_tokens = []
-    for i, batch in enumerate(loader):
-        inputs = preprocessor(
-            images=batch['data'],
-            return_tensors="pt",
-            size={"height": 224, "width": 224},   # 直接 resize 到 224x224
-            crop_size=None,                       # 禁用 center crop
-            do_center_crop=False
-        )
-        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-            outputs = extractor(**inputs)
-        for hidden_state, block_mask in zip(outputs.last_hidden_state, batch['block_mask']):  # iteration over samples in batch
-            patch_states = hidden_state[1:]
-            valid_patchs = []
-            for block_index in block_mask:
-                valid_patchs.append(patch_states[block_index])
-            if len(valid_patchs) == 0:
-                valid_patchs.append(torch.zeros((768,)))   # empty patch
-            cls_token = torch.stack(valid_patchs, dim=0).mean(dim=0)
-            cls_tokens.append(cls_token.numpy())
-    
-    end_time = time.time()
-    logging.info(f"Feature extraction took {end_time - start_time:.2f} seconds")
-
-    # filter invalid (deleted) segments
-    features = []
-    indexes = []
-    for i, (valid, cls_token) in enumerate(zip(dataset.valid, cls_tokens)):
-        if valid:
-            features.append((cls_token, dataset.mean_color[i], dataset.std_color[i], dataset.area[i]))
-            indexes.append(i)
-
-    # PCA on texture features from DINOv2
-    # [VARI] does it need normalization?
-    texture_features = np.stack([feature[0] for feature in features], axis=0)
-    pca = PCA(n_components=7)
-    texture_features = pca.fit_transform(texture_features)
-    texture_features = normalize(texture_features, norm='l2')
-
-    # manual features
-    manual_features = np.stack([np.concat([feature[1], feature[2], np.array([feature[3]])], axis=-1) for feature in features], axis=0)
-    features = np.concat([texture_features, manual_features], axis=-1)
-
-    # normalization & UMAP
-    scaler = StandardScaler()
-    features = scaler.fit_transform(features)
-    reducer = umap.UMAP(n_neighbors=30, min_dist=0.0, n_components=3)
-    features = reducer.fit_transform(features)
-
-    # # 将特征向量转换为numpy数组用于聚类
-    # features = torch.stack(features).cpu().numpy()
-    
-    # 执行K-means聚类
-    start_time = time.time()
-    kmeans = KMeans(n_clusters=request.k, random_state=0)
-    cluster_labels = kmeans.fit_predict(features)
-    end_time = time.time()
-    logging.info(f"K-means clustering took {end_time - start_time:.2f} seconds")
-
-    labels = [-1 for _ in range(len(cls_tokens))]
-    for index, cluster_label in zip(indexes, cluster_labels):
-        labels[int(index)] = cluster_label
-    cluster_labels = np.array(labels)
-
-    # areas = np.zeros(cluster_labels.max() + 1)
-    # for label, area in zip(cluster_labels, dataset.area):
-    #     if label != -1:
-    #         areas[label] += area
-
-    position_x = np.round((dataset.bbox_top + dataset.bbox_bottom) / 2)
-    position_y = np.round((dataset.bbox_left + dataset.bbox_right) / 2)
-    # 返回聚类结果
-    return JSONResponse(content={
-        "labels": cluster_labels.tolist(),      # List[n_segments]. each element is the cluster label to the segment, start from 0, -1 for deleted segments
-        # "areas": areas.tolist(),                # List[n_clusters]. each element is the area in pixels to the cluster
-        "areas": dataset.area,
-        "block_count": dataset.block_count,
-        "position_x": position_x.tolist(),
-        "position_y": position_y.tolist(),
-    })
-    
+    error = cluster_error(request.backend, request.k, request.k_sweep)
+    if error is not None:
+        return JSONResponse(content={"error": error}, status_code=400)
+    palette = np.array(request.palette, dtype=np.int32) if request.palette is not None else None
+    try:
+        result = run_cluster(session, palette, request.k, request.seg_ratio, request.backend, request.k_sweep)
+    except ModelsNotReady as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503)
+    except PaletteConflict as e:
+        return JSONResponse(content={"error": str(e)}, status_code=409)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return JSONResponse(content=result)
+
+@app.post("/cluster/upload")
+async def cluster_upload(
+    file: UploadFile = File(...),
+    height: int = Form(...),
+    width: int = Form(...),
+    k: int = Form(...),
+    seg_ratio: int = Form(...),
+    encoding: str = Form("gzip"),
+    session_id: Optional[str] = Form(None),
+    backend: str = Form("umap"),
+    k_sweep: Optional[str] = Form(None),    # comma separated, e.g. "4,5,6,7,8"
+):
+    '''
+    /cluster with the palette uploaded as a binary file in one of the formats of codec.encode_palette
+    '''
+    session = get_session(session_id)
+    if session is None:
+        return JSONResponse(content={"error": "No image loaded"}, status_code=400)
+    try:
+        ks = [int(v) for v in k_sweep.split(",") if v.strip()] if k_sweep else None
+    except ValueError:
+        return JSONResponse(content={"error": "k_sweep must be a comma separated list of integers"}, status_code=400)
+    error = cluster_error(backend, k, ks)
+    if error is not None:
+        return JSONResponse(content={"error": error}, status_code=400)
+    contents = await file.read()
+    try:
+        with metrics.stage("decode"):
+            palette = await asyncio.to_thread(decode_palette, contents, height, width, encoding)
+        result = await asyncio.to_thread(run_cluster, session, palette, k, seg_ratio, backend, ks)
+    except ModelsNotReady as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503)
+    except PaletteConflict as e:
+        return JSONResponse(content={"error": str(e)}, status_code=409)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return JSONResponse(content=result)
+
+class PaletteEdit(BaseModel):
+    op: str                                 # add, paint, erase, delete or merge, see PaletteState
+    index: Optional[int] = None             # segment index on palette (merge target for merge)
+    indexes: Optional[List[int]] = None     # merge sources
+    box: Optional[List[int]] = None         # [top, left, bottom, right) of a bit-packed region
+    bits: Optional[str] = None              # base64 of np.packbits(region, axis=1)
+    x: Optional[int] = None                 # brush circle region
+    y: Optional[int] = None
+    radius: int = 5
+    invasive: bool = False                  # add only. take pixels from other segments
+
+class PalettePatchRequest(BaseModel):
+    session_id: Optional[str] = None
+    base_version: int                       # the version the edits were made against
+    edits: List[PaletteEdit]
+
+@app.get("/palette")
+def get_palette(session_id: Optional[str] = None):
+    session = get_session(session_id)
+    if session is None or session.palette_state is None:
+        return JSONResponse(content={"error": "No palette"}, status_code=400)
+    with session.lock:
+        state = session.palette_state
+        with metrics.stage("encode"):
+            palette_base64 = base64.b64encode(encode_palette(state.palette, "gzip")).decode('utf-8')
+        metrics.payload("palette", len(palette_base64))
+        return JSONResponse(content={
+            "palette": palette_base64,
+            "version": state.version,
+            "height": state.height,
+            "width": state.width,
+            "session_id": session.session_id,
+        })
+
+@app.post("/palette/patch")
+def patch_palette(request: PalettePatchRequest):
+    '''
+    apply small edits to the server palette. edits against an outdated version are rejected with 409
+    '''
+    session = get_session(request.session_id)
+    if session is None or session.palette_state is None:
+        return JSONResponse(content={"error": "No palette"}, status_code=400)
+    with session.lock:
+        state = session.palette_state
+        if request.base_version != state.version:
+            return JSONResponse(content={"error": "Palette version conflict", "version": state.version}, status_code=409)
+        for edit in request.edits:
+            if edit.op not in PALETTE_OPS:
+                return JSONResponse(content={"error": f"Unknown palette op: {edit.op}"}, status_code=400)
+        try:
+            with metrics.stage("apply"):
+                touched, added = state.apply([edit.model_dump() for edit in request.edits])
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+        return JSONResponse(content={
+            "version": state.version,
+            "touched": sorted(touched.keys()),
+            "added": added,
+        })
+
+# ------------------------------------------------------------
+# spatial queries
+# ------------------------------------------------------------
+class SegmentRegionRequest(BaseModel):
+    session_id: Optional[str] = None
+    box: Optional[List[float]] = None               # [x0, y0, x1, y1)
+    polygon: Optional[List[List[float]]] = None     # [[x, y], ...], at least 3 vertices
+    with_indexes: bool = False                      # also return the palette indexes of the segments
+
+def segment_region_error(request: SegmentRegionRequest) -> Optional[str]:
+    if (request.box is None) == (request.polygon is None):
+        return "Either box or polygon is required"
+    if request.box is not None and len(request.box) != 4:
+        return "box must be [x0, y0, x1, y1]"
+    if request.polygon is not None and (len(request.polygon) < 3 or any(len(vertex) != 2 for vertex in request.polygon)):
+        return "polygon must be at least 3 [x, y] vertices"
+    return None
+
+@app.get("/segments/at")
+def segment_at(x: int, y: int, session_id: Optional[str] = None):
+    '''
+    hit-test: the segment under pixel (x, y) with its cluster label, area, bbox and centroid, null on background
+    '''
+    session = get_session(session_id)
+    if session is None or session.palette_state is None:
+        return JSONResponse(content={"error": "No palette"}, status_code=400)
+    with session.lock:
+        index = session_segment_index(session)
+        with metrics.stage("query"):
+            segment = index.hit(x, y)
+        return JSONResponse(content={"segment": segment, "version": index.version})
+
+@app.post("/segments/count")
+def segment_count(request: SegmentRegionRequest):
+    '''
+    segments whose centroid is inside a box or a polygon, counted per cluster label (-1: not clustered yet)
+    '''
+    session = get_session(request.session_id)
+    if session is None or session.palette_state is None:
+        return JSONResponse(content={"error": "No palette"}, status_code=400)
+    error = segment_region_error(request)
+    if error is not None:
+        return JSONResponse(content={"error": error}, status_code=400)
+    with session.lock:
+        index = session_segment_index(session)
+        with metrics.stage("query"):
+            result = index.count(request.box, request.polygon, request.with_indexes)
+        return JSONResponse(content={**result, "version": index.version})
+
+@app.get("/segments/nearest")
+def segment_nearest(x: float, y: float, k: int = 5, label: Optional[int] = None, max_distance: Optional[float] = None, session_id: Optional[str] = None):
+    '''
+    the k segments with the closest centroids to (x, y), nearest first, optionally of one cluster label only
+    '''
+    session = get_session(session_id)
+    if session is None or session.palette_state is None:
+        return JSONResponse(content={"error": "No palette"}, status_code=400)
+    if not 1 <= k <= 1000:
+        return JSONResponse(content={"error": "k must be between 1 and 1000"}, status_code=400)
+    with session.lock:
+        index = session_segment_index(session)
+        with metrics.stage("query"):
+            segments = index.nearest(x, y, k, label, max_distance)
+        return JSONResponse(content={"segments": segments, "version": index.version})
+
+# ------------------------------------------------------------
+# background jobs
+# ------------------------------------------------------------
+@app.post("/jobs/segmentation")
+def submit_segmentation(request: SegmentationRequest):
+    session = get_session(request.session_id)
+    if session is None:
+        return JSONResponse(content={"error": "No image loaded"}, status_code=400)
+    error = segmentation_error(request, session)
+    if error is not None:
+        return JSONResponse(content={"error": error}, status_code=400)
+    try:
+        job = job_manager.submit("segmentation", metrics.traced_call, "job:segmentation", run_segmentation, session, request)
+    except JobQueueFull:
+        return JSONResponse(content={"error": "Job queue is full"}, status_code=429)
+    return JSONResponse(content={"job_id": job.job_id, "session_id": session.session_id})
+
+@app.post("/jobs/cluster")
+def submit_cluster(request: ClusterRequest):
+    session = get_session(request.session_id)
+    if session is None:
+        return JSONResponse(content={"error": "No image loaded"}, status_code=400)
+    error = cluster_error(request.backend, request.k, request.k_sweep)
+    if error is not None:
+        return JSONResponse(content={"error": error}, status_code=400)
+    try:
+        palette = np.array(request.palette, dtype=np.int32) if request.palette is not None else None
+        job = job_manager.submit("cluster", metrics.traced_call, "job:cluster", run_cluster, session, palette, request.k, request.seg_ratio, request.backend, request.k_sweep)
+    except JobQueueFull:
+        return JSONResponse(content={"error": "Job queue is full"}, status_code=429)
+    return JSONResponse(content={"job_id": job.job_id, "session_id": session.session_id})
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    try:
+        job = job_manager.get(job_id)
+    except KeyError:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    return JSONResponse(content=job.summary(with_result=True))
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    try:
+        job = job_manager.cancel(job_id)
+    except KeyError:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    return JSONResponse(content=job.summary())
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    '''
+    server-sent events with the progress of a job. the stream ends with the final status event
+    (done, failed or cancelled); the result itself is fetched from /jobs/{job_id}.
+    '''
+    try:
+        job = job_manager.get(job_id)
+    except KeyError:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+
+    async def stream():
+        sent = 0
+        while True:
+            events = await asyncio.to_thread(job.wait_events, sent)
+            for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+            sent += len(events)
+            if job.is_finished and sent >= len(job.events):
+                break
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
 
     
 if __name__ == "__main__":
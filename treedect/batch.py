@@ -0,0 +1,179 @@
+'''
+headless batch mode: segment and cluster every image of a directory, without the web frontend.
+
+    python batch.py <input_dir> <output_dir> --k 6 --workers 2
+
+every image gets a folder in output_dir, named after the image file (a.jpg and a.tif do not collide), holding
+    palette.npy      HxW int32 palette, 0 is background (written after segmentation)
+    segments.csv     one row per segment: palette value, cluster label, area, block count, bbox (inclusive), mean color
+    result.json      segmentation and clustering statistics (written last, marks the image as done)
+images with result.json are skipped on the next run, and images with only palette.npy resume at clustering.
+the models are loaded once and shared by the workers; SAM2 runs one image at a time while the other workers
+decode, filter and cluster.
+'''
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+
+import pipeline
+from clustering import CLUSTER_BACKENDS
+from inference import profile
+from tiling import open_mosaic
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+def list_images(input_dir: str):
+    return sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+def save_atomic(path: str, write):
+    '''
+    write(tmp_path) then rename, so an interrupted run never leaves a truncated checkpoint behind
+    '''
+    tmp = f"{path}.tmp{os.path.splitext(path)[1]}"
+    write(tmp)
+    os.replace(tmp, path)
+
+def write_json(path: str, data: dict):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+def load_image(path: str, args):
+    if args.tile_size > 0:
+        return open_mosaic(path, os.path.join(args.output_dir, ".work"))
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"cannot read image: {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), []
+
+def write_segments(path: str, dataset, labels):
+    def write(tmp):
+        with open(tmp, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["segment", "label", "area", "block_count", "top", "left", "bottom", "right", "mean_r", "mean_g", "mean_b"])
+            for i in range(len(dataset)):
+                if not dataset.valid[i]:
+                    continue
+                writer.writerow([
+                    i + 1, labels[i], dataset.area[i], dataset.block_count[i],
+                    dataset.top[i], dataset.left[i], dataset.bottom[i], dataset.right[i],
+                    *(round(float(c), 2) for c in dataset.mean_color[i]),
+                ])
+    save_atomic(path, write)
+
+def process_image(path: str, args) -> dict:
+    name = os.path.basename(path)
+    out_dir = os.path.join(args.output_dir, name)
+    result_path = os.path.join(out_dir, "result.json")
+    palette_path = os.path.join(out_dir, "palette.npy")
+    if os.path.exists(result_path):
+        return {"image": name, "status": "skipped"}
+    os.makedirs(out_dir, exist_ok=True)
+
+    start = time.time()
+    image, files = load_image(path, args)
+    session = pipeline.session_store.create(image, files)
+    try:
+        result = {"image": name}
+        if os.path.exists(palette_path):
+            palette = np.load(palette_path)
+            result["segmentation"] = "resumed"
+        else:
+            request = pipeline.SegmentationRequest(
+                session_id=session.session_id,
+                row_sample_interval=args.interval,
+                col_sample_interval=args.interval,
+                overlap_ratio=args.overlap_ratio,
+                batch_size=args.batch_size,
+                schedule=args.schedule,
+                tile_size=args.tile_size,
+                tile_overlap=args.tile_overlap,
+            )
+            error = pipeline.segmentation_error(request, session)
+            if error is not None:
+                raise ValueError(error)
+            segmentation = pipeline.run_segmentation(session, request)
+            palette = session.palette_state.palette
+            save_atomic(palette_path, lambda tmp: np.save(tmp, palette))
+            result["segmentation"] = {"num_masks": segmentation["num_masks"], "prompt_stats": segmentation["prompt_stats"]}
+        result["seconds_segmentation"] = round(time.time() - start, 2)
+
+        cluster = pipeline.run_cluster(session, palette, args.k, args.seg_ratio, args.backend)
+        write_segments(os.path.join(out_dir, "segments.csv"), session.dataset, cluster["labels"])
+        result["num_segments"] = int(sum(session.dataset.valid))
+        result["k"] = args.k
+        result["seconds"] = round(time.time() - start, 2)
+        save_atomic(result_path, lambda tmp: write_json(tmp, result))
+        result["status"] = "done"
+        return result
+    finally:
+        pipeline.session_store.remove(session.session_id)
+
+def main():
+    parser = argparse.ArgumentParser(description="segment and cluster every image of a directory")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--k", type=int, default=6, help="number of clusters")
+    parser.add_argument("--seg-ratio", type=int, default=2)
+    parser.add_argument("--backend", default="umap", choices=sorted(CLUSTER_BACKENDS))
+    parser.add_argument("--interval", type=int, default=40, help="prompt grid spacing in pixels")
+    parser.add_argument("--overlap-ratio", type=float, default=0.3)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--schedule", default="full", choices=("full", "adaptive"))
+    parser.add_argument("--tile-size", type=int, default=0, help="> 0 segments in tiles, see /load_mosaic")
+    parser.add_argument("--tile-overlap", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    profile.configure_threads()
+    pipeline.startup.start()
+    os.makedirs(args.output_dir, exist_ok=True)
+    images = list_images(args.input_dir)
+    logging.info(f"{len(images)} images in {args.input_dir}")
+
+    start = time.time()
+    done = failed = skipped = 0
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="treedect-batch") as pool:
+        futures = {pool.submit(process_image, path, args): path for path in images}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                logging.exception(f"{path} failed: {e}")
+                continue
+            if result["status"] == "skipped":
+                skipped += 1
+                continue
+            done += 1
+            elapsed = time.time() - start
+            logging.info(
+                f"[{done + failed + skipped}/{len(images)}] {result['image']}: {result['num_segments']} segments "
+                f"in {result['seconds']:.1f} s, {done / elapsed * 3600:.1f} images/hour"
+            )
+
+    elapsed = time.time() - start
+    summary = {
+        "images": len(images),
+        "done": done,
+        "skipped": skipped,
+        "failed": failed,
+        "seconds": round(elapsed, 2),
+        "images_per_hour": round(done / elapsed * 3600, 2) if done > 0 else 0.0,
+    }
+    write_json(os.path.join(args.output_dir, "summary.json"), summary)
+    logging.info(f"batch finished: {summary}")
+
+if __name__ == "__main__":
+    main()
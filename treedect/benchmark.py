@@ -0,0 +1,262 @@
+'''
+stage benchmarks on synthetic tree crown images, runnable on a cpu-only box without model weights.
+
+    python benchmark.py --output baseline.json                  # run and save a baseline
+    python benchmark.py --compare baseline.json                 # run and flag stages slower than the baseline
+
+SAM2 is replaced by StubPredictor, which answers a point prompt with the synthetic crown under it, through the
+same decode_point_batch path as the real model. DINOv2 is replaced by random patch tokens, so feature pooling
+and clustering see realistic shapes. every stage is timed on its own, repeat times, keeping min and median.
+progress bars are off while timing, and the run happens in a temporary directory because FeatureExtractionDataset
+writes visualization.png in the working directory.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import types
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+import prompt
+
+from clustering import CLUSTER_BACKENDS, build_features
+from feature import CropPipeline, FeatureExtractionDataset, pool_patch_tokens
+from prompt import grid_prompt_order, predict_points_batched
+from utils import filter_overlap_segments, generation_sample_grid, masks_to_palette
+
+# name: (height, width, number of crowns, crown radius range)
+SIZES = {
+    "small": (1024, 1024, 150, (20, 60)),
+    "medium": (2048, 2048, 600, (20, 60)),
+    "large": (4096, 4096, 2400, (20, 60)),
+}
+
+def synthetic_crowns(height: int, width: int, crowns: int, radius: tuple, seed: int = 0):
+    '''
+    (RGB image, ground truth palette): overlapping discs of per-crown colour over a noisy ground, later crowns on top
+    '''
+    rng = np.random.default_rng(seed)
+    palette = np.zeros((height, width), dtype=np.int32)
+    colors = np.zeros((crowns + 1, 3), dtype=np.float32)
+    colors[0] = (110, 90, 60)
+    for label in range(1, crowns + 1):
+        r = int(rng.integers(*radius))
+        cy, cx = int(rng.integers(0, height)), int(rng.integers(0, width))
+        top, bottom, left, right = max(cy - r, 0), min(cy + r + 1, height), max(cx - r, 0), min(cx + r + 1, width)
+        yy, xx = np.ogrid[top:bottom, left:right]
+        palette[top:bottom, left:right][(yy - cy) ** 2 + (xx - cx) ** 2 <= r * r] = label
+        colors[label] = (rng.integers(20, 80), rng.integers(90, 200), rng.integers(20, 80))
+    image = colors[palette] + rng.normal(0, 12, (height, width, 3))
+    return np.clip(image, 0, 255).astype(np.uint8), palette
+
+class _StubPromptEncoder(torch.nn.Module):
+    def forward(self, points, boxes, masks):
+        coords, labels = points
+        return coords, None
+
+    def get_dense_pe(self):
+        return None
+
+class _StubMaskDecoder(torch.nn.Module):
+    '''
+    low-res logits of the crown under each prompt: +1 inside, -1 outside, with weaker copies as the other two
+    multimask outputs. cheap on purpose, the stage timings should measure the pipeline and not the stub
+    '''
+    def __init__(self, low_res_palette: torch.Tensor, resolution: int):
+        super().__init__()
+        self.low_res_palette = low_res_palette
+        self.scale = low_res_palette.shape[-1] / resolution
+
+    def forward(self, image_embeddings, image_pe, sparse_prompt_embeddings, dense_prompt_embeddings, multimask_output, repeat_image, high_res_features):
+        size = self.low_res_palette.shape[-1]
+        coords = (sparse_prompt_embeddings[:, 0] * self.scale).long().clamp(0, size - 1)
+        labels = self.low_res_palette[coords[:, 1], coords[:, 0]]
+        inside = (self.low_res_palette[None] == labels[:, None, None]) & (labels[:, None, None] != 0)
+        logits = inside.float()[:, None] * 2 - 1
+        low_res_masks = logits * torch.tensor([1.0, 0.5, 0.25]).view(1, 3, 1, 1)
+        iou_predictions = torch.tensor([[0.9, 0.7, 0.8]]).expand(len(coords), 3)
+        return low_res_masks, iou_predictions, None, None
+
+class _StubTransforms:
+    def __init__(self, resolution: int):
+        self.resolution = resolution
+
+    def transform_coords(self, coords, normalize=False, orig_hw=None):
+        coords = coords.clone()
+        coords[..., 0] = coords[..., 0] / orig_hw[1]
+        coords[..., 1] = coords[..., 1] / orig_hw[0]
+        return coords * self.resolution
+
+    def postprocess_masks(self, masks, orig_hw):
+        return F.interpolate(masks.float(), orig_hw, mode="bilinear", align_corners=False)
+
+class StubPredictor:
+    '''
+    deterministic stand-in for SAM2ImagePredictor after set_image, with the attributes decode_point_batch uses
+    '''
+    def __init__(self, palette: np.ndarray, resolution: int = 1024, low_res: int = 256):
+        height, width = palette.shape
+        rows = np.arange(low_res) * height // low_res
+        cols = np.arange(low_res) * width // low_res
+        low_res_palette = torch.from_numpy(palette[rows[:, None], cols[None, :]])
+        self.model = types.SimpleNamespace(
+            sam_prompt_encoder=_StubPromptEncoder(),
+            sam_mask_decoder=_StubMaskDecoder(low_res_palette, resolution),
+        )
+        self._transforms = _StubTransforms(resolution)
+        self._features = {"image_embed": torch.zeros(1, 1, 1, 1), "high_res_feats": []}
+        self._orig_hw = [(height, width)]
+        self._is_image_set = True
+        self.mask_threshold = 0.0
+        self.device = torch.device("cpu")
+
+    def _prep_prompts(self, point_coords, point_labels, box, mask_logits, normalize_coords, img_idx=-1):
+        coords = torch.as_tensor(point_coords, dtype=torch.float32)
+        coords = self._transforms.transform_coords(coords, normalize=normalize_coords, orig_hw=self._orig_hw[img_idx])
+        return None, coords, torch.as_tensor(point_labels, dtype=torch.int32), None
+
+def time_stage(fn: Callable, repeat: int) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return {"min": round(min(seconds), 6), "median": round(statistics.median(seconds), 6), "repeat": repeat}
+
+def run_size(name: str, repeat: int, interval: int = 40, ratio: float = 0.3, k: int = 6) -> Dict[str, dict]:
+    height, width, crowns, radius = SIZES[name]
+    image, truth = synthetic_crowns(height, width, crowns, radius)
+    predictor = StubPredictor(truth)
+    results = {}
+    state = {}
+
+    def stage(stage_name: str, fn: Callable):
+        results[f"{name}/{stage_name}"] = time_stage(fn, repeat)
+        print(f"{name:>8} {stage_name:<18} {results[f'{name}/{stage_name}']['min'] * 1000:10.2f} ms", file=sys.stderr)
+
+    def grid():
+        state["grid"] = generation_sample_grid(height, width, interval, interval)
+
+    def prompting():
+        with torch.inference_mode():
+            state["masks"] = predict_points_batched(predictor, grid_prompt_order(state["grid"]), 16)
+
+    def filtering():
+        state["points"], state["filtered"] = filter_overlap_segments(state["grid"], state["masks"], height, width, ratio)
+
+    def palette():
+        state["palette"] = masks_to_palette(state["filtered"], height, width)
+
+    def dataset():
+        state["dataset"] = FeatureExtractionDataset(state["palette"], image, 16, 2)
+
+    def crops():
+        dataset = state["dataset"]
+        valid = [i for i in range(len(dataset)) if dataset.valid[i]]
+        pipeline = CropPipeline(dataset, valid, 128, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), "cpu", num_workers=min(4, os.cpu_count() or 1))
+        state["block_masks"] = [block_mask for _, block_mask, _ in pipeline]
+
+    def pooling():
+        rng = torch.Generator().manual_seed(0)
+        pooled = []
+        with torch.inference_mode():
+            for block_mask in state["block_masks"]:
+                tokens = torch.randn(len(block_mask), 1 + 16 * 16, 384, generator=rng)
+                pooled.append(pool_patch_tokens(tokens, block_mask))
+        state["tokens"] = torch.cat(pooled).numpy()
+
+    def clustering(backend: str):
+        def run():
+            dataset = state["dataset"]
+            valid = [i for i in range(len(dataset)) if dataset.valid[i]]
+            features = build_features(state["tokens"], dataset.mean_color[valid], dataset.std_color[valid], np.asarray(dataset.area, dtype=np.float32)[valid])
+            embedding = CLUSTER_BACKENDS[backend].embed(features)
+            CLUSTER_BACKENDS[backend].fit(embedding, k)
+        return run
+
+    stage("sample_grid", grid)
+    stage("prompting", prompting)
+    stage("filter_overlap", filtering)
+    stage("masks_to_palette", palette)
+    stage("generate_dataset", dataset)
+    stage("crops", crops)
+    stage("pooling", pooling)
+    stage("cluster_fast", clustering("fast"))
+    try:
+        import umap     # noqa: F401
+        stage("cluster_umap", clustering("umap"))
+    except ImportError:
+        pass
+    results[f"{name}/segments"] = {"count": int(state["dataset"].num_segs), "masks": len(state["masks"])}
+    return results
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float, min_seconds: float) -> List[str]:
+    '''
+    stages whose min time grew by more than tolerance (relative) and min_seconds (absolute) against the baseline
+    '''
+    regressions = []
+    for key, result in sorted(results.items()):
+        if "min" not in result or key not in baseline:
+            continue
+        old, new = baseline[key]["min"], result["min"]
+        ratio = new / old if old > 0 else float("inf")
+        flag = ratio > 1 + tolerance and new - old > min_seconds
+        print(f"{key:<28} {old * 1000:10.2f} ms -> {new * 1000:10.2f} ms  x{ratio:5.2f}{'  REGRESSION' if flag else ''}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="stage benchmarks on synthetic images")
+    parser.add_argument("--sizes", default="small", help=f"comma separated, of {', '.join(SIZES)}")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage, the min is compared. below 5 the noise shows as regressions")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="baseline json to compare against, exit code 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument("--min-seconds", type=float, default=0.005, help="ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    prompt.tqdm = lambda *a, **kw: tqdm(*a, **kw, disable=True)     # drawing the bar is not pipeline work
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for name in args.sizes.split(","):
+                results.update(run_size(name.strip(), args.repeat))
+        finally:
+            os.chdir(cwd)
+    report = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import numpy as np
+from typing import Callable, Dict, List, Optional
+
+class ClusterBackend:
+    '''
+    a clustering backend turns the per-segment features into an embedding once (embed),
+    and labels that embedding for a given k (fit). embed is the expensive part and is cached by the caller.
+    '''
+    def __init__(self, name: str, embed: Callable[[np.ndarray], np.ndarray], fit: Callable[[np.ndarray, int], np.ndarray]):
+        self.name = name
+        self.embed = embed
+        self.fit = fit
+
+CLUSTER_BACKENDS: Dict[str, ClusterBackend] = {}
+
+def register_backend(name: str, embed: Callable[[np.ndarray], np.ndarray], fit: Callable[[np.ndarray, int], np.ndarray]):
+    CLUSTER_BACKENDS[name] = ClusterBackend(name, embed, fit)
+
+def build_features(cls_tokens: np.ndarray, mean_color: np.ndarray, std_color: np.ndarray, area: np.ndarray) -> np.ndarray:
+    '''
+    texture features (PCA of the DINOv2 tokens) concatenated with the manual colour/area features, standardized
+    '''
+    # sklearn and umap are imported on first use, they are slow to import and not needed to serve segmentation
+    from sklearn.decomposition import PCA
+    from sklearn.preprocessing import StandardScaler, normalize
+
+    # PCA on texture features from DINOv2
+    # [VARI] does it need normalization?
+    pca = PCA(n_components=min(7, *cls_tokens.shape))
+    texture_features = pca.fit_transform(cls_tokens)
+    texture_features = normalize(texture_features, norm='l2')
+
+    # manual features
+    manual_features = np.concatenate([mean_color, std_color, area[:, None]], axis=-1)
+    features = np.concatenate([texture_features, manual_features], axis=-1)
+
+    scaler = StandardScaler()
+    return scaler.fit_transform(features)
+
+def _umap_embed(features: np.ndarray, **kwargs) -> np.ndarray:
+    import umap
+    reducer = umap.UMAP(n_neighbors=30, min_dist=0.0, n_components=3, **kwargs)
+    return reducer.fit_transform(features)
+
+def _kmeans(embedding: np.ndarray, k: int) -> np.ndarray:
+    from sklearn.cluster import KMeans
+    return KMeans(n_clusters=k, random_state=0).fit_predict(embedding)
+
+def _minibatch_kmeans(embedding: np.ndarray, k: int) -> np.ndarray:
+    from sklearn.cluster import MiniBatchKMeans
+    return MiniBatchKMeans(n_clusters=k, random_state=0, batch_size=1024, n_init=3).fit_predict(embedding)
+
+# the original pipeline: exact UMAP then KMeans
+register_backend("umap", _umap_embed, _kmeans)
+# UMAP forced onto approximate nearest neighbours (NN-descent) with fewer epochs
+register_backend("umap_approx", lambda features: _umap_embed(features, force_approximation_algorithm=True, n_epochs=200, low_memory=True), _kmeans)
+# no manifold learning, the standardized PCA features go straight to MiniBatchKMeans
+register_backend("fast", lambda features: features, _minibatch_kmeans)
+
+def cluster_scores(embedding: np.ndarray, labels: np.ndarray, sample_size: int = 2000) -> Dict[str, Optional[float]]:
+    '''
+    quality of a clustering, silhouette on a fixed random sample to bound its quadratic cost
+    '''
+    from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_score
+    if len(np.unique(labels)) < 2 or len(np.unique(labels)) >= len(labels):
+        return {"silhouette": None, "calinski_harabasz": None, "davies_bouldin": None}
+    return {
+        "silhouette": float(silhouette_score(embedding, labels, sample_size=min(sample_size, len(labels)), random_state=0)),
+        "calinski_harabasz": float(calinski_harabasz_score(embedding, labels)),
+        "davies_bouldin": float(davies_bouldin_score(embedding, labels)),
+    }
+
+def sweep_k(backend: ClusterBackend, embedding: np.ndarray, ks: List[int]) -> List[dict]:
+    '''
+    fit every k on the same embedding. returns [{"k", "labels", "scores"}] in the order of ks
+    '''
+    results = []
+    for k in ks:
+        labels = backend.fit(embedding, k)
+        results.append({"k": k, "labels": labels, "scores": cluster_scores(embedding, labels)})
+    return results
@@ -0,0 +1,88 @@
+import gzip
+import zlib
+import numpy as np
+
+PALETTE_ENCODINGS = ("gzip", "raw", "rle")
+GZIP_MAGIC = b"\x1f\x8b"
+
+def encode_palette(palette: np.ndarray, encoding: str = "gzip") -> bytes:
+    '''
+    binary palette formats shared by /generate_segmentation and /cluster/upload, all little-endian int32:
+    - raw:  the row-major HxW palette
+    - gzip: gzip of raw (what /generate_segmentation returns, base64 encoded)
+    - rle:  gzip of (value, run length) pairs over the row-major palette
+    '''
+    flat = np.ascontiguousarray(palette, dtype='<i4').ravel()
+    if encoding == "raw":
+        return flat.tobytes()
+    if encoding == "gzip":
+        return gzip.compress(flat.tobytes())
+    if encoding == "rle":
+        starts = np.flatnonzero(np.diff(flat, prepend=flat[:1] - 1))
+        lengths = np.diff(np.append(starts, len(flat)))
+        pairs = np.stack([flat[starts], lengths], axis=-1).astype('<i4')
+        return gzip.compress(pairs.tobytes())
+    raise ValueError(f"unknown palette encoding: {encoding}")
+
+def decode_palette(data: bytes, height: int, width: int, encoding: str = "gzip") -> np.ndarray:
+    '''
+    inverse of encode_palette. raw data is wrapped without copying (the result is read-only), and gzip
+    is detected by its magic bytes, so raw and gzip payloads are accepted under either name.
+    any malformed payload raises ValueError.
+    '''
+    if encoding not in PALETTE_ENCODINGS:
+        raise ValueError(f"unknown palette encoding: {encoding}")
+    if data[:2] == GZIP_MAGIC:
+        # an rle palette holds at most one run per pixel
+        data = _gunzip(data, height * width * (8 if encoding == "rle" else 4))
+    if encoding == "rle":
+        if len(data) % 8 != 0:
+            raise ValueError(f"rle palette has {len(data)} bytes, not a multiple of 8")
+        pairs = np.frombuffer(data, dtype='<i4').reshape(-1, 2)
+        if (pairs[:, 1] < 0).any():
+            raise ValueError("rle palette has negative run lengths")
+        if pairs[:, 1].sum() != height * width:
+            raise ValueError(f"rle palette covers {pairs[:, 1].sum()} pixels, expected {height * width}")
+        return np.repeat(pairs[:, 0], pairs[:, 1]).reshape(height, width)
+    if len(data) != height * width * 4:
+        raise ValueError(f"palette has {len(data)} bytes, expected {height * width * 4}")
+    return np.frombuffer(data, dtype='<i4').reshape(height, width)
+
+def _gunzip(data: bytes, max_bytes: int) -> bytes:
+    '''
+    gzip.decompress that raises ValueError for corrupt or truncated data, and stops past max_bytes so a small
+    payload cannot inflate without bound
+    '''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        out = decompressor.decompress(data, max_bytes + 1)
+    except zlib.error as e:
+        raise ValueError(f"corrupt gzip palette: {e}") from e
+    if len(out) > max_bytes:
+        raise ValueError(f"palette inflates to more than {max_bytes} bytes")
+    if not decompressor.eof:
+        raise ValueError("truncated gzip palette")
+    return out
+
+if __name__ == '__main__':
+    # decode time of the JSON list path against the binary formats, on a synthetic palette
+    import json
+    import time
+
+    height, width = 3000, 4000
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 2000, (height // 40 + 1, width // 40 + 1))
+    palette = np.repeat(np.repeat(blocks, 40, axis=0), 40, axis=1)[:height, :width].astype(np.int32)
+
+    payload = json.dumps({"palette": palette.tolist()})
+    start = time.time()
+    decoded = np.array(json.loads(payload)["palette"], dtype=np.int32)
+    print(f"json: {len(payload) / 1e6:.1f} MB, decode {time.time() - start:.2f} s")
+    assert np.array_equal(decoded, palette)
+
+    for encoding in PALETTE_ENCODINGS:
+        data = encode_palette(palette, encoding)
+        start = time.time()
+        decoded = decode_palette(data, height, width, encoding)
+        print(f"{encoding}: {len(data) / 1e6:.1f} MB, decode {time.time() - start:.3f} s")
+        assert np.array_equal(decoded, palette)
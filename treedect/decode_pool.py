@@ -0,0 +1,202 @@
+import io
+import math
+import queue
+import threading
+import time
+import traceback
+import types
+from typing import TYPE_CHECKING, Callable, Optional
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import metrics
+from masks import MaskStore
+from prompt import decode_point_batch
+
+if TYPE_CHECKING:
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+class _DecoderView:
+    '''
+    the parts of SAM2ImagePredictor that decode_point_batch uses, rebuilt in a worker process
+    without the image encoder
+    '''
+    def __init__(self, prompt_encoder: torch.nn.Module, mask_decoder: torch.nn.Module, transforms: dict):
+        from sam2.utils.transforms import SAM2Transforms
+        self.model = types.SimpleNamespace(sam_prompt_encoder=prompt_encoder, sam_mask_decoder=mask_decoder)
+        self._transforms = SAM2Transforms(**transforms)
+        self.mask_threshold = transforms["mask_threshold"]
+        self.device = torch.device("cpu")
+        self._is_image_set = True
+        self._features = None
+        self._orig_hw = None
+
+    def _prep_prompts(self, *args, **kwargs):
+        from sam2.sam2_image_predictor import SAM2ImagePredictor
+        return SAM2ImagePredictor._prep_prompts(self, *args, **kwargs)
+
+def _worker(modules: bytes, transforms: dict, threads: int, tasks, results, cancelled):
+    torch.set_num_threads(threads)
+    prompt_encoder, mask_decoder = torch.load(io.BytesIO(modules), weights_only=False)
+    view = _DecoderView(prompt_encoder, mask_decoder, transforms)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, index, features, orig_hw, points, batch_size, selection = task
+        if job_id <= cancelled.value:   # the rest of a failed request
+            continue
+        try:
+            view._features = features
+            view._orig_hw = orig_hw
+            masks = []
+            with torch.inference_mode():
+                for start in range(0, len(points), batch_size):
+                    for box, crop in decode_point_batch(view, points[start:start + batch_size], selection):
+                        masks.append((box, np.packbits(crop, axis=1), int(np.count_nonzero(crop))))
+            results.put((job_id, index, len(points), masks, None))
+        except Exception:
+            results.put((job_id, index, len(points), None, traceback.format_exc()))
+
+class DecoderPool:
+    '''
+    SAM2 prompt decoding sharded over worker processes, for cpu deployments where one process decodes on one core.
+    every worker holds a copy of the prompt encoder and the mask decoder, sent serialized so int8 quantized
+    decoders work as well, and receives the image embedding of each request through torch shared memory
+    (moved there once, then passed by handle). the points are cut into chunks of whole batches, a few per worker
+    so the load stays balanced, and the masks are merged in chunk order, i.e. the input order: the result equals
+    predict_points_batched with the same batch_size.
+    a worker that dies (killed, out of memory) fails the request running at the time instead of hanging it,
+    and the pool is started afresh for the next one.
+    '''
+    def __init__(self, predictor: "SAM2ImagePredictor", num_workers: int, threads_per_worker: int = 1, chunks_per_worker: int = 4, poll_seconds: float = 1.0):
+        # forkserver imports the main module once, as __mp_main__, and forks the workers from it. a main module
+        # such as api.py must not load the models when imported under that name
+        self._context = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+        self._transforms = {
+            "resolution": predictor._transforms.resolution,
+            "mask_threshold": predictor.mask_threshold,
+            "max_hole_area": predictor._transforms.max_hole_area,
+            "max_sprinkle_area": predictor._transforms.max_sprinkle_area,
+        }
+        modules = io.BytesIO()
+        torch.save((predictor.model.sam_prompt_encoder, predictor.model.sam_mask_decoder), modules)
+        self._modules = modules.getvalue()
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.chunks_per_worker = chunks_per_worker
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._job_id = 0
+        self._workers = []
+        self._start()
+
+    def _start(self):
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        # tasks of job ids up to this one are skipped by the workers
+        self._cancelled = self._context.Value("q", self._job_id)
+        self._workers = [
+            self._context.Process(
+                target=_worker,
+                args=(self._modules, self._transforms, self.threads_per_worker, self._tasks, self._results, self._cancelled),
+                name=f"treedect-decoder-{i}",
+                daemon=True,
+            )
+            for i in range(self.num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _restart(self):
+        '''
+        a dead worker may have held the lock of a queue, so the queues are replaced along with all workers
+        '''
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._start()
+
+    def _next_result(self, timeout: Optional[float], started: float):
+        while True:
+            try:
+                return self._results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                pass
+            dead = [worker.name for worker in self._workers if not worker.is_alive()]
+            if dead:
+                self._restart()
+                raise RuntimeError(f"decoder workers died: {', '.join(dead)}")
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise TimeoutError(f"decoding took longer than {timeout} seconds")
+
+    def decode(
+        self,
+        predictor: "SAM2ImagePredictor",
+        points: np.ndarray,
+        batch_size: int = 16,
+        selection: str = "first",
+        progress: Optional[Callable[[int, int], None]] = None,
+        timeout: Optional[float] = None,
+    ) -> MaskStore:
+        '''
+        masks of the points for the image set on predictor, as predict_points_batched returns them.
+        raises RuntimeError if a worker fails or dies, TimeoutError after timeout seconds
+        '''
+        height, width = predictor._orig_hw[-1]
+        masks = MaskStore(height, width)
+        if len(points) == 0:
+            return masks
+        # only the last image of the predictor is decoded, as in decode_point_batch
+        features = {
+            "image_embed": predictor._features["image_embed"].cpu().share_memory_(),
+            "high_res_feats": [feat.cpu().share_memory_() for feat in predictor._features["high_res_feats"]],
+        }
+        batches = math.ceil(len(points) / batch_size)
+        chunk = batch_size * max(1, math.ceil(batches / (self.num_workers * self.chunks_per_worker)))
+        starts = list(range(0, len(points), chunk))
+
+        # one request at a time, the result queue is shared
+        with self._lock:
+            self._job_id += 1
+            job_id = self._job_id
+            started = time.monotonic()
+            try:
+                for index, start in enumerate(starts):
+                    self._tasks.put((job_id, index, features, predictor._orig_hw, points[start:start + chunk], batch_size, selection))
+                received = {}
+                done = 0
+                while len(received) < len(starts):
+                    result_job, index, count, chunk_masks, error = self._next_result(timeout, started)
+                    if result_job != job_id:    # left over from a failed request
+                        continue
+                    if error is not None:
+                        raise RuntimeError(f"decoder worker failed:\n{error}")
+                    received[index] = chunk_masks
+                    done += count
+                    if progress is not None:
+                        progress(done, len(points))
+            except BaseException:
+                # the workers drop the chunks of this request still queued
+                self._cancelled.value = job_id
+                raise
+
+        # the workers do not see the trace of the request
+        metrics.count("decoder_calls", batches)
+        for index in range(len(starts)):
+            for box, payload, area in received[index]:
+                masks.append_packed(box, payload, area)
+        return masks
+
+    def close(self):
+        with self._lock:
+            for _ in self._workers:
+                self._tasks.put(None)
+            for worker in self._workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+            self._workers = []
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+class EmbeddingCache:
+    '''
+    persistent content-addressed cache for SAM2 image embeddings (predictor._features).
+    an entry is a directory named by the hash of the image, the model name and variant, holding one .npy file
+    per feature tensor plus meta.json. variant names the settings the encoder output depends on, such as the
+    device and precision (see InferenceProfile.variant), and is checked against meta.json on load. tensors are loaded back memory-mapped; bfloat16 tensors are stored
+    as their raw 16 bit pattern, so the loaded features are bit-identical to the encoder output.
+    entries are evicted least recently used once the cache grows beyond max_bytes.
+    '''
+    def __init__(self, root: str, model_name: str, max_bytes: int = 10 * 1024 ** 3, variant: str = ""):
+        self.root = root
+        self.model_name = model_name
+        self.variant = variant
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, image: np.ndarray) -> str:
+        h = hashlib.sha256()
+        h.update(self.model_name.encode())
+        h.update(self.variant.encode())
+        h.update(str(image.shape).encode())
+        h.update(str(image.dtype).encode())
+        h.update(np.ascontiguousarray(image).data)
+        return h.hexdigest()
+
+    def get(self, key: str, device) -> Optional[Tuple[dict, List[Tuple[int, int]]]]:
+        '''
+        returns (features, orig_hw) as set_image leaves them on the predictor, or None on a miss
+        '''
+        path = os.path.join(self.root, key)
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get("model_name") != self.model_name or meta.get("variant", "") != self.variant:
+                raise ValueError("entry of another model or variant")
+            image_embed = self._load(path, "image_embed", meta["dtypes"]["image_embed"], device)
+            high_res_feats = [
+                self._load(path, f"high_res_feats_{i}", dtype, device)
+                for i, dtype in enumerate(meta["dtypes"]["high_res_feats"])
+            ]
+        except (OSError, ValueError, KeyError):
+            shutil.rmtree(path, ignore_errors=True)     # broken entry
+            return None
+        os.utime(meta_path)     # mark as recently used
+        orig_hw = [tuple(hw) for hw in meta["orig_hw"]]
+        return {"image_embed": image_embed, "high_res_feats": high_res_feats}, orig_hw
+
+    def put(self, key: str, features: dict, orig_hw: List[Tuple[int, int]]):
+        path = os.path.join(self.root, key)
+        if os.path.exists(path):
+            return
+        tmp_path = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            dtypes = {
+                "image_embed": self._save(tmp_path, "image_embed", features["image_embed"]),
+                "high_res_feats": [
+                    self._save(tmp_path, f"high_res_feats_{i}", feat)
+                    for i, feat in enumerate(features["high_res_feats"])
+                ],
+            }
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump({
+                    "model_name": self.model_name,
+                    "variant": self.variant,
+                    "orig_hw": [list(hw) for hw in orig_hw],
+                    "dtypes": dtypes,
+                    "created": time.time(),
+                }, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                meta_path = os.path.join(path, "meta.json")
+                if name.startswith(".") or not os.path.exists(meta_path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(meta_path), size, path))
+                total += size
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    @staticmethod
+    def _save(path: str, name: str, tensor: torch.Tensor) -> str:
+        tensor = tensor.detach().cpu().contiguous()
+        dtype = str(tensor.dtype).replace("torch.", "")
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.view(torch.int16)
+        np.save(os.path.join(path, f"{name}.npy"), tensor.numpy())
+        return dtype
+
+    @staticmethod
+    def _load(path: str, name: str, dtype: str, device) -> torch.Tensor:
+        array = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c")
+        tensor = torch.from_numpy(array)
+        if dtype == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+        return tensor.to(device)
@@ -3,10 +3,20 @@ import torch
 import numpy as np
 from torch.utils.data import Dataset
 import cv2
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
 
-from utils import create_block_mask_in_bbox, create_block_mask_in_global
+from typing import Dict, Tuple
+
+from utils import block_area_in_bbox, count_blocks_in_global, count_segment_blocks
 
 class FeatureExtractionDataset(Dataset):
+    band_rows = 1024    # image rows read at once by _generate_dataset
+
     def __init__(self, palette: np.ndarray, image, n_patch, seg_ratio = 2):
         super().__init__()
         self.palette = palette
@@ -17,63 +27,124 @@ class FeatureExtractionDataset(Dataset):
         self.image = image
 
         self.num_segs = int(palette.max())
-        
-        self.left = [float('inf') for _ in range(self.num_segs)]
-        self.top = [float('inf') for _ in range(self.num_segs)]   # left up corner
-        self.right = [0 for _ in range(self.num_segs)]
-        self.bottom = [0 for _ in range(self.num_segs)]    # right down corner
-
-        self.area = [0 for _ in range(self.num_segs)]
-        self.valid = [1 for _ in range(self.num_segs)]
-        self.mean_color = [np.array([0, 0, 0], dtype=np.float32) for _ in range(self.num_segs)]
-        self.std_color = [np.array([0, 0, 0], dtype=np.float32) for _ in range(self.num_segs)]
-        self.block_count = [0 for _ in range(self.num_segs)]
 
         self._generate_dataset()
 
-        self._visualization()
+        # a copy of the whole image, not for mosaics
+        if not isinstance(image, np.memmap):
+            self._visualization()
 
         # import pickle
         # pickle.dump(self.palette, open("palette.pkl", "wb"))
         # pickle.dump(self.image, open("image.pkl", "wb"))
 
     def _generate_dataset(self):
+        '''
+        per-segment bbox, area, colour statistics and block count, computed with whole-array reductions.
+        palette value i (i >= 1) is segment i - 1, 0 is background.
+        '''
+        # colour moments, in bands of rows so the float64 copy of a (memory-mapped) mosaic stays small.
+        # pixels are integers so the float64 sums are exact
+        n = self.num_segs + 1
+        channels = self.image.shape[-1]
+        area = np.zeros(n, dtype=np.int64)
+        color_sum = np.zeros((n, channels), dtype=np.float64)
+        color_sq_sum = np.zeros((n, channels), dtype=np.float64)
+        for top in range(0, self.height, self.band_rows):
+            labels = self.palette[top:top + self.band_rows].ravel()
+            pixels = np.asarray(self.image[top:top + self.band_rows]).reshape(-1, channels).astype(np.float64)
+            area += np.bincount(labels, minlength=n)
+            for c in range(channels):
+                color_sum[:, c] += np.bincount(labels, weights=pixels[:, c], minlength=n)
+                color_sq_sum[:, c] += np.bincount(labels, weights=pixels[:, c] ** 2, minlength=n)
+        area, color_sum, color_sq_sum = area[1:], color_sum[1:], color_sq_sum[1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_color = np.where(area[:, None] > 0, color_sum / np.maximum(area, 1)[:, None], 0)
+            # sample variance (ddof = 1), same as the former welford accumulation
+            std_color = (color_sq_sum - area[:, None] * mean_color ** 2) / (area[:, None] - 1)
+        self.mean_color = mean_color.astype(np.float32)
+        self.std_color = std_color.astype(np.float32)
 
-        for i in range(self.height):
-            for j in range(self.width):
-                index = int(self.palette[i, j]) - 1
-                if index != -1: # 0 (no segment), but -1
-                    self.left[index] = min(self.left[index], j)
-                    self.top[index] = min(self.top[index], i)
-                    self.right[index] = max(self.right[index], j)
-                    self.bottom[index] = max(self.bottom[index], i)
-                    self.area[index] += 1
-                    color = self.image[i, j, :]     # welford's algorithm
-                    delta = color - self.mean_color[index]
-                    self.mean_color[index] += delta / self.area[index]
-                    self.std_color[index] += delta * (color - self.mean_color[index])
-
-        for i in range(self.num_segs):
-            self.std_color[i] /= (self.area[i] - 1)
-            if self.left[i] == float('inf'):    # invalid segment (deleted during edition)
-                self.left[i] = 0
-                self.top[i] = 0
-                self.right[i] = 10
-                self.bottom[i] = 10
-                self.valid[i] = 0
-
-        self.left = np.array(self.left).astype(np.int32)
-        self.top = np.array(self.top).astype(np.int32)
-        self.right = np.array(self.right).astype(np.int32)
-        self.bottom = np.array(self.bottom).astype(np.int32)
+        # bbox from object slices. invalid segments (deleted during edition) get a dummy bbox
+        self.valid = (area > 0).astype(np.int32).tolist()
+        self.area = area.tolist()
+        self.left = np.zeros(self.num_segs, dtype=np.int32)
+        self.top = np.zeros(self.num_segs, dtype=np.int32)
+        self.right = np.full(self.num_segs, 10, dtype=np.int32)
+        self.bottom = np.full(self.num_segs, 10, dtype=np.int32)
+        for i, obj in enumerate(ndimage.find_objects(self.palette, max_label=self.num_segs)):
+            if obj is not None:
+                self.top[i], self.bottom[i] = obj[0].start, obj[0].stop - 1
+                self.left[i], self.right[i] = obj[1].start, obj[1].stop - 1
 
         self.bbox_left = self.left
         self.bbox_top = self.top
         self.bbox_right = self.right
         self.bbox_bottom = self.bottom
 
-        for i in range(self.num_segs):
-            self.block_count[i] = create_block_mask_in_global(self.bbox_top[i], self.bbox_bottom[i], self.bbox_left[i], self.bbox_right[i], self.palette, i + 1, self.seg_ratio)
+        self.block_count = count_blocks_in_global(self.bbox_top, self.bbox_bottom, self.bbox_left, self.bbox_right, self.palette, self.seg_ratio).tolist()
+
+    def refresh(self, changes: Dict[int, Tuple[int, int, int, int]]):
+        '''
+        recompute the statistics of the segments edited in place on self.palette, as PaletteState.changes_since
+        reports them: {segment index on palette: [top, left, bottom, right) box of the edited pixels}.
+        the segment is searched in its previous bbox plus the edited box, so the cost follows the edits.
+        segments are never dropped: trailing segments deleted by the edits stay as invalid entries.
+        '''
+        changes = dict(changes)
+        num_segs = max([self.num_segs] + list(changes.keys()))
+        for index in range(self.num_segs + 1, num_segs + 1):
+            changes.setdefault(index, (0, 0, 0, 0))
+        if num_segs > self.num_segs:
+            grow = num_segs - self.num_segs
+            for name, fill in (("left", 0), ("top", 0), ("right", 10), ("bottom", 10)):
+                setattr(self, name, np.concatenate([getattr(self, name), np.full(grow, fill, dtype=np.int32)]))
+            self.bbox_left, self.bbox_top, self.bbox_right, self.bbox_bottom = self.left, self.top, self.right, self.bottom
+            self.mean_color = np.concatenate([self.mean_color, np.zeros((grow, 3), dtype=np.float32)])
+            self.std_color = np.concatenate([self.std_color, np.zeros((grow, 3), dtype=np.float32)])
+            self.area += [0] * grow
+            self.valid += [0] * grow
+            self.block_count += [0] * grow
+            self.num_segs = num_segs
+
+        for index, box in changes.items():
+            i = index - 1
+            top, left, bottom, right = box
+            if self.valid[i]:
+                top, left = min(top, self.top[i]), min(left, self.left[i])
+                bottom, right = max(bottom, self.bottom[i] + 1), max(right, self.right[i] + 1)
+            rows, cols = np.nonzero(self.palette[top:bottom, left:right] == index)
+            rows += top
+            cols += left
+
+            area = len(rows)
+            self.area[i] = area
+            self.valid[i] = int(area > 0)
+            if area > 0:
+                self.top[i], self.bottom[i] = rows.min(), rows.max()
+                self.left[i], self.right[i] = cols.min(), cols.max()
+                pixels = self.image[rows, cols].astype(np.float64)
+                mean = pixels.mean(axis=0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    self.std_color[i] = ((pixels - mean) ** 2).sum(axis=0) / (area - 1)
+                self.mean_color[i] = mean
+            else:
+                self.top[i], self.left[i], self.bottom[i], self.right[i] = 0, 0, 10, 10
+                self.mean_color[i] = 0
+                self.std_color[i] = -0.0
+            self.block_count[i] = int(count_segment_blocks(rows, cols, self.top[i], self.bottom[i], self.left[i], self.right[i], self.palette.shape, self.seg_ratio))
+
+    def segment_key(self, index) -> str:
+        '''
+        hash of the pixels of segment index (0-based): its bbox and its mask inside the bbox.
+        together with the image this determines the crop fed to the extractor.
+        '''
+        top, bottom = int(self.bbox_top[index]), int(self.bbox_bottom[index])
+        left, right = int(self.bbox_left[index]), int(self.bbox_right[index])
+        mask = self.palette[top:bottom + 1, left:right + 1] == index + 1
+        h = hashlib.sha1(np.array([top, left, bottom, right], dtype=np.int64).tobytes())
+        h.update(np.packbits(mask, axis=1).tobytes())
+        return h.hexdigest()
 
     def _visualization(self):
         vis_image = self.image.copy()
@@ -88,14 +159,13 @@ class FeatureExtractionDataset(Dataset):
         cv2.imwrite('visualization.png', vis_image)
 
     def __getitem__(self, index):
-        bbox = self.image[int(self.bbox_top[index]):int(self.bbox_bottom[index]) + 1, int(self.bbox_left[index]):int(self.bbox_right[index]) + 1, :]
+        bbox = self.image[int(self.bbox_top[index]):int(self.bbox_bottom[index]) + 1, int(self.bbox_left[index]):int(self.bbox_right[index]) + 1, :].copy()
         cutted_palette = self.palette[int(self.bbox_top[index]):int(self.bbox_bottom[index]) + 1, int(self.bbox_left[index]):int(self.bbox_right[index]) + 1]
-        mask = (cutted_palette != index + 1).astype(np.bool)
-        bbox[mask] = np.array([0, 0, 0], dtype=np.uint8)
-        block_mask = create_block_mask_in_bbox(self.bbox_top[index], self.bbox_bottom[index], self.bbox_left[index], self.bbox_right[index], self.palette, index + 1, self.n_patch)
+        mask = cutted_palette == index + 1
+        bbox[~mask] = np.array([0, 0, 0], dtype=np.uint8)
         return {
             "data": bbox,
-            "block_mask": np.array(block_mask, dtype=np.int32),
+            "block_mask": block_area_in_bbox(mask, self.n_patch) > 0,     # [n_patch * n_patch], patches covered by the segment
         }
 
     def __len__(self):
@@ -105,13 +175,118 @@ class FeatureExtractionDataset(Dataset):
     def collate_fn(batch):
         return {
             "data": [sample["data"] for sample in batch],
-            "block_mask": [sample["block_mask"] for sample in batch],
+            "block_mask": torch.from_numpy(np.stack([sample["block_mask"] for sample in batch], axis=0)),
         }
 
+class CropPipeline:
+    '''
+    producer/consumer pipeline feeding segment crops of a FeatureExtractionDataset to the extractor.
+    worker threads crop, mask and resize the samples (cv2 releases the GIL) straight into preallocated
+    [batch_size, size, size, 3] uint8 buffers, pinned when the model runs on cuda. a producer thread keeps up
+    to prefetch batches ready, so the next batch is prepared while the model runs on the current one.
+    iterating yields (pixel_values [B, 3, size, size] normalized on device, block_mask [B, P], dataset indices).
+    '''
+    def __init__(self, dataset: FeatureExtractionDataset, indices, batch_size: int, image_mean, image_std, device,
+                 size: int = 224, num_workers: int = 4, prefetch: int = 2):
+        self.dataset = dataset
+        self.indices = list(indices)
+        self.batch_size = batch_size
+        self.size = size
+        self.device = torch.device(device)
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.mean = torch.tensor(image_mean, dtype=torch.float32, device=self.device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(image_std, dtype=torch.float32, device=self.device).view(1, 3, 1, 1) * 255
+        self.wait_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.batches = 0
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def _prepare(self, index, out: np.ndarray) -> np.ndarray:
+        sample = self.dataset[index]
+        cv2.resize(sample["data"], (self.size, self.size), dst=out, interpolation=cv2.INTER_CUBIC)
+        return sample["block_mask"]
+
+    def _produce(self, free: queue.Queue, ready: queue.Queue, stop: threading.Event):
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                for start in range(0, len(self.indices), self.batch_size):
+                    chunk = self.indices[start:start + self.batch_size]
+                    buffer = free.get()
+                    if stop.is_set():
+                        return
+                    views = buffer.numpy()
+                    block_masks = list(pool.map(self._prepare, chunk, [views[slot] for slot in range(len(chunk))]))
+                    ready.put((buffer, np.stack(block_masks, axis=0), chunk))
+        except Exception as e:
+            ready.put(e)
+            return
+        ready.put(None)
+
+    def __iter__(self):
+        pin = self.device.type == "cuda"
+        free = queue.Queue()
+        for _ in range(self.prefetch + 1):
+            buffer = torch.empty((self.batch_size, self.size, self.size, 3), dtype=torch.uint8)
+            free.put(buffer.pin_memory() if pin else buffer)
+        ready = queue.Queue()
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(free, ready, stop), daemon=True)
+
+        start_time = time.time()
+        producer.start()
+        try:
+            while True:
+                wait_start = time.time()
+                item = ready.get()
+                self.wait_seconds += time.time() - wait_start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                buffer, block_mask, chunk = item
+                pixels = buffer[:len(chunk)].to(self.device, non_blocking=pin)
+                pixel_values = (pixels.permute(0, 3, 1, 2).float() - self.mean) / self.std
+                if pin:
+                    torch.cuda.current_stream().synchronize()   # the copy must finish before the buffer is reused
+                free.put(buffer)
+                self.batches += 1
+                yield pixel_values, torch.from_numpy(block_mask), chunk
+        finally:
+            stop.set()
+            free.put(None)      # unblock the producer if it waits for a buffer
+            self.wall_seconds += time.time() - start_time
+
+    def stats(self) -> dict:
+        '''
+        occupancy: share of the wall time the consumer (the model) was not waiting for crops
+        '''
+        occupancy = 1.0 - self.wait_seconds / self.wall_seconds if self.wall_seconds > 0 else 0.0
+        return {
+            "batches": self.batches,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "wait_seconds": round(self.wait_seconds, 3),
+            "occupancy": round(occupancy, 3),
+        }
+
+def pool_patch_tokens(last_hidden_state: torch.Tensor, block_mask: torch.Tensor) -> torch.Tensor:
+    '''
+    masked mean of the patch tokens covered by each segment, for a whole batch at once.
+    last_hidden_state: [B, 1 + n_patch * n_patch, D] (CLS token first), block_mask: [B, n_patch * n_patch].
+    segments covering no patch get a zero vector.
+    '''
+    patch_states = last_hidden_state[:, 1:].float()
+    weights = block_mask.to(device=patch_states.device, dtype=patch_states.dtype)
+    # in fp32 even under autocast, the pooled features are cached and handed to numpy
+    with torch.autocast(patch_states.device.type, enabled=False):
+        pooled = torch.bmm(weights.unsqueeze(1), patch_states).squeeze(1)
+    return pooled / weights.sum(dim=1, keepdim=True).clamp(min=1)
+
 # %%
 if __name__ == '__main__':
     import pickle
-    import cv2
     import matplotlib.pyplot as plt
     # np.set_printoptions(threshold=10000)
     image = pickle.load(open("image.pkl", "rb"))
@@ -0,0 +1,189 @@
+import contextlib
+import logging
+import os
+from typing import Optional
+
+import torch
+
+QUANTIZATIONS = ("none", "int8", "bf16")
+
+class InferenceProfile:
+    '''
+    where and in which precision the models run.
+    - device:   cuda when available, or forced with TREEDECT_DEVICE=cpu|cuda
+    - quantize: none, int8 or bf16 (TREEDECT_QUANTIZE, cpu only)
+        int8: dynamic int8 quantization of the Linear layers of the SAM2 mask decoder and of DINOv2,
+              activations stay fp32. the SAM2 image encoder is left in fp32
+        bf16: bf16 autocast, if the cpu supports it (AVX512-BF16 / AMX), fp32 otherwise
+    - threads:  intra-op and inter-op thread pools (TREEDECT_THREADS, TREEDECT_INTEROP_THREADS), torch defaults if unset
+    on cuda the models always run under bf16 autocast, as before.
+    '''
+    def __init__(self, device: str = "auto", quantize: str = "none", threads: Optional[int] = None, interop_threads: Optional[int] = None):
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if quantize not in QUANTIZATIONS:
+            raise ValueError(f"unknown quantization: {quantize}")
+        self.device = torch.device(device)
+        self.quantize = quantize if self.device.type == "cpu" else "none"
+        if self.quantize == "bf16" and not cpu_supports_bf16():
+            logging.warning("bf16 is not supported by this cpu, running in fp32")
+            self.quantize = "none"
+        self.threads = threads
+        self.interop_threads = interop_threads
+
+    @classmethod
+    def from_env(cls) -> "InferenceProfile":
+        threads = os.environ.get("TREEDECT_THREADS")
+        interop_threads = os.environ.get("TREEDECT_INTEROP_THREADS")
+        return cls(
+            device=os.environ.get("TREEDECT_DEVICE", "auto"),
+            quantize=os.environ.get("TREEDECT_QUANTIZE", "none"),
+            threads=int(threads) if threads else None,
+            interop_threads=int(interop_threads) if interop_threads else None,
+        )
+
+    def configure_threads(self):
+        '''
+        must run before the first parallel torch operation, set_num_interop_threads fails afterwards
+        '''
+        if self.threads is not None:
+            torch.set_num_threads(self.threads)
+        if self.interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError as e:
+                logging.warning(f"cannot set inter-op threads: {e}")
+
+    def autocast(self):
+        if self.device.type == "cuda":
+            return torch.autocast("cuda", dtype=torch.bfloat16)
+        if self.quantize == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def prepare_predictor(self, predictor):
+        predictor.model.to(self.device)
+        if self.quantize == "int8":
+            quantize_linear(predictor.model.sam_mask_decoder)
+
+    def prepare_extractor(self, extractor):
+        extractor.to(self.device)
+        if self.quantize == "int8":
+            quantize_linear(extractor)
+
+    @property
+    def precision(self) -> str:
+        '''
+        the dtype autocast runs the models in
+        '''
+        return "bf16" if self.device.type == "cuda" or self.quantize == "bf16" else "fp32"
+
+    def variant(self) -> str:
+        '''
+        the settings model outputs depend on, e.g. "cuda-bf16-none", part of the embedding cache keys
+        '''
+        return f"{self.device.type}-{self.precision}-{self.quantize}"
+
+    def describe(self) -> dict:
+        return {
+            "device": str(self.device),
+            "quantize": self.quantize,
+            "threads": torch.get_num_threads(),
+            "interop_threads": torch.get_num_interop_threads(),
+        }
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def quantize_linear(module: torch.nn.Module) -> torch.nn.Module:
+    '''
+    dynamic int8 quantization of the Linear layers of module, in place
+    '''
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+# the profile of this process, shared by api, session and batch
+profile = InferenceProfile.from_env()
+
+def autocast():
+    return profile.autocast()
+
+if __name__ == '__main__':
+    # accuracy and speed of the cpu precisions against fp32, on one image:
+    # mask IoU of the SAM2 decoder outputs for a grid of point prompts, and cosine similarity of pooled DINOv2 features
+    # python inference.py <image> [sam2 model] [dinov2 model]
+    import copy
+    import sys
+    import time
+
+    import cv2
+    import numpy as np
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+    from transformers import AutoModel
+
+    from prompt import decode_point_batch
+    from utils import generation_sample_grid
+
+    image_path = sys.argv[1]
+    sam2_name = sys.argv[2] if len(sys.argv) > 2 else "facebook/sam2-hiera-small"
+    dinov2_name = sys.argv[3] if len(sys.argv) > 3 else "facebook/dinov2-small"
+    profile = InferenceProfile("cpu", "none", profile.threads, profile.interop_threads)
+    profile.configure_threads()
+    print(profile.describe())
+
+    image = cv2.cvtColor(cv2.imread(image_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    height, width = image.shape[:2]
+    predictor = SAM2ImagePredictor.from_pretrained(sam2_name, local_files_only=True, device="cpu")
+    with torch.inference_mode():
+        start = time.time()
+        predictor.set_image(image)
+        print(f"sam2 image encoder (fp32): {time.time() - start:.2f} s")
+    points = generation_sample_grid(height, width, max(width // 16, 1), max(height // 16, 1)).reshape(-1, 2)[:256]
+
+    extractor = AutoModel.from_pretrained(dinov2_name, local_files_only=True).eval()
+    crops = torch.from_numpy(np.stack([
+        cv2.resize(image[y:y + height // 4, x:x + width // 4], (224, 224)) for y in range(0, height - height // 4 + 1, height // 4) for x in range(0, width - width // 4 + 1, width // 4)
+    ])).permute(0, 3, 1, 2).float().div(255)
+
+    def run(precision):
+        decoder = predictor.model.sam_mask_decoder
+        dino = extractor
+        context = contextlib.nullcontext()
+        if precision == "int8":
+            predictor.model.sam_mask_decoder = quantize_linear(copy.deepcopy(decoder))
+            dino = quantize_linear(copy.deepcopy(extractor))
+        elif precision == "bf16":
+            context = torch.autocast("cpu", dtype=torch.bfloat16)
+        try:
+            with torch.inference_mode(), context:
+                start = time.time()
+                masks = []
+                for i in range(0, len(points), 16):
+                    for box, crop in decode_point_batch(predictor, points[i:i + 16]):
+                        mask = np.zeros((height, width), dtype=bool)
+                        mask[box[0]:box[2], box[1]:box[3]] = crop
+                        masks.append(mask)
+                decode_time = time.time() - start
+                start = time.time()
+                features = dino(pixel_values=crops).last_hidden_state.mean(1).float()
+                extract_time = time.time() - start
+        finally:
+            predictor.model.sam_mask_decoder = decoder
+        return masks, features, decode_time, extract_time
+
+    baseline_masks, baseline_features, baseline_decode, baseline_extract = run("none")
+    print(f"{'precision':>9} | {'decoder s':>9} | {'speedup':>7} | {'mask IoU mean':>13} | {'min':>5} | {'dinov2 s':>8} | {'speedup':>7} | {'cos mean':>8} | {'min':>5}")
+    for precision in ("none", "int8", "bf16"):
+        if precision == "bf16" and not cpu_supports_bf16():
+            print(f"{precision:>9} | not supported by this cpu")
+            continue
+        masks, features, decode_time, extract_time = run(precision)
+        ious = [(a & b).sum() / max((a | b).sum(), 1) for a, b in zip(masks, baseline_masks)]
+        cosine = torch.nn.functional.cosine_similarity(features, baseline_features, dim=-1)
+        print(
+            f"{precision:>9} | {decode_time:9.2f} | {baseline_decode / decode_time:7.2f} | {np.mean(ious):13.4f} | {np.min(ious):5.3f} | "
+            f"{extract_time:8.2f} | {baseline_extract / extract_time:7.2f} | {cosine.mean():8.4f} | {cosine.min():5.3f}"
+        )
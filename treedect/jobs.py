@@ -0,0 +1,143 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+class JobCancelled(Exception):
+    pass
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    '''
+    a unit of work run by JobManager. the work function receives job.report as its progress callback;
+    every report is appended to events (streamed to clients) and is also where cancellation takes effect.
+    '''
+    def __init__(self, kind: str):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"      # queued -> running -> done | failed | cancelled
+        self.result = None
+        self.error = None
+        self.events = []
+        self.created = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+        self._cond = threading.Condition()
+
+    def report(self, stage: str, done: Optional[int] = None, total: Optional[int] = None, **partial):
+        if self._cancel.is_set():
+            raise JobCancelled()
+        event = {"stage": stage}
+        if done is not None:
+            event["done"] = done
+            event["total"] = total
+        event.update(partial)
+        self._emit(event)
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def wait_events(self, start: int, timeout: float = 1.0):
+        '''
+        block until there are events after index start, the job is finished, or timeout expires
+        '''
+        with self._cond:
+            if len(self.events) <= start and not self.is_finished:
+                self._cond.wait(timeout)
+            return self.events[start:]
+
+    def summary(self, with_result: bool = False) -> dict:
+        summary = {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.events[-1] if self.events else None,
+            "error": self.error,
+        }
+        if with_result and self.status == "done":
+            summary["result"] = self.result
+        return summary
+
+    def _emit(self, event: dict):
+        with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+
+    def _finish(self, status: str, result=None, error: Optional[str] = None):
+        with self._cond:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            self.events.append({"stage": status})
+            self._cond.notify_all()
+
+class JobManager:
+    '''
+    runs jobs on a worker pool off the event loop. at most max_pending jobs may be queued or running,
+    further submissions raise JobQueueFull. finished jobs are kept for max_history submissions.
+    '''
+    def __init__(self, max_workers: int = 1, max_pending: int = 8, max_history: int = 64):
+        self.max_pending = max_pending
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="treedect-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, fn: Callable, *args) -> Job:
+        '''
+        fn(*args, progress=job.report) is run on the pool; its return value becomes the job result
+        '''
+        job = Job(kind)
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if not j.is_finished)
+            if pending >= self.max_pending:
+                raise JobQueueFull()
+            self._jobs[job.job_id] = job
+            self._prune()
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self._lock:
+            return self._jobs[job_id]
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        job.cancel()
+        if job.status == "queued":
+            job._finish("cancelled")
+        return job
+
+    def _run(self, job: Job, fn: Callable, args: tuple):
+        if job.is_finished:     # cancelled while queued
+            return
+        job.status = "running"
+        job._emit({"stage": "running"})
+        try:
+            result = fn(*args, progress=job.report)
+        except JobCancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            traceback.print_exc()
+            job._finish("failed", error=str(e))
+        else:
+            job._finish("done", result=result)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[job_id]
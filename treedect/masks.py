@@ -0,0 +1,177 @@
+import numpy as np
+from scipy import sparse
+from typing import Iterable, Optional, Tuple
+
+class MaskStore:
+    '''
+    append-only container for the binary masks of one image.
+    every mask is kept as its tight bounding box plus the box content bit-packed along rows (np.packbits),
+    so memory follows the size of the mask instead of the size of the image.
+    boxes are [top, left, bottom, right) with exclusive ends; an empty mask has an empty box at (0, 0).
+    boxes and areas live in arrays grown by doubling, so reading them does not copy.
+    '''
+    def __init__(self, height: int, width: int, capacity: int = 64):
+        self.height = height
+        self.width = width
+        self._boxes = np.zeros((capacity, 4), dtype=np.int64)
+        self._areas = np.zeros(capacity, dtype=np.int64)
+        self._payloads = []
+
+    @classmethod
+    def from_masks(cls, masks: Iterable, height: int, width: int) -> "MaskStore":
+        '''
+        build a store from full-frame masks, either dense boolean arrays or scipy sparse matrices.
+        '''
+        store = cls(height, width)
+        for mask in masks:
+            if sparse.issparse(mask):
+                store.append_sparse(mask)
+            else:
+                store.append(mask)
+        return store
+
+    def append(self, mask: np.ndarray):
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            self.append_cropped((0, 0, 0, 0), np.zeros((0, 0), dtype=bool))
+            return
+        cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+        top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        self.append_cropped((top, left, bottom, right), mask[top:bottom, left:right])
+
+    def append_sparse(self, mask: sparse.spmatrix):
+        mask = sparse.coo_matrix(mask)
+        if mask.nnz == 0:
+            self.append_cropped((0, 0, 0, 0), np.zeros((0, 0), dtype=bool))
+            return
+        top, bottom = mask.row.min(), mask.row.max() + 1
+        left, right = mask.col.min(), mask.col.max() + 1
+        crop = np.zeros((bottom - top, right - left), dtype=bool)
+        crop[mask.row - top, mask.col - left] = mask.data.astype(bool)
+        self.append_cropped((top, left, bottom, right), crop)
+
+    def append_cropped(self, box: Tuple[int, int, int, int], crop: np.ndarray):
+        '''
+        append a mask that is already cropped to box. the box does not need to be tight.
+        '''
+        crop = crop.astype(bool, copy=False)
+        self.append_packed(box, np.packbits(crop, axis=1), int(np.count_nonzero(crop)))
+
+    def append_packed(self, box: Tuple[int, int, int, int], payload: np.ndarray, area: int):
+        '''
+        append a mask already bit-packed as the store keeps it, e.g. received from another process
+        '''
+        index = len(self._payloads)
+        if index == len(self._areas):
+            self._reserve(2 * index)
+        self._boxes[index] = box
+        self._areas[index] = area
+        self._payloads.append(payload)
+
+    def _reserve(self, capacity: int):
+        capacity = max(capacity, 16)
+        boxes = np.zeros((capacity, 4), dtype=np.int64)
+        areas = np.zeros(capacity, dtype=np.int64)
+        boxes[:len(self)] = self._boxes[:len(self)]
+        areas[:len(self)] = self._areas[:len(self)]
+        self._boxes, self._areas = boxes, areas
+
+    def __len__(self):
+        return len(self._payloads)
+
+    @property
+    def boxes(self) -> np.ndarray:
+        '''
+        [N, 4] read-only view, valid until the next append
+        '''
+        boxes = self._boxes[:len(self)]
+        boxes.flags.writeable = False
+        return boxes
+
+    @property
+    def areas(self) -> np.ndarray:
+        areas = self._areas[:len(self)]
+        areas.flags.writeable = False
+        return areas
+
+    @property
+    def nbytes(self) -> int:
+        return sum(payload.nbytes for payload in self._payloads) + 5 * 8 * len(self)
+
+    def crop(self, index: int) -> Tuple[Tuple[int, int, int, int], np.ndarray]:
+        '''
+        returns (box, boolean mask of the box)
+        '''
+        top, left, bottom, right = (int(v) for v in self._boxes[index])
+        crop = np.unpackbits(self._payloads[index], axis=1, count=right - left).astype(bool)
+        return (top, left, bottom, right), crop
+
+    def to_dense(self, index: int) -> np.ndarray:
+        (top, left, bottom, right), crop = self.crop(index)
+        mask = np.zeros((self.height, self.width), dtype=bool)
+        mask[top:bottom, left:right] = crop
+        return mask
+
+    def to_sparse(self, index: int) -> sparse.csr_matrix:
+        (top, left, bottom, right), crop = self.crop(index)
+        rows, cols = np.nonzero(crop)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows + top, cols + left)), shape=(self.height, self.width))
+
+    def subset(self, indices: Iterable[int]) -> "MaskStore":
+        indices = np.asarray(list(indices), dtype=np.int64)
+        store = MaskStore(self.height, self.width, len(indices))
+        store._boxes[:len(indices)] = self._boxes[indices]
+        store._areas[:len(indices)] = self._areas[indices]
+        store._payloads = [self._payloads[i] for i in indices]
+        return store
+
+    def packed(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        flat view for compiled kernels: (boxes [N, 4], concatenated payload bytes, payload offsets [N])
+        '''
+        sizes = [payload.size for payload in self._payloads]
+        offsets = np.cumsum([0] + sizes[:-1]).astype(np.int64)
+        payload = np.concatenate([p.ravel() for p in self._payloads]) if len(self) > 0 else np.zeros(0, dtype=np.uint8)
+        return self._boxes[:len(self)], payload, offsets
+
+    # ------------------------------------------------------------
+    # set operations
+    # ------------------------------------------------------------
+    def box_intersects(self, index: int) -> np.ndarray:
+        '''
+        boolean array over all masks whose box intersects the box of mask index
+        '''
+        boxes = self.boxes
+        top, left, bottom, right = boxes[index]
+        return (boxes[:, 0] < bottom) & (boxes[:, 2] > top) & (boxes[:, 1] < right) & (boxes[:, 3] > left)
+
+    def intersection_area(self, i: int, j: int) -> int:
+        return int(self.intersection_areas(i, [j])[0])
+
+    def union_area(self, i: int, j: int) -> int:
+        return int(self._areas[i] + self._areas[j]) - self.intersection_area(i, j)
+
+    def intersection_areas(self, index: int, others: Optional[Iterable[int]] = None) -> np.ndarray:
+        '''
+        intersection area of mask index with every mask in the store, or with the masks others only.
+        mask index is unpacked once; of the other masks only the rows inside its box are unpacked, and only
+        for masks whose box intersects it.
+        '''
+        boxes = self.boxes
+        others = np.arange(len(self)) if others is None else np.asarray(list(others), dtype=np.int64)
+        result = np.zeros(len(others), dtype=np.int64)
+        (top, left, bottom, right), crop = self.crop(index)
+        candidates = boxes[others]
+        hits = np.flatnonzero(
+            (candidates[:, 0] < bottom) & (candidates[:, 2] > top) & (candidates[:, 1] < right) & (candidates[:, 3] > left)
+        )
+        # the overlap of every candidate box with the box of index
+        overlap_top = np.maximum(candidates[hits, 0], top)
+        overlap_bottom = np.minimum(candidates[hits, 2], bottom)
+        overlap_left = np.maximum(candidates[hits, 1], left)
+        overlap_right = np.minimum(candidates[hits, 3], right)
+        for k, j, t, b, l, r in zip(hits, others[hits], overlap_top, overlap_bottom, overlap_left, overlap_right):
+            tj, lj, _, rj = candidates[k]
+            rows = np.unpackbits(self._payloads[j][t - tj:b - tj], axis=1, count=rj - lj)[:, l - lj:r - lj]
+            result[k] = np.count_nonzero(rows.view(bool) & crop[t - top:b - top, l - left:r - left])
+        return result
@@ -0,0 +1,330 @@
+import contextvars
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+import torch
+
+# upper bounds of the histogram buckets, seconds and bytes
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(12))     # 1 KB .. 4 GB
+
+METRICS = {
+    # name: (type, help)
+    "treedect_request_seconds": ("histogram", "wall time of a request"),
+    "treedect_stage_seconds": ("histogram", "wall time of a pipeline stage within a request"),
+    "treedect_decoder_calls_total": ("counter", "SAM2 mask decoder calls"),
+    "treedect_request_bytes": ("histogram", "request body size"),
+    "treedect_response_bytes": ("histogram", "response body size"),
+    "treedect_payload_bytes": ("histogram", "size of an encoded payload within a response"),
+    "treedect_request_rss_growth_bytes": ("histogram", "highest resident memory sampled during a request, above the resident memory at its start"),
+    "treedect_request_cuda_peak_bytes": ("histogram", "peak cuda memory allocated during a request"),
+    "treedect_peak_rss_bytes": ("gauge", "peak resident memory of the process"),
+    "treedect_rss_bytes": ("gauge", "resident memory of the process"),
+    "treedect_ready": ("gauge", "1 once the models are loaded"),
+    "treedect_sessions": ("gauge", "open image sessions"),
+    "treedect_session_bytes": ("gauge", "memory held by the image sessions"),
+    "treedect_feature_cache_bytes": ("gauge", "memory held by the feature cache"),
+}
+
+logger = logging.getLogger("treedect.requests")
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    '''
+    process-wide metrics in the Prometheus text format, without the prometheus_client dependency.
+    series are keyed by metric name and a sorted tuple of label pairs.
+    '''
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, labels: Dict[str, str], value: float, buckets: Tuple[float, ...] = SECONDS_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, labels: Dict[str, str], value: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, labels: Dict[str, str], value: float):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            series = sorted(
+                [(key, "histogram", value) for key, value in self._histograms.items()]
+                + [(key, "counter", value) for key, value in self._counters.items()]
+                + [(key, "gauge", value) for key, value in self._gauges.items()],
+                key=lambda item: item[0],
+            )
+            described = set()
+            for (name, labels), kind, value in series:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {METRICS.get(name, (kind, name))[1]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(value.sum)}")
+                lines.append(f"{name}_count{_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def peak_rss_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024     # KB on linux
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+class _RssSampler:
+    '''
+    samples the resident memory every interval seconds while traces are open, and raises their rss peaks.
+    ru_maxrss cannot serve per request: it is the high-water mark of the whole process lifetime, which
+    a request only moves once it exceeds every earlier one. the thread exits when the last trace closes
+    '''
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self._traces = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, trace: "Trace"):
+        with self._lock:
+            self._traces.add(trace)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="treedect-rss-sampler", daemon=True)
+                self._thread.start()
+
+    def remove(self, trace: "Trace"):
+        with self._lock:
+            self._traces.discard(trace)
+
+    def _run(self):
+        while True:
+            rss = rss_bytes()
+            with self._lock:
+                if not self._traces or rss is None:
+                    self._thread = None
+                    return
+                for trace in self._traces:
+                    trace._rss_peak = max(trace._rss_peak, rss)
+            time.sleep(self.interval)
+
+class Trace:
+    '''
+    timings and sizes of one request: wall time per stage (summed over repeats), counts such as decoder calls,
+    encoded payload sizes and memory. stages that overlap, e.g. run on the same request from two threads,
+    are each counted in full.
+    memory is process-wide: the rss growth (sampled, see _RssSampler) and the cuda peak (reset when the trace
+    starts) of concurrent requests both cover all of them.
+    '''
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.stages = {}
+        self.counts = {}
+        self.payloads = {}
+        self.memory = {}
+        self.seconds = None
+        self._start = time.perf_counter()
+        self._rss_start = rss_bytes()
+        self._rss_peak = self._rss_start or 0
+        if self._rss_start is not None:
+            _rss_sampler.add(self)
+        self._cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def payload(self, name: str, nbytes: int):
+        with self._lock:
+            self.payloads[name] = self.payloads.get(name, 0) + nbytes
+
+    def finish(self, status: str, endpoint: Optional[str] = None) -> dict:
+        '''
+        record the trace in registry and log it. endpoint replaces the one given at start, for requests
+        whose route is only known after routing
+        '''
+        self.seconds = time.perf_counter() - self._start
+        if endpoint is not None:
+            self.endpoint = endpoint
+        if self._rss_start is not None:
+            _rss_sampler.remove(self)
+            rss = rss_bytes()
+            if rss is not None:
+                self._rss_peak = max(self._rss_peak, rss)
+            self.memory["rss_peak_bytes"] = self._rss_peak
+            self.memory["rss_growth_bytes"] = self._rss_peak - self._rss_start
+        if self._cuda:
+            self.memory["cuda_peak_bytes"] = torch.cuda.max_memory_allocated()
+
+        labels = {"endpoint": self.endpoint}
+        registry.observe("treedect_request_seconds", {**labels, "status": status}, self.seconds)
+        for name, seconds in self.stages.items():
+            registry.observe("treedect_stage_seconds", {**labels, "stage": name}, seconds)
+        if "decoder_calls" in self.counts:
+            registry.inc("treedect_decoder_calls_total", labels, self.counts["decoder_calls"])
+        for name, nbytes in self.payloads.items():
+            target = {"request": "treedect_request_bytes", "response": "treedect_response_bytes"}.get(name)
+            if target is not None:
+                registry.observe(target, labels, nbytes, BYTES_BUCKETS)
+            else:
+                registry.observe("treedect_payload_bytes", {**labels, "payload": name}, nbytes, BYTES_BUCKETS)
+        if "rss_growth_bytes" in self.memory:
+            registry.observe("treedect_request_rss_growth_bytes", labels, self.memory["rss_growth_bytes"], BYTES_BUCKETS)
+        if self._cuda:
+            registry.observe("treedect_request_cuda_peak_bytes", labels, self.memory["cuda_peak_bytes"], BYTES_BUCKETS)
+
+        summary = self.summary()
+        summary["status"] = status
+        logger.info(json.dumps(summary))
+        return summary
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "endpoint": self.endpoint,
+                "seconds": round(self.seconds if self.seconds is not None else time.perf_counter() - self._start, 4),
+                "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                "counts": dict(self.counts),
+                "payloads": dict(self.payloads),
+                "memory": dict(self.memory),
+            }
+
+    def server_timing(self) -> str:
+        '''
+        the trace as a Server-Timing header value, durations in milliseconds
+        '''
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={(self.seconds or 0.0) * 1000:.1f}")
+        return ", ".join(entries)
+
+registry = Registry()
+_rss_sampler = _RssSampler()
+_current = contextvars.ContextVar("treedect_trace", default=None)
+
+@contextmanager
+def tracing(endpoint: str):
+    '''
+    a new trace as the current one of this context, for the duration of the block. threads started with a copy
+    of the context (asyncio.to_thread, the fastapi threadpool) record into it as well. the caller finishes it
+    '''
+    trace = Trace(endpoint)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+@contextmanager
+def stage(name: str):
+    '''
+    time the block as a stage of the current trace. a no-op outside of a traced request (batch mode, workers)
+    '''
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, time.perf_counter() - start)
+
+def add_stage(name: str, seconds: float):
+    '''
+    a stage timed elsewhere, e.g. waiting times accumulated by a pipeline
+    '''
+    trace = _current.get()
+    if trace is not None:
+        trace.add_stage(name, seconds)
+
+def count(name: str, value: int = 1):
+    trace = _current.get()
+    if trace is not None:
+        trace.count(name, value)
+
+def payload(name: str, nbytes: int):
+    trace = _current.get()
+    if trace is not None:
+        trace.payload(name, nbytes)
+
+def traced_call(endpoint: str, fn, *args, **kwargs):
+    '''
+    fn(*args, **kwargs) under its own trace, for work run outside of a request such as background jobs
+    '''
+    with tracing(endpoint) as trace:
+        status = "error"
+        try:
+            result = fn(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            trace.finish(status)
+
+def render() -> str:
+    peak_rss = peak_rss_bytes()
+    registry.set("treedect_peak_rss_bytes", {}, peak_rss)
+    rss = rss_bytes()
+    if rss is not None:
+        registry.set("treedect_rss_bytes", {}, rss)
+    return registry.render()
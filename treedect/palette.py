@@ -0,0 +1,191 @@
+import base64
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+Box = Tuple[int, int, int, int]     # [top, left, bottom, right), exclusive ends
+
+PALETTE_OPS = ("add", "paint", "erase", "delete", "merge")
+# fields every edit of an op needs, besides its region (box and bits, or a brush x and y) for add, paint and erase
+REQUIRED_FIELDS = {"add": (), "paint": ("index",), "erase": ("index",), "delete": ("index",), "merge": ("index", "indexes")}
+
+def union_box(a: Optional[Box], b: Optional[Box]) -> Optional[Box]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def pixel_box(rows: np.ndarray, cols: np.ndarray) -> Optional[Box]:
+    if len(rows) == 0:
+        return None
+    return (int(rows.min()), int(cols.min()), int(rows.max()) + 1, int(cols.max()) + 1)
+
+class PaletteConflict(Exception):
+    '''
+    the palette was replaced or edited while a result computed from it was pending
+    '''
+
+class PaletteState:
+    '''
+    the authoritative palette of a session and its edit history.
+    every applied patch bumps version and records, for each touched segment index, a box covering the
+    edited pixels, so downstream stages can recompute only what changed since the version they saw.
+    edits mirror the operations of PaletteImage in Canva.js:
+    - add:    new segment from a region, on free pixels only unless invasive
+    - paint:  grow segment index over the free pixels of a region
+    - erase:  remove the pixels of segment index inside a region
+    - delete: remove segment index entirely
+    - merge:  relabel segments indexes to index
+    a region is either a box plus bit-packed rows (base64 of np.packbits(crop, axis=1), as MaskStore keeps
+    them) or a brush circle (x, y, radius) rasterized like PaletteImage.modify.
+    '''
+    def __init__(self, palette: np.ndarray, max_history: int = 256):
+        self.palette = np.array(palette, dtype=np.int32)
+        self.height, self.width = self.palette.shape
+        self.version = 0
+        self.max_index = int(self.palette.max()) if self.palette.size > 0 else 0
+        self.max_history = max_history
+        self._history = []     # [(version, {segment index: box})]
+
+    def apply(self, edits: List[dict]) -> Tuple[Dict[int, Box], List[int]]:
+        '''
+        apply a patch atomically. returns (touched segments of this patch, indexes created by add edits).
+        raises ValueError for an invalid edit, in which case the palette is left unchanged: the fields of all
+        edits are checked first, and edits that fail later are undone from the pixels saved before each write.
+        '''
+        for edit in edits:
+            self._check_fields(edit)
+        max_index = self.max_index
+        touched = {}
+        added = []
+        undo = []       # [(where, previous values)], the pixels each edit overwrote
+        try:
+            for edit in edits:
+                for index, box in self._apply_one(edit, added, undo).items():
+                    touched[index] = union_box(touched.get(index), box)
+        except Exception as e:
+            for where, values in reversed(undo):
+                self.palette[where] = values
+            self.max_index = max_index
+            if isinstance(e, (ValueError, KeyError, TypeError)):
+                raise ValueError(str(e)) from e
+            raise
+        self.version += 1
+        self._history.append((self.version, touched))
+        del self._history[:-self.max_history]
+        return touched, added
+
+    def changes_since(self, version: int) -> Optional[Dict[int, Box]]:
+        '''
+        touched segments between version and now, None if the history does not reach back that far
+        '''
+        if version == self.version:
+            return {}
+        if version > self.version or len(self._history) == 0 or self._history[0][0] > version + 1:
+            return None
+        changes = {}
+        for v, touched in self._history:
+            if v > version:
+                for index, box in touched.items():
+                    changes[index] = union_box(changes.get(index), box)
+        return changes
+
+    def _check_fields(self, edit: dict):
+        op = edit.get("op")
+        if op not in PALETTE_OPS:
+            raise ValueError(f"unknown palette op: {op}")
+        missing = [field for field in REQUIRED_FIELDS[op] if edit.get(field) is None]
+        if op in ("add", "paint", "erase"):
+            if edit.get("box") is not None:
+                if edit.get("bits") is None:
+                    missing.append("bits")
+            elif edit.get("x") is None or edit.get("y") is None:
+                missing.append("box and bits, or x and y")
+        if missing:
+            raise ValueError(f"{op} edit needs {', '.join(missing)}")
+
+    def _apply_one(self, edit: dict, added: List[int], undo: List[tuple]) -> Dict[int, Box]:
+        op = edit["op"]
+        if op == "delete":
+            return self._relabel([self._check_index(edit["index"])], 0, undo)
+        if op == "merge":
+            target = self._check_index(edit["index"])
+            return self._relabel([self._check_index(i) for i in edit["indexes"] if i != target], target, undo)
+
+        box, crop = self._region(edit)
+        if op == "add":
+            self.max_index += 1
+            index = self.max_index
+            added.append(index)
+            region = self.palette[box[0]:box[2], box[1]:box[3]]
+            write = crop if edit.get("invasive", False) else crop & (region == 0)
+        elif op == "paint":
+            index = self._check_index(edit["index"])
+            region = self.palette[box[0]:box[2], box[1]:box[3]]
+            write = crop & (region == 0)
+        elif op == "erase":
+            index = self._check_index(edit["index"])
+            region = self.palette[box[0]:box[2], box[1]:box[3]]
+            write = crop & (region == index)
+        else:
+            raise ValueError(f"unknown palette op: {op}")
+
+        undo.append((np.s_[box[0]:box[2], box[1]:box[3]], region.copy()))
+        rows, cols = np.nonzero(write)
+        changed = pixel_box(rows + box[0], cols + box[1])
+        touched = {}
+        if op == "add" and edit.get("invasive", False):
+            # pixels taken over from other segments
+            for other in np.unique(region[write]):
+                if other != 0:
+                    touched[int(other)] = changed
+        region[write] = 0 if op == "erase" else index
+        if changed is not None:
+            touched[index] = changed
+        return touched
+
+    def _relabel(self, indexes: List[int], target: int, undo: List[tuple]) -> Dict[int, Box]:
+        touched = {}
+        if len(indexes) == 0:
+            return touched
+        rows, cols = np.nonzero(np.isin(self.palette, indexes))
+        values = self.palette[rows, cols]
+        undo.append(((rows, cols), values))
+        for index in indexes:
+            selected = values == index
+            box = pixel_box(rows[selected], cols[selected])
+            if box is not None:
+                touched[index] = box
+                if target != 0:
+                    touched[target] = union_box(touched.get(target), box)
+        self.palette[rows, cols] = target
+        return touched
+
+    def _check_index(self, index) -> int:
+        index = int(index)
+        if index < 1 or index > self.max_index:
+            raise ValueError(f"segment index out of range: {index}")
+        return index
+
+    def _region(self, edit: dict) -> Tuple[Box, np.ndarray]:
+        if edit.get("box") is not None:
+            top, left, bottom, right = (int(v) for v in edit["box"])
+            if not (0 <= top <= bottom <= self.height and 0 <= left <= right <= self.width):
+                raise ValueError(f"box out of range: {edit['box']}")
+            packed = np.frombuffer(base64.b64decode(edit["bits"]), dtype=np.uint8)
+            row_bytes = (right - left + 7) // 8
+            if packed.size != (bottom - top) * row_bytes:
+                raise ValueError("bits do not match box")
+            crop = np.unpackbits(packed.reshape(bottom - top, row_bytes), axis=1, count=right - left).astype(bool)
+            return (top, left, bottom, right), crop
+
+        # brush circle, same rasterization as PaletteImage.modify
+        x, y = int(edit["x"]), int(edit["y"])
+        radius = int(edit["radius"]) if edit.get("radius") is not None else 5
+        top, bottom = max(0, y - radius), min(self.height, y + radius)
+        left, right = max(0, x - radius), min(self.width, x + radius)
+        crop = np.zeros((max(bottom - top, 0), max(right - left, 0)), dtype=bool)
+        for i in range(top, bottom):
+            tangent = int(round(np.sqrt(radius ** 2 - (y - i) ** 2)))
+            crop[i - top, max(0, x - tangent) - left:min(self.width, x + tangent) - left] = True
+        return (top, left, max(bottom, top), max(right, left)), crop
@@ -0,0 +1,403 @@
+'''
+the segmentation and clustering pipeline behind api.py and batch.py: the models, the session store and the caches.
+importing it loads nothing; the models are loaded by startup (see Startup), which api.py starts with the server
+and any run_* call starts on first use.
+'''
+import base64
+import logging
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+import torch
+from pydantic import BaseModel
+
+import metrics
+from clustering import CLUSTER_BACKENDS, build_features, sweep_k
+from codec import encode_palette
+from decode_pool import DecoderPool
+from embedding_cache import EmbeddingCache
+from feature import CropPipeline, FeatureExtractionDataset, pool_patch_tokens
+from feature_cache import FeatureCache
+from inference import autocast, profile
+from palette import PaletteConflict, PaletteState
+from prompt import MASK_SELECTIONS, decode_point_batch, grid_prompt_order, predict_points, predict_points_adaptive, predict_points_batched
+from session import SessionStore, bind_predictor, predictor_lock
+from spatial import SegmentIndex
+from startup import Startup
+from tiling import predict_tiled
+from utils import filter_and_build_palette, generation_sample_grid, masks_to_palette, warmup_kernels
+
+# ------------------------------------------------------------
+# global states
+# ------------------------------------------------------------
+predictor = None
+preprocessor = None
+extractor = None
+extractor_name = None
+crop_workers = int(os.environ.get("TREEDECT_CROP_WORKERS", min(4, os.cpu_count() or 1)))
+feature_cache = FeatureCache(max_bytes=int(os.environ.get("TREEDECT_FEATURE_CACHE_BYTES", 512 * 1024 ** 2)))
+session_store = SessionStore(max_bytes=int(os.environ.get("TREEDECT_SESSION_BYTES", 4 * 1024 ** 3)))
+embedding_cache = None
+decoder_pool = None
+# a decoding request fails after this long instead of waiting on a stuck decoder worker
+decode_timeout = float(os.environ.get("TREEDECT_DECODE_TIMEOUT", 600))
+tile_memory_bytes = int(os.environ.get("TREEDECT_TILE_MEMORY_BYTES", 2 * 1024 ** 3))
+model_timeout = float(os.environ.get("TREEDECT_MODEL_TIMEOUT", 600))
+
+def load_model(model_name = "facebook/sam2-hiera-small"):
+    global predictor, embedding_cache
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+    predictor = SAM2ImagePredictor.from_pretrained(model_name, local_files_only=True, device=str(profile.device))
+    profile.prepare_predictor(predictor)
+    # on-disk cache of image embeddings. set TREEDECT_EMBEDDING_CACHE to an empty string to disable
+    cache_dir = os.environ.get("TREEDECT_EMBEDDING_CACHE", os.path.expanduser("~/.cache/treedect/sam2_embeddings"))
+    if cache_dir:
+        cache_bytes = int(os.environ.get("TREEDECT_EMBEDDING_CACHE_BYTES", 10 * 1024 ** 3))
+        embedding_cache = EmbeddingCache(cache_dir, model_name, cache_bytes, profile.variant())
+
+def load_feature_extractor(model_name = "facebook/dinov2-small"):
+    global preprocessor, extractor, extractor_name
+    from transformers import AutoImageProcessor, AutoModel
+    extractor_name = model_name
+    preprocessor = AutoImageProcessor.from_pretrained(model_name, local_files_only=True, use_fast=True)
+    extractor = AutoModel.from_pretrained(model_name, local_files_only=True)
+    profile.prepare_extractor(extractor)
+
+def warmup_models():
+    '''
+    one tiny inference through every model and kernel, so the first request does not pay for
+    CUDA kernel selection, numba compilation (or loading it from the numba cache) and lazy imports
+    '''
+    with predictor_lock, torch.inference_mode(), autocast():
+        predictor.set_image(np.zeros((256, 256, 3), dtype=np.uint8))
+        decode_point_batch(predictor, np.array([[128, 128]]), "first")
+        predictor.reset_predictor()
+        extractor(pixel_values=torch.zeros((1, 3, 224, 224), device=extractor.device))
+
+def load_models(startup: Startup):
+    logging.info(f"inference profile: {profile.describe()}")
+    global decoder_pool
+    with startup.timed("load_sam2"):
+        load_model()
+    # TREEDECT_DECODE_WORKERS > 0 shards grid prompting over that many processes, cpu only
+    decode_workers = int(os.environ.get("TREEDECT_DECODE_WORKERS", 0))
+    if decode_workers > 0 and profile.device.type == "cpu":
+        threads = int(os.environ.get("TREEDECT_DECODE_THREADS", max(1, (os.cpu_count() or 1) // decode_workers)))
+        with startup.timed("start_decoder_pool"):
+            decoder_pool = DecoderPool(predictor, decode_workers, threads)
+    with startup.timed("load_dinov2"):
+        load_feature_extractor()
+    if os.environ.get("TREEDECT_WARMUP", "1") != "0":
+        with startup.timed("compile_kernels"):
+            warmup_kernels()
+        with startup.timed("warmup_inference"):
+            warmup_models()
+        with startup.timed("import_clustering"):
+            import sklearn.cluster, sklearn.decomposition, sklearn.metrics
+            try:
+                import umap
+            except ImportError:
+                pass
+
+# TREEDECT_STARTUP: background (default), lazy or eager, see Startup
+startup = Startup(load_models, os.environ.get("TREEDECT_STARTUP", "background"))
+
+# ------------------------------------------------------------
+# segmentation
+# ------------------------------------------------------------
+class SegmentationRequest(BaseModel):
+    session_id: Optional[str] = None
+    row_sample_interval: int
+    col_sample_interval: int
+    overlap_ratio: float
+    batch_size: int = 16            # points per mask decoder call. 1 falls back to one call per point
+    mask_selection: str = "first"   # which multimask output to keep: "first" or "best" (highest predicted IoU)
+    schedule: str = "full"          # "full": prompt every grid point then filter. "adaptive": skip points already covered
+    refine_levels: int = 0          # adaptive only. number of coarse-to-fine levels before the full grid
+    tile_size: int = 0              # > 0: segment in overlapping tiles of this size, stitched into one palette
+    tile_overlap: int = 256         # tiled only. overlap of neighbouring tiles in pixels
+
+def segmentation_error(request: SegmentationRequest, session=None):
+    if session is not None and session.is_mosaic and request.tile_size <= 0:
+        return "Mosaics are only segmented in tiles, set tile_size"
+    if request.mask_selection not in MASK_SELECTIONS:
+        return f"Unknown mask selection: {request.mask_selection}"
+    if request.schedule not in ("full", "adaptive"):
+        return f"Unknown schedule: {request.schedule}"
+    if request.tile_size > 0 and not 0 <= 2 * request.tile_overlap < request.tile_size:
+        return "tile_overlap must be non-negative and less than half of tile_size"
+    return None
+
+def run_segmentation(session, request: SegmentationRequest, progress=None) -> dict:
+    '''
+    body of /generate_segmentation, shared with the job API. progress(stage, done, total) reports progress
+    '''
+    row_sample_interval = request.row_sample_interval
+    col_sample_interval = request.col_sample_interval
+    overlap_ratio = request.overlap_ratio
+    report = progress if progress is not None else (lambda *args, **kwargs: None)
+    startup.wait(model_timeout)
+
+    height, width = session.image.shape[:2]
+    point_grid = generation_sample_grid(height, width, row_sample_interval, col_sample_interval)
+
+    # a mosaic is read tile by tile even when it fits in one tile, it is never encoded whole
+    tiled = request.tile_size > 0 and (max(height, width) > request.tile_size or session.is_mosaic)
+    with session.lock, predictor_lock:
+        if tiled:
+            logging.info(f"start tiled prediction, height: {height}, width: {width}")
+            with metrics.stage("tiles"), torch.inference_mode(), autocast():
+                points, masks, prompt_stats = predict_tiled(
+                    predictor, session.image, point_grid, overlap_ratio,
+                    request.tile_size, request.tile_overlap, max(request.batch_size, 1), request.mask_selection,
+                    request.schedule, request.refine_levels, embedding_cache, tile_memory_bytes,
+                    progress=lambda done, total: report("tiles", done, total),
+                )
+            logging.info(f"prediction complete {prompt_stats}")
+        else:
+            logging.info(f"start prefilling, height: {height}, width: {width}")
+            report("set_image")
+            with metrics.stage("set_image"):
+                bind_predictor(predictor, session, session_store, embedding_cache)
+            logging.info("prefilling complete")
+            prompt_progress = lambda done, total: report("prompting", done, total)
+
+            with metrics.stage("prompting"), torch.inference_mode(), autocast():
+                if request.schedule == "adaptive":
+                    filtered_grids, filtered_masks, prompt_stats = predict_points_adaptive(
+                        predictor, point_grid, overlap_ratio, max(request.batch_size, 1), request.mask_selection, request.refine_levels,
+                        progress=prompt_progress,
+                    )
+                else:
+                    points = grid_prompt_order(point_grid)
+                    if decoder_pool is not None:
+                        masks = decoder_pool.decode(predictor, points, max(request.batch_size, 1), request.mask_selection, progress=prompt_progress, timeout=decode_timeout)
+                    elif request.batch_size > 1:
+                        masks = predict_points_batched(predictor, points, request.batch_size, request.mask_selection, progress=prompt_progress)
+                    else:
+                        masks = predict_points(predictor, points, request.mask_selection, progress=prompt_progress)
+                    prompt_stats = {"grid_points": len(points), "decoded_points": len(points), "skipped_points": 0}
+                logging.info(f"prediction complete {prompt_stats}")
+    
+    report("filtering", **prompt_stats)
+    # filtering and the palette are built in one pass, except for adaptive where filtering is part of prompting
+    with metrics.stage("filter_palette"):
+        if tiled:
+            # stitched masks are already in prompt order, as a one-column grid
+            filtered_grids, filtered_masks, palette = filter_and_build_palette(points[None], masks, height, width, overlap_ratio)
+        elif request.schedule == "full":
+            filtered_grids, filtered_masks, palette = filter_and_build_palette(point_grid, masks, height, width, overlap_ratio)
+        else:
+            palette = masks_to_palette(filtered_masks, height, width)
+    logging.info("filter complete")
+    with session.lock:
+        session.palette_state = PaletteState(palette)
+        session.dataset = None
+        with metrics.stage("index"):
+            session.segment_index = SegmentIndex(session.palette_state.palette)
+    session_store.evict()
+
+    num_masks = len(filtered_masks)
+    report("encoding", num_masks=num_masks)
+
+    with metrics.stage("encode"):
+        # 使用gzip压缩数据而不是np.save
+        compressed_data = encode_palette(palette, "gzip")
+        # 进行base64编码
+        palette_base64 = base64.b64encode(compressed_data).decode('utf-8')
+    metrics.payload("palette", len(palette_base64))
+    
+    return {
+        "palette": palette_base64,
+        "num_masks": num_masks,
+        "height": height,
+        "width": width,
+        "prompt_stats": prompt_stats,
+        "session_id": session.session_id,
+    }
+
+# ------------------------------------------------------------
+# clustering
+# ------------------------------------------------------------
+def session_dataset(session, palette: Optional[np.ndarray], n_patch: int, seg_ratio: int) -> FeatureExtractionDataset:
+    '''
+    palette None reuses the server palette of the session, and refreshes only the segments edited since the
+    last clustering. an uploaded palette replaces the server palette and rebuilds the dataset.
+    must be called with session.lock held.
+    '''
+    if palette is not None:
+        session.palette_state = PaletteState(palette)
+        session.dataset = None
+    state = session.palette_state
+    if state is None:
+        raise ValueError("No palette. Run segmentation or upload a palette first")
+
+    dataset = session.dataset
+    changes = None
+    if dataset is not None and dataset.palette is state.palette and dataset.n_patch == n_patch and dataset.seg_ratio == seg_ratio:
+        changes = state.changes_since(session.dataset_version)
+    if changes is None:
+        dataset = FeatureExtractionDataset(state.palette, session.image, n_patch, seg_ratio)
+    else:
+        dataset.refresh(changes)
+    session.dataset = dataset
+    session.dataset_version = state.version
+    return dataset
+
+def cluster_error(backend: str, k: int, k_sweep: Optional[List[int]]) -> Optional[str]:
+    if backend not in CLUSTER_BACKENDS:
+        return f"backend must be one of {sorted(CLUSTER_BACKENDS)}"
+    if min([k] + list(k_sweep or [])) < 1:
+        return "k must be positive"
+    return None
+
+def run_cluster(session, palette: Optional[np.ndarray], k: int, seg_ratio: int, backend: str = "umap", k_sweep: Optional[List[int]] = None, progress=None) -> dict:
+    '''
+    body of /cluster, shared with /cluster/upload and the job API. progress(stage, done, total) reports progress.
+    with k_sweep, every k of k_sweep is fitted on the one embedding and returned with its quality scores,
+    so the client can switch k without another request. labels stay those of k.
+    '''
+    report = progress if progress is not None else (lambda *args, **kwargs: None)
+    startup.wait(model_timeout)
+    report("dataset")
+    # the palette and the cached dataset of the session are read under its lock, the extraction and the clustering
+    # run without it. if the palette changed meanwhile, the result is dropped with PaletteConflict
+    with session.lock:
+        with metrics.stage("dataset"):
+            dataset = session_dataset(session, palette, 224 // extractor.config.patch_size, seg_ratio)
+        state = session.palette_state
+        version = state.version
+        dataset_version = session.dataset_version
+        ks = list(dict.fromkeys([k] + list(k_sweep or [])))
+        if sum(dataset.valid) < max(ks):
+            raise ValueError(f"{sum(dataset.valid)} segments cannot be split into {max(ks)} clusters")
+
+        # cached features of unchanged segments. deleted segments are dropped below and need no features
+        image_key = (session.image_key, extractor_name, dataset.n_patch)
+        segment_keys = [dataset.segment_key(i) if dataset.valid[i] else None for i in range(len(dataset))]
+        cls_tokens = [None for _ in range(len(dataset))]
+        missing = []
+        for i, segment_key in enumerate(segment_keys):
+            if segment_key is not None:
+                cls_tokens[i] = feature_cache.get((image_key, segment_key))
+                if cls_tokens[i] is None:
+                    missing.append(i)
+        cache_stats = {"hits": sum(key is not None for key in segment_keys) - len(missing), "misses": len(missing)}
+
+        # filter invalid (deleted) segments
+        indexes = [i for i, valid in enumerate(dataset.valid) if valid]
+        mean_color, std_color = dataset.mean_color[indexes], dataset.std_color[indexes]
+        valid_area = np.asarray(dataset.area, dtype=np.float32)[indexes]
+        areas, block_count = list(dataset.area), list(dataset.block_count)
+        position_x = np.round((dataset.bbox_top + dataset.bbox_bottom) / 2)
+        position_y = np.round((dataset.bbox_left + dataset.bbox_right) / 2)
+        embedding = session.embedding
+
+    # crops are resized straight to 224x224 (no center crop) and normalized as the preprocessor would
+    pipeline = CropPipeline(
+        dataset, missing, batch_size=128,
+        image_mean=preprocessor.image_mean, image_std=preprocessor.image_std,
+        device=extractor.device, size=224, num_workers=crop_workers,
+    )
+
+    start_time = time.time()
+
+    with metrics.stage("extraction"):
+        for i, (pixel_values, block_mask, indices) in enumerate(pipeline):
+            report("extraction", i, len(pipeline))
+            with torch.inference_mode(), autocast():
+                outputs = extractor(pixel_values=pixel_values)
+                pooled = pool_patch_tokens(outputs.last_hidden_state, block_mask).cpu().numpy()
+            for index, cls_token in zip(indices, pooled):  # iteration over samples in batch
+                cls_tokens[index] = cls_token
+    metrics.count("extracted_segments", len(missing))
+    # part of the extraction spent waiting for crops rather than running the model
+    metrics.add_stage("crop_wait", pipeline.wait_seconds)
+
+    end_time = time.time()
+    logging.info(f"Feature extraction took {end_time - start_time:.2f} seconds, {pipeline.stats()}")
+
+    # the reduced embedding only depends on the segments, so re-clustering with another k reuses it
+    cluster_backend = CLUSTER_BACKENDS[backend]
+    embedding_key = (image_key, backend, tuple(segment_keys))
+    cache_stats["embedding_reused"] = embedding is not None and embedding[0] == embedding_key
+    if cache_stats["embedding_reused"]:
+        features = embedding[1]
+    else:
+        report("reduction")
+        with metrics.stage("pca"):
+            features = build_features(np.stack([cls_tokens[i] for i in indexes], axis=0), mean_color, std_color, valid_area)
+        with metrics.stage("embed"):
+            features = cluster_backend.embed(features)
+
+    # 执行K-means聚类
+    report("kmeans")
+    start_time = time.time()
+    with metrics.stage("kmeans"):
+        fits = sweep_k(cluster_backend, features, ks) if k_sweep else [{"k": k, "labels": cluster_backend.fit(features, k)}]
+    end_time = time.time()
+    logging.info(f"{backend} clustering of k={ks} took {end_time - start_time:.2f} seconds")
+
+    # back to one label per segment, -1 for deleted segments
+    for fit in fits:
+        labels = np.full(len(dataset), -1, dtype=np.int64)
+        labels[indexes] = fit["labels"]
+        fit["labels"] = labels.tolist()
+    cluster_labels = np.array(fits[0]["labels"])
+
+    with session.lock:
+        if session.palette_state is not state or state.version != version:
+            raise PaletteConflict("The palette changed during clustering, cluster again")
+        # the features are only cached once they are known to match the palette
+        for index in missing:
+            feature_cache.put((image_key, segment_keys[index]), cls_tokens[index])
+        if not cache_stats["embedding_reused"]:
+            session.embedding = (embedding_key, features)
+        with metrics.stage("index"):
+            # the dataset the labels follow and the index must be at the same palette version
+            session_segment_index(session).set_labels(cluster_labels, dataset_version)
+
+    # areas = np.zeros(cluster_labels.max() + 1)
+    # for label, area in zip(cluster_labels, dataset.area):
+    #     if label != -1:
+    #         areas[label] += area
+
+    # 返回聚类结果
+    return {
+        "labels": cluster_labels.tolist(),      # List[n_segments]. each element is the cluster label to the segment, start from 0, -1 for deleted segments
+        # "areas": areas.tolist(),                # List[n_clusters]. each element is the area in pixels to the cluster
+        "areas": areas,
+        "block_count": block_count,
+        "position_x": position_x.tolist(),
+        "position_y": position_y.tolist(),
+        "feature_cache": cache_stats,
+        "extraction": pipeline.stats(),
+        "backend": backend,
+        # List[{"k", "labels", "scores"}] in the order of k_sweep (k first if missing), None without k_sweep
+        "sweep": fits if k_sweep else None,
+    }
+
+# ------------------------------------------------------------
+# spatial index
+# ------------------------------------------------------------
+def session_segment_index(session) -> SegmentIndex:
+    '''
+    the spatial index of the session palette, brought up to date with the palette edits since it was built.
+    must be called with session.lock held.
+    '''
+    state = session.palette_state
+    if state is None:
+        raise ValueError("No palette. Run segmentation or upload a palette first")
+    index = session.segment_index
+    if index is None or index.palette is not state.palette:
+        index = SegmentIndex(state.palette, version=state.version)
+    elif index.version != state.version:
+        changes = state.changes_since(index.version)
+        if changes is None:
+            index = SegmentIndex(state.palette, index.labels[1:], state.version)
+        else:
+            index.refresh(changes, state.version)
+    session.segment_index = index
+    return index
@@ -0,0 +1,274 @@
+import numpy as np
+import torch
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from tqdm import tqdm
+
+import metrics
+from masks import MaskStore
+
+if TYPE_CHECKING:
+    # imported for annotations only, loading SAM2 is deferred to api.load_model
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+MASK_SELECTIONS = ("first", "best")
+# float32 logits upscaled to the full image at once. a 24 MP mask takes 96 MB, so a whole batch would take GBs
+UPSCALE_BYTES = 256 * 1024 * 1024
+
+def grid_prompt_order(point_grid: np.ndarray) -> np.ndarray:
+    '''
+    flatten the point grid into the order in which masks are consumed by filter_overlap_segments,
+    i.e. column by column (outer loop over x, inner loop over y). returns [N, 2] array of [x, y].
+    '''
+    return point_grid.transpose(1, 0, 2).reshape(-1, 2)
+
+def select_multimask(masks, scores, selection: str = "first"):
+    '''
+    pick one of the multimask outputs for every prompt in a single indexing step.
+    masks: [B, 3, H, W], scores: [B, 3]. works on both numpy arrays and torch tensors.
+    "first" keeps the first output token (the historical behaviour), "best" keeps the highest predicted IoU.
+    '''
+    if selection == "first":
+        return masks[:, 0]
+    if selection == "best":
+        best = scores.argmax(-1)
+        if isinstance(masks, torch.Tensor):
+            rows = torch.arange(masks.shape[0], device=masks.device)
+        else:
+            rows = np.arange(masks.shape[0])
+        return masks[rows, best]
+    raise ValueError(f"unknown mask selection: {selection}")
+
+def predict_points(
+    predictor: "SAM2ImagePredictor",
+    points: np.ndarray,
+    selection: str = "first",
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> MaskStore:
+    '''
+    reference path: one decoder call per point. predictor.set_image must have been called.
+    progress(done, total) is called after every decoded point (or chunk, in the functions below).
+    '''
+    height, width = predictor._orig_hw[-1]
+    masks = MaskStore(height, width)
+    point_label = np.array([1])
+    for i, point in enumerate(tqdm(points, desc="Processing points")):
+        point_coord = np.expand_dims(point, axis=0)
+        current_masks, scores, _ = predictor.predict(point_coords=point_coord, point_labels=point_label, multimask_output=True)
+        metrics.count("decoder_calls")
+        masks.append(select_multimask(current_masks[None], scores[None], selection)[0].astype(bool))
+        if progress is not None:
+            progress(i + 1, len(points))
+    return masks
+
+def decode_point_batch(predictor: "SAM2ImagePredictor", points: np.ndarray, selection: str = "first") -> List[Tuple[Tuple[int, int, int, int], np.ndarray]]:
+    '''
+    send a chunk of points through the mask decoder in one call, reusing the embedding from set_image.
+    every point is an independent single-click prompt, so the result equals predict_points.
+    the multimask selection is done on the low-res logits before upscaling: postprocess_masks works
+    channel by channel, so only the kept mask has to be upscaled, a few masks at a time (crop_low_res_masks).
+    returns [(box, crop)] as MaskStore.append_cropped takes.
+    '''
+    if not predictor._is_image_set:
+        raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+    point_coords = points[:, None, :]                           # [B, 1, 2], one click per prompt
+    point_labels = np.ones((len(points), 1), dtype=np.int32)
+    _, unnorm_coords, labels, _ = predictor._prep_prompts(point_coords, point_labels, None, None, normalize_coords=True)
+
+    sparse_embeddings, dense_embeddings = predictor.model.sam_prompt_encoder(points=(unnorm_coords, labels), boxes=None, masks=None)
+    low_res_masks, iou_predictions, _, _ = predictor.model.sam_mask_decoder(
+        image_embeddings=predictor._features["image_embed"][-1].unsqueeze(0),
+        image_pe=predictor.model.sam_prompt_encoder.get_dense_pe(),
+        sparse_prompt_embeddings=sparse_embeddings,
+        dense_prompt_embeddings=dense_embeddings,
+        multimask_output=True,
+        repeat_image=len(points) > 1,
+        high_res_features=[feat_level[-1].unsqueeze(0) for feat_level in predictor._features["high_res_feats"]],
+    )
+    metrics.count("decoder_calls")
+
+    selected = select_multimask(low_res_masks, iou_predictions, selection)
+    return crop_low_res_masks(predictor, selected)
+
+def crop_low_res_masks(predictor: "SAM2ImagePredictor", low_res_masks: torch.Tensor) -> List[Tuple[Tuple[int, int, int, int], np.ndarray]]:
+    '''
+    upscale [B, H, W] low-res logits to the image, threshold, and crop every mask to its bbox on the device.
+    masks are upscaled in slices of at most UPSCALE_BYTES of logits, at least one mask per slice, and only
+    the crops are copied back to host
+    '''
+    height, width = predictor._orig_hw[-1]
+    step = max(1, UPSCALE_BYTES // (height * width * 4))
+    crops = []
+    for start in range(0, len(low_res_masks), step):
+        upscaled = predictor._transforms.postprocess_masks(low_res_masks[start:start + step, None], (height, width))
+        batch_masks = upscaled[:, 0] > predictor.mask_threshold
+        del upscaled
+        row_any = batch_masks.any(dim=2).cpu().numpy()
+        col_any = batch_masks.any(dim=1).cpu().numpy()
+        for mask, rows, cols in zip(batch_masks, row_any, col_any):
+            rows, cols = np.flatnonzero(rows), np.flatnonzero(cols)
+            if len(rows) == 0:
+                crops.append(((0, 0, 0, 0), np.zeros((0, 0), dtype=bool)))
+                continue
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            crops.append(((top, left, bottom, right), mask[top:bottom, left:right].cpu().numpy()))
+    return crops
+
+def decode_prompts(predictor: "SAM2ImagePredictor", prompts: List[dict], selection: str = "best") -> List[dict]:
+    '''
+    interactive prompts, several segments per call. every prompt is a dict with
+    - points [N, 2] of [x, y] and labels [N] (1 positive, 0 negative), N may be 0
+    - box [x0, y0, x1, y1] or None
+    - mask_input [1, 256, 256] low-res logits of the previous round for this segment, or None
+    like SAM2ImagePredictor.predict, a lone click without box or mask_input is ambiguous and gets the
+    multimask outputs (picked by selection), everything else gets the single refined output.
+    prompts of different sizes share a decoder call by padding with "not a point" (label -1), so there is
+    one call per kind of prompt (with / without mask_input, single / multimask output).
+    returns per prompt {"box", "crop", "score", "logits"}, logits being the next mask_input for the segment.
+    '''
+    if not predictor._is_image_set:
+        raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+    groups = {}
+    for i, prompt in enumerate(prompts):
+        multimask = prompt["box"] is None and prompt["mask_input"] is None and len(prompt["points"]) == 1
+        groups.setdefault((prompt["mask_input"] is not None, multimask), []).append(i)
+
+    results = [None] * len(prompts)
+    image_embed = predictor._features["image_embed"][-1].unsqueeze(0)
+    high_res_features = [feat_level[-1].unsqueeze(0) for feat_level in predictor._features["high_res_feats"]]
+    for (with_mask, multimask), indices in groups.items():
+        group = [prompts[i] for i in indices]
+        n_box = 2 if any(prompt["box"] is not None for prompt in group) else 0
+        n_points = n_box + max(len(prompt["points"]) for prompt in group)
+        coords = np.zeros((len(group), max(n_points, 1), 2), dtype=np.float32)
+        labels = np.full((len(group), max(n_points, 1)), -1, dtype=np.int32)
+        for b, prompt in enumerate(group):
+            if prompt["box"] is not None:
+                # box corners are prompted as points labelled 2 and 3, as SAM2ImagePredictor._predict does
+                coords[b, :2] = np.asarray(prompt["box"], dtype=np.float32).reshape(2, 2)
+                labels[b, :2] = (2, 3)
+            n = len(prompt["points"])
+            if n > 0:
+                coords[b, n_box:n_box + n] = prompt["points"]
+                labels[b, n_box:n_box + n] = prompt["labels"]
+        coords = predictor._transforms.transform_coords(
+            torch.as_tensor(coords, device=predictor.device), normalize=True, orig_hw=predictor._orig_hw[-1])
+        labels = torch.as_tensor(labels, device=predictor.device)
+        mask_input = torch.stack([prompt["mask_input"] for prompt in group]).to(predictor.device) if with_mask else None
+
+        sparse_embeddings, dense_embeddings = predictor.model.sam_prompt_encoder(points=(coords, labels), boxes=None, masks=mask_input)
+        low_res_masks, iou_predictions, _, _ = predictor.model.sam_mask_decoder(
+            image_embeddings=image_embed,
+            image_pe=predictor.model.sam_prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask,
+            repeat_image=len(group) > 1,
+            high_res_features=high_res_features,
+        )
+        metrics.count("decoder_calls")
+        if multimask:
+            best = iou_predictions.argmax(-1) if selection == "best" else torch.zeros(len(group), dtype=torch.long, device=iou_predictions.device)
+            rows = torch.arange(len(group), device=iou_predictions.device)
+            selected, scores = low_res_masks[rows, best], iou_predictions[rows, best]
+        else:
+            selected, scores = low_res_masks[:, 0], iou_predictions[:, 0]
+        # clamped like SAM2ImagePredictor.predict returns them for reuse as mask_input
+        logits = torch.clamp(selected.float(), -32.0, 32.0)
+        for i, (box, crop), score, logit in zip(indices, crop_low_res_masks(predictor, selected), scores.float().cpu().numpy(), logits):
+            results[i] = {"box": box, "crop": crop, "score": float(score), "logits": logit[None].cpu()}
+    return results
+
+def predict_points_batched(
+    predictor: "SAM2ImagePredictor",
+    points: np.ndarray,
+    batch_size: int = 16,
+    selection: str = "first",
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> MaskStore:
+    '''
+    decode the points in chunks of batch_size. returns the same masks as predict_points.
+    '''
+    height, width = predictor._orig_hw[-1]
+    masks = MaskStore(height, width)
+    pbar = tqdm(total=len(points), desc="Processing points")
+    for start in range(0, len(points), batch_size):
+        chunk = points[start:start + batch_size]
+        for box, crop in decode_point_batch(predictor, chunk, selection):
+            masks.append_cropped(box, crop)
+        pbar.update(len(chunk))
+        if progress is not None:
+            progress(start + len(chunk), len(points))
+    pbar.close()
+    return masks
+
+def predict_points_adaptive(
+    predictor: "SAM2ImagePredictor",
+    point_grid: np.ndarray,
+    ratio: float,
+    batch_size: int = 16,
+    selection: str = "first",
+    refine_levels: int = 0,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[List[np.ndarray], MaskStore, Dict[str, int]]:
+    '''
+    coverage-aware prompting. a running coverage bitmap of the accepted segments is kept while prompting,
+    and grid points that already fall inside it are skipped instead of being decoded and filtered afterwards.
+    masks are accepted with the same rule as filter_overlap_segments (overlap / area < ratio).
+
+    with refine_levels > 0 the grid is visited coarse to fine: first every 2**refine_levels-th point,
+    then the points of each finer level, which only survive where the coarser levels left holes.
+    with refine_levels = 0 the visiting order is the same as the full grid.
+
+    returns (legal_sample_points, filtered_masks, stats), the first two as from filter_overlap_segments.
+    '''
+    n_rows, n_cols = point_grid.shape[:2]
+    height, width = predictor._orig_hw[-1]
+    coverage = np.zeros((height, width), dtype=bool)
+    visited = np.zeros((n_rows, n_cols), dtype=bool)
+
+    filtered_masks = MaskStore(height, width)
+    legal_sample_points = []
+    decoded = 0
+    batches = 0
+
+    pbar = tqdm(total=n_rows * n_cols, desc="Processing points")
+    for level in range(refine_levels, -1, -1):
+        stride = 2 ** level
+        level_visit = np.zeros_like(visited)
+        level_visit[::stride, ::stride] = True
+        level_visit &= ~visited
+        visited |= level_visit
+        # column by column, same as grid_prompt_order
+        cols, rows = np.nonzero(level_visit.T)
+        points = point_grid[rows, cols]
+
+        for start in range(0, len(points), batch_size):
+            chunk = points[start:start + batch_size]
+            pending = chunk[~coverage[chunk[:, 1], chunk[:, 0]]]
+            pbar.update(len(chunk))
+            if progress is not None:
+                progress(pbar.n, pbar.total)
+            if len(pending) == 0:
+                continue
+            chunk_masks = decode_point_batch(predictor, pending, selection)
+            decoded += len(pending)
+            batches += 1
+            for point, ((top, left, bottom, right), crop) in zip(pending, chunk_masks):
+                covered = coverage[top:bottom, left:right]
+                area = np.count_nonzero(crop)
+                if area > 0 and np.count_nonzero(covered & crop) / area >= ratio:
+                    continue
+                filtered_masks.append_cropped((top, left, bottom, right), crop)
+                legal_sample_points.append(point)
+                covered |= crop
+    pbar.close()
+
+    stats = {
+        "grid_points": n_rows * n_cols,
+        "decoded_points": decoded,
+        "decoder_batches": batches,
+        "skipped_points": n_rows * n_cols - decoded,
+    }
+    return legal_sample_points, filtered_masks, stats
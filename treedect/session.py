@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from embedding_cache import EmbeddingCache
+from inference import autocast
+
+if TYPE_CHECKING:
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+class Session:
+    '''
+    state of one operator's image: the decoded image, the SAM2 image embedding and the derived palette.
+    lock serializes the requests of the session; the embedding is computed lazily by bind_predictor.
+    '''
+    def __init__(self, session_id: str, image: np.ndarray, files: Optional[List[str]] = None):
+        self.session_id = session_id
+        self.image = image          # in memory, or a read-only np.memmap for tiled mosaics (see tiling.open_mosaic)
+        self.files = files or []    # files backing the image, deleted with the session
+        self.features = None        # predictor._features after set_image
+        self.orig_hw = None         # predictor._orig_hw after set_image
+        self.palette_state = None   # PaletteState, the authoritative palette
+        self.dataset = None         # FeatureExtractionDataset of the last clustering, refreshed on palette edits
+        self.dataset_version = None
+        self.embedding = None       # (key, reduced features) of the last clustering
+        self.prompt_logits = OrderedDict()  # segment id -> low-res logits of its last /point_segment round, LRU
+        self.segment_index = None   # spatial.SegmentIndex over the palette and the labels of the last clustering
+        self._image_key = None
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+
+    @property
+    def image_key(self) -> str:
+        '''
+        content hash of the image, computed once
+        '''
+        if self._image_key is None:
+            # in bands of rows, so a memory-mapped mosaic is never copied whole
+            digest = hashlib.sha256()
+            rows = max(1, (64 * 1024 ** 2) // max(1, self.image[:1].nbytes))
+            for top in range(0, self.image.shape[0], rows):
+                digest.update(np.ascontiguousarray(self.image[top:top + rows]).data)
+            self._image_key = digest.hexdigest()
+        return self._image_key
+
+    @property
+    def is_mosaic(self) -> bool:
+        '''
+        memory-mapped, read in windows only: no set_image on the whole image
+        '''
+        return isinstance(self.image, np.memmap)
+
+    @property
+    def nbytes(self) -> int:
+        # a memory-mapped image lives in the page cache, not in the budget
+        size = 0 if self.is_mosaic else self.image.nbytes
+        if self.palette_state is not None:
+            size += self.palette_state.palette.nbytes
+        size += sum(logits.nbytes for logits in self.prompt_logits.values())
+        if self.segment_index is not None:
+            size += self.segment_index.nbytes
+        if self.features is not None:
+            size += self.features["image_embed"].nbytes
+            size += sum(feat.nbytes for feat in self.features["high_res_feats"])
+        return size
+
+    def close(self):
+        for path in self.files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.files = []
+
+class SessionStore:
+    '''
+    session-keyed store with a memory budget. least recently used sessions are evicted when
+    the total size of the stored sessions exceeds max_bytes; the last used session is always kept.
+    '''
+    def __init__(self, max_bytes: int = 4 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, image: np.ndarray, files: Optional[List[str]] = None) -> Session:
+        session = Session(uuid.uuid4().hex, image, files)
+        with self._lock:
+            self._sessions[session.session_id] = session
+        self.evict()
+        return session
+
+    def get(self, session_id: Optional[str] = None) -> Session:
+        '''
+        session_id None returns the only session, for clients that do not track sessions. raises KeyError if
+        there is none, or if there are several: another client's session must not be picked by mistake.
+        '''
+        with self._lock:
+            if session_id is None:
+                if len(self._sessions) != 1:
+                    raise KeyError("no session" if len(self._sessions) == 0 else "session_id required with several sessions")
+                session_id = next(iter(self._sessions))
+            session = self._sessions[session_id]
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            return session
+
+    def remove(self, session_id: str):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(session.nbytes for session in self._sessions.values())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def evict(self):
+        with self._lock:
+            total = sum(session.nbytes for session in self._sessions.values())
+            while total > self.max_bytes and len(self._sessions) > 1:
+                _, session = self._sessions.popitem(last=False)
+                total -= session.nbytes
+                session.close()
+
+# the SAM2 model is shared between sessions, only its image state is swapped
+predictor_lock = threading.RLock()
+
+def encode_image(
+    predictor: "SAM2ImagePredictor",
+    image: np.ndarray,
+    embedding_cache: Optional[EmbeddingCache] = None,
+) -> Tuple[dict, list]:
+    '''
+    (predictor._features, predictor._orig_hw) of image, from embedding_cache or by running set_image on a miss.
+    must be called with predictor_lock held.
+    '''
+    if embedding_cache is not None:
+        key = embedding_cache.key(image)
+        cached = embedding_cache.get(key, predictor.device)
+        if cached is not None:
+            return cached
+    with torch.inference_mode(), autocast():
+        predictor.set_image(image)
+    if embedding_cache is not None:
+        embedding_cache.put(key, predictor._features, predictor._orig_hw)
+    return predictor._features, predictor._orig_hw
+
+def bind_features(predictor: "SAM2ImagePredictor", features: dict, orig_hw: list):
+    '''
+    point the predictor at an image embedding computed earlier
+    '''
+    predictor.reset_predictor()
+    predictor._features = features
+    predictor._orig_hw = orig_hw
+    predictor._is_image_set = True
+    predictor._is_batch = False
+
+def bind_predictor(
+    predictor: "SAM2ImagePredictor",
+    session: Session,
+    store: Optional[SessionStore] = None,
+    embedding_cache: Optional[EmbeddingCache] = None,
+):
+    '''
+    point the predictor at the embedding of session. if the session has none yet, it is loaded from
+    embedding_cache, and set_image only runs on a cache miss. mosaics are only encoded tile by tile, see
+    tiling.predict_tiled, and raise ValueError.
+    must be called with predictor_lock held, and the lock must be kept while the predictor is used.
+    '''
+    if session.features is None:
+        if session.is_mosaic:
+            raise ValueError("Mosaics are only segmented in tiles, set tile_size")
+        session.features, session.orig_hw = encode_image(predictor, session.image, embedding_cache)
+        if store is not None:
+            store.evict()
+    bind_features(predictor, session.features, session.orig_hw)
@@ -0,0 +1,222 @@
+import math
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from palette import Box, union_box
+
+class SegmentIndex:
+    '''
+    spatial index of the segments of a palette, for region queries that must not scan the palette.
+    per segment (indexed by palette value, 0 unused) it keeps the area, the bbox [top, left, bottom, right),
+    the centroid and the cluster label (-1 for unclustered or deleted segments), plus
+    - a uniform grid over the centroids in CSR form: the segments of a region are gathered from the cells
+      it covers, one contiguous slice per grid row, and every segment is in exactly one cell
+    - k-d trees over the centroids, one per cluster label, built on the first nearest-neighbour query
+    only the hit-test reads the palette, one pixel. region queries count a segment when its centroid is inside.
+    version is the PaletteState version the index reflects, see refresh.
+    '''
+    def __init__(self, palette: np.ndarray, labels: Optional[Sequence[int]] = None, version: int = 0, band_rows: int = 1024):
+        self.palette = palette
+        self.height, self.width = palette.shape
+        self.version = version
+        num_segs = int(palette.max()) if palette.size > 0 else 0
+        self.area = np.zeros(num_segs + 1, dtype=np.int64)
+        self.bbox = np.zeros((num_segs + 1, 4), dtype=np.int64)
+        self.centroid = np.zeros((num_segs + 1, 2), dtype=np.float64)   # [x, y]
+        self.labels = np.full(num_segs + 1, -1, dtype=np.int64)
+        self._scan(band_rows)
+        if labels is not None:
+            self.set_labels(labels)
+        self._build_grid()
+
+    @property
+    def num_segs(self) -> int:
+        return len(self.area) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.area.nbytes + self.bbox.nbytes + self.centroid.nbytes + self.labels.nbytes + self._cell_segments.nbytes + self._cell_start.nbytes
+
+    def _scan(self, band_rows: int):
+        '''
+        areas and centroids of all segments, in bands of rows so the coordinate weights stay small, and bboxes
+        '''
+        n = self.num_segs + 1
+        row_sum = np.zeros(n, dtype=np.float64)
+        col_sum = np.zeros(n, dtype=np.float64)
+        cols = np.arange(self.width, dtype=np.float64)
+        for top in range(0, self.height, band_rows):
+            flat = np.asarray(self.palette[top:top + band_rows]).ravel()
+            rows = np.arange(top, top + len(flat) // max(self.width, 1), dtype=np.float64)
+            self.area += np.bincount(flat, minlength=n)
+            row_sum += np.bincount(flat, weights=np.repeat(rows, self.width), minlength=n)
+            col_sum += np.bincount(flat, weights=np.tile(cols, len(rows)), minlength=n)
+        for index, slices in enumerate(ndimage.find_objects(self.palette), start=1):
+            if slices is not None:
+                self.bbox[index] = (slices[0].start, slices[1].start, slices[0].stop, slices[1].stop)
+        self.area[0] = 0    # background
+        present = self.area > 0
+        self.centroid[present, 0] = col_sum[present] / self.area[present]
+        self.centroid[present, 1] = row_sum[present] / self.area[present]
+
+    def _build_grid(self):
+        '''
+        cells of about twice the median bbox side, a few segments per cell
+        '''
+        live = np.flatnonzero(self.area > 0)
+        sides = np.concatenate([self.bbox[live, 2] - self.bbox[live, 0], self.bbox[live, 3] - self.bbox[live, 1]])
+        self.cell_size = int(max(16, 2 * np.median(sides))) if len(live) > 0 else max(self.height, self.width, 1)
+        self.grid_rows = math.ceil(self.height / self.cell_size)
+        self.grid_cols = math.ceil(self.width / self.cell_size)
+
+        cells = (self.centroid[live, 1] // self.cell_size).astype(np.int64) * self.grid_cols + (self.centroid[live, 0] // self.cell_size).astype(np.int64)
+        order = np.argsort(cells, kind="stable")
+        self._cell_segments = live[order]
+        self._cell_start = np.zeros(self.grid_rows * self.grid_cols + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.grid_rows * self.grid_cols), out=self._cell_start[1:])
+        self._trees = {}
+
+    def set_labels(self, labels: Sequence[int], version: Optional[int] = None):
+        '''
+        labels[i] is the cluster label of palette value i + 1, as run_cluster returns them. labels are applied by
+        position, so version, the palette version they were computed on, must be the one of the index
+        '''
+        if version is not None and version != self.version:
+            raise ValueError(f"labels of palette version {version} cannot be applied to the index of version {self.version}")
+        labels = np.asarray(labels, dtype=np.int64)[:self.num_segs]
+        self.labels[:] = -1
+        self.labels[1:len(labels) + 1] = labels
+        self._trees = {}
+
+    def refresh(self, changes: Dict[int, Box], version: int):
+        '''
+        recompute the segments touched by palette edits (PaletteState.changes_since) within their old bbox
+        and the edited box, where all their pixels are. segments created since get label -1
+        '''
+        if len(changes) > 0 and max(changes) > self.num_segs:
+            grow = max(changes) - self.num_segs
+            self.area = np.concatenate([self.area, np.zeros(grow, dtype=np.int64)])
+            self.bbox = np.concatenate([self.bbox, np.zeros((grow, 4), dtype=np.int64)])
+            self.centroid = np.concatenate([self.centroid, np.zeros((grow, 2))])
+            self.labels = np.concatenate([self.labels, np.full(grow, -1, dtype=np.int64)])
+        for index, box in changes.items():
+            if self.area[index] > 0:
+                box = union_box(tuple(int(v) for v in self.bbox[index]), box)
+            top, left, bottom, right = box
+            rows, cols = np.nonzero(self.palette[top:bottom, left:right] == index)
+            self.area[index] = len(rows)
+            if len(rows) == 0:
+                self.bbox[index] = 0
+                self.centroid[index] = 0
+                continue
+            self.bbox[index] = (top + rows.min(), left + cols.min(), top + rows.max() + 1, left + cols.max() + 1)
+            self.centroid[index] = (left + cols.mean(), top + rows.mean())
+        self.version = version
+        self._build_grid()
+
+    def describe(self, index: int) -> dict:
+        top, left, bottom, right = (int(v) for v in self.bbox[index])
+        return {
+            "index": int(index),
+            "label": int(self.labels[index]),
+            "area": int(self.area[index]),
+            "box": [top, left, bottom, right],
+            "x": round(float(self.centroid[index, 0]), 2),
+            "y": round(float(self.centroid[index, 1]), 2),
+        }
+
+    def hit(self, x: int, y: int) -> Optional[dict]:
+        '''
+        the segment under pixel (x, y), None for background or outside the image
+        '''
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        index = int(self.palette[y, x])
+        if index == 0:
+            return None
+        return self.describe(index)
+
+    def candidates(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        '''
+        segments whose centroid may be in the rectangle [x0, x1) x [y0, y1), those of the grid cells it covers
+        '''
+        col0, col1 = max(math.floor(x0) // self.cell_size, 0), min(math.ceil(x1) // self.cell_size, self.grid_cols - 1)
+        row0, row1 = max(math.floor(y0) // self.cell_size, 0), min(math.ceil(y1) // self.cell_size, self.grid_rows - 1)
+        if col0 > col1 or row0 > row1:
+            return np.zeros(0, dtype=np.int64)
+        if col0 == 0 and col1 == self.grid_cols - 1:
+            # full grid rows are one slice
+            return self._cell_segments[self._cell_start[row0 * self.grid_cols]:self._cell_start[(row1 + 1) * self.grid_cols]]
+        rows = np.arange(row0, row1 + 1) * self.grid_cols
+        return np.concatenate([self._cell_segments[start:stop] for start, stop in zip(self._cell_start[rows + col0], self._cell_start[rows + col1 + 1])])
+
+    def select(self, box: Optional[Sequence[float]] = None, polygon: Optional[Sequence[Sequence[float]]] = None) -> np.ndarray:
+        '''
+        segments whose centroid is inside box [x0, y0, x1, y1) or inside polygon [[x, y], ...] (even-odd rule)
+        '''
+        if polygon is not None:
+            vertices = np.asarray(polygon, dtype=np.float64)
+            x0, y0 = vertices.min(axis=0)
+            x1, y1 = vertices.max(axis=0) + 1
+        else:
+            x0, y0, x1, y1 = box
+        indexes = self.candidates(x0, y0, x1, y1)
+        x, y = self.centroid[indexes, 0], self.centroid[indexes, 1]
+        inside = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+        if polygon is not None:
+            inside &= points_in_polygon(x, y, vertices)
+        return indexes[inside]
+
+    def count(self, box: Optional[Sequence[float]] = None, polygon: Optional[Sequence[Sequence[float]]] = None, with_indexes: bool = False) -> dict:
+        '''
+        segments of a region grouped by cluster label: count and total area per label, -1 being unclustered
+        '''
+        indexes = self.select(box, polygon)
+        labels = self.labels[indexes] + 1       # -1 (unclustered) first
+        counts = np.bincount(labels)
+        areas = np.bincount(labels, weights=self.area[indexes])
+        result = {
+            "count": int(len(indexes)),
+            "area": int(self.area[indexes].sum()),
+            "clusters": [{"label": int(label) - 1, "count": int(counts[label]), "area": int(areas[label])} for label in np.flatnonzero(counts)],
+        }
+        if with_indexes:
+            result["indexes"] = np.sort(indexes).tolist()
+        return result
+
+    def nearest(self, x: float, y: float, k: int = 5, label: Optional[int] = None, max_distance: Optional[float] = None) -> List[dict]:
+        '''
+        the k segments whose centroids are closest to (x, y), optionally of one cluster label only
+        '''
+        if label not in self._trees:
+            live = self.area > 0
+            if label is not None:
+                live &= self.labels == label
+            indexes = np.flatnonzero(live)
+            self._trees[label] = (cKDTree(self.centroid[indexes]) if len(indexes) > 0 else None, indexes)
+        tree, indexes = self._trees[label]
+        if tree is None or k < 1:
+            return []
+        distances, positions = tree.query([x, y], k=min(k, len(indexes)), distance_upper_bound=max_distance if max_distance is not None else np.inf)
+        results = []
+        for distance, position in zip(np.atleast_1d(distances), np.atleast_1d(positions)):
+            if not np.isfinite(distance):     # fewer than k within max_distance
+                break
+            results.append({**self.describe(indexes[position]), "distance": round(float(distance), 2)})
+        return results
+
+def points_in_polygon(x: np.ndarray, y: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+    '''
+    even-odd rule, vectorized over the points and looped over the edges
+    '''
+    inside = np.zeros(len(x), dtype=bool)
+    for (ax, ay), (bx, by) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        crosses = (ay > y) != (by > y)
+        if not crosses.any():
+            continue
+        x_cross = ax + (y[crosses] - ay) * (bx - ax) / (by - ay)
+        inside[crosses] ^= x[crosses] < x_cross
+    return inside
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+STARTUP_MODES = ("background", "lazy", "eager")
+
+class ModelsNotReady(RuntimeError):
+    pass
+
+class Startup:
+    '''
+    loads the models off the import path and records how long each startup phase took. nothing loads until
+    start() is called: by the lifespan handler of api.py when the server starts, and by batch.py before its run.
+    - eager:      start() loads the models itself, the port opens once everything is loaded (the historical behaviour)
+    - background: start() loads them on a thread, the port opens right away
+    - lazy:       the server does not call start(), the first request that needs a model does
+    requests needing a model call wait(), which starts the load in lazy mode and blocks until it is done.
+    '''
+    def __init__(self, load: Callable[["Startup"], None], mode: str = "background"):
+        if mode not in STARTUP_MODES:
+            raise ValueError(f"unknown startup mode: {mode}")
+        self.mode = mode
+        self.phases = {}            # phase name -> seconds, in order
+        self.phase = None           # phase running now
+        self.error = None
+        self._load = load
+        self._started = time.time()
+        self._thread = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, phase: str):
+        self.phase = phase
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[phase] = round(time.time() - start, 3)
+            self.phase = None
+            logging.info(f"startup phase {phase} took {self.phases[phase]:.2f} seconds")
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self._done.is_set():
+                return
+            if self.mode == "eager":
+                self._run()
+                return
+            self._thread = threading.Thread(target=self._run, name="treedect-startup", daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout: Optional[float] = None):
+        '''
+        block until the models are loaded. raises ModelsNotReady if loading failed or timeout expired
+        '''
+        self.start()
+        if not self._done.wait(timeout):
+            raise ModelsNotReady(f"models are still loading ({self.phase})")
+        if self.error is not None:
+            raise ModelsNotReady(f"model loading failed: {self.error}")
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set() and self.error is None
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "mode": self.mode,
+            "phase": self.phase,
+            "phases": dict(self.phases),
+            "error": self.error,
+            "uptime": round(time.time() - self._started, 3),
+        }
+
+    def _run(self):
+        try:
+            self._load(self)
+        except Exception as e:
+            logging.exception("model loading failed")
+            self.error = str(e)
+        finally:
+            self._done.set()
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the modules import each other by bare name, as when run from treedect/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def blobs():
+    '''
+    60x80 palette of a few rectangular segments, 0 is background
+    '''
+    palette = np.zeros((60, 80), dtype=np.int32)
+    palette[5:15, 5:20] = 1
+    palette[10:30, 30:45] = 2
+    palette[40:55, 10:25] = 3
+    palette[35:58, 50:78] = 4
+    palette[20:25, 60:70] = 5
+    return palette
@@ -0,0 +1,49 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from codec import PALETTE_ENCODINGS, decode_palette, encode_palette
+
+@pytest.mark.parametrize("encoding", PALETTE_ENCODINGS)
+def test_round_trip(blobs, encoding):
+    data = encode_palette(blobs, encoding)
+    assert np.array_equal(decode_palette(data, *blobs.shape, encoding), blobs)
+
+def test_raw_and_gzip_accepted_under_either_name(blobs):
+    assert np.array_equal(decode_palette(encode_palette(blobs, "gzip"), *blobs.shape, "raw"), blobs)
+    assert np.array_equal(decode_palette(encode_palette(blobs, "raw"), *blobs.shape, "gzip"), blobs)
+
+def test_unknown_encoding(blobs):
+    with pytest.raises(ValueError):
+        encode_palette(blobs, "png")
+    with pytest.raises(ValueError):
+        decode_palette(b"", *blobs.shape, "png")
+
+def test_wrong_size(blobs):
+    with pytest.raises(ValueError):
+        decode_palette(encode_palette(blobs, "raw"), 60, 81, "raw")
+
+def test_corrupt_and_truncated_gzip(blobs):
+    data = encode_palette(blobs, "gzip")
+    with pytest.raises(ValueError, match="truncated"):
+        decode_palette(data[:len(data) // 2], *blobs.shape)
+    corrupt = data[:10] + bytes(b ^ 0xFF for b in data[10:30]) + data[30:]
+    with pytest.raises(ValueError):
+        decode_palette(corrupt, *blobs.shape)
+
+def test_gzip_bomb():
+    data = gzip.compress(bytes(10 * 1024 * 1024))
+    with pytest.raises(ValueError, match="inflates"):
+        decode_palette(data, 10, 10)
+
+def test_rle_checks(blobs):
+    height, width = blobs.shape
+    short = np.array([[1, height * width - 1]], dtype='<i4').tobytes()
+    with pytest.raises(ValueError, match="covers"):
+        decode_palette(short, height, width, "rle")
+    negative = np.array([[1, height * width + 5], [2, -5]], dtype='<i4').tobytes()
+    with pytest.raises(ValueError, match="negative"):
+        decode_palette(negative, height, width, "rle")
+    with pytest.raises(ValueError, match="multiple of 8"):
+        decode_palette(short[:6], height, width, "rle")
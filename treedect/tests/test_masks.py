@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from masks import MaskStore
+
+@pytest.fixture
+def dense():
+    rng = np.random.default_rng(0)
+    masks = []
+    for _ in range(40):
+        mask = np.zeros((50, 70), dtype=bool)
+        top, left = rng.integers(0, 40), rng.integers(0, 60)
+        mask[top:top + rng.integers(1, 20), left:left + rng.integers(1, 25)] = rng.random() > 0.2
+        mask &= rng.random(mask.shape) > 0.3
+        masks.append(mask)
+    masks.append(np.zeros((50, 70), dtype=bool))
+    return masks
+
+def test_round_trip(dense):
+    store = MaskStore.from_masks(dense, 50, 70)
+    assert len(store) == len(dense)
+    for i, mask in enumerate(dense):
+        assert np.array_equal(store.to_dense(i), mask)
+        assert (store.to_sparse(i) != sparse.csr_matrix(mask)).nnz == 0
+    assert list(store.areas) == [int(mask.sum()) for mask in dense]
+    # boxes are tight, an empty mask has an empty box at (0, 0)
+    rows, cols = np.nonzero(dense[0])
+    assert tuple(store.boxes[0]) == (rows.min(), cols.min(), rows.max() + 1, cols.max() + 1)
+    assert tuple(store.boxes[-1]) == (0, 0, 0, 0)
+
+def test_sparse_input(dense):
+    store = MaskStore.from_masks([sparse.csr_matrix(mask) for mask in dense], 50, 70)
+    for i, mask in enumerate(dense):
+        assert np.array_equal(store.to_dense(i), mask)
+
+def test_read_only_views(dense):
+    store = MaskStore.from_masks(dense, 50, 70)
+    with pytest.raises(ValueError):
+        store.boxes[0, 0] = 1
+    with pytest.raises(ValueError):
+        store.areas[0] = 1
+
+def test_growth_past_capacity(dense):
+    store = MaskStore(50, 70, capacity=1)
+    for mask in dense:
+        store.append(mask)
+    assert len(store) == len(dense)
+    assert np.array_equal(store.to_dense(len(dense) - 2), dense[-2])
+
+def test_intersections(dense):
+    store = MaskStore.from_masks(dense, 50, 70)
+    for i in range(0, len(dense), 7):
+        expected = np.array([np.logical_and(dense[i], mask).sum() for mask in dense])
+        assert np.array_equal(store.intersection_areas(i), expected)
+        assert np.array_equal(store.intersection_areas(i, [3, 1]), expected[[3, 1]])
+        assert np.array_equal(store.box_intersects(i)[expected > 0], np.ones((expected > 0).sum(), dtype=bool))
+        assert store.intersection_area(i, 5) == expected[5]
+        assert store.union_area(i, 5) == np.logical_or(dense[i], dense[5]).sum()
+
+def test_subset_and_packed(dense):
+    store = MaskStore.from_masks(dense, 50, 70)
+    subset = store.subset([4, 2, 9])
+    for i, j in enumerate([4, 2, 9]):
+        assert np.array_equal(subset.to_dense(i), dense[j])
+    boxes, payload, offsets = subset.packed()
+    assert np.array_equal(boxes, store.boxes[[4, 2, 9]])
+    top, left, bottom, right = boxes[1]
+    size = (bottom - top) * ((right - left + 7) // 8)
+    crop = np.unpackbits(payload[offsets[1]:offsets[1] + size].reshape(bottom - top, -1), axis=1, count=right - left)
+    assert np.array_equal(crop.astype(bool), dense[2][top:bottom, left:right])
@@ -0,0 +1,113 @@
+import base64
+
+import numpy as np
+import pytest
+
+from palette import PaletteState, pixel_box, union_box
+
+def region(mask: np.ndarray, box):
+    '''
+    an edit region as the client sends it: box plus bit-packed rows of the box
+    '''
+    top, left, bottom, right = box
+    return {"box": list(box), "bits": base64.b64encode(np.packbits(mask[top:bottom, left:right], axis=1).tobytes()).decode()}
+
+def test_boxes():
+    assert union_box(None, (1, 2, 3, 4)) == (1, 2, 3, 4)
+    assert union_box((0, 5, 2, 6), (1, 2, 3, 4)) == (0, 2, 3, 6)
+    assert pixel_box(np.array([], dtype=int), np.array([], dtype=int)) is None
+    assert pixel_box(np.array([3, 7]), np.array([9, 4])) == (3, 4, 8, 10)
+
+def test_add_keeps_other_segments(blobs):
+    state = PaletteState(blobs)
+    mask = np.zeros(blobs.shape, dtype=bool)
+    mask[0:12, 0:10] = True
+    touched, added = state.apply([{"op": "add", **region(mask, (0, 0, 12, 10))}])
+    assert added == [6]
+    assert state.version == 1
+    expected = blobs.copy()
+    expected[mask & (blobs == 0)] = 6
+    assert np.array_equal(state.palette, expected)
+    assert touched == {6: pixel_box(*np.nonzero(mask & (blobs == 0)))}
+
+def test_invasive_add_touches_overwritten_segments(blobs):
+    state = PaletteState(blobs)
+    mask = np.zeros(blobs.shape, dtype=bool)
+    mask[0:12, 0:10] = True
+    touched, _ = state.apply([{"op": "add", "invasive": True, **region(mask, (0, 0, 12, 10))}])
+    assert set(touched) == {1, 6}
+    assert (state.palette[mask] == 6).all()
+
+def test_erase_paint_delete_merge(blobs):
+    state = PaletteState(blobs)
+    mask = np.zeros(blobs.shape, dtype=bool)
+    mask[5:10, 5:10] = True
+    state.apply([{"op": "erase", "index": 1, **region(mask, (5, 5, 10, 10))}])
+    assert (state.palette[5:10, 5:10] == 0).all() and (state.palette[10:15, 5:20] == 1).all()
+    state.apply([{"op": "paint", "index": 2, **region(mask, (5, 5, 10, 10))}])
+    assert (state.palette[5:10, 5:10] == 2).all()
+    state.apply([{"op": "delete", "index": 5}])
+    assert not (state.palette == 5).any()
+    touched, _ = state.apply([{"op": "merge", "index": 3, "indexes": [3, 4]}])
+    assert not (state.palette == 4).any()
+    # the target is touched where pixels were relabelled to it, not where it already was
+    assert touched[4] == touched[3] == (35, 50, 58, 78)
+    assert state.version == 4
+
+def test_brush(blobs):
+    state = PaletteState(blobs)
+    touched, _ = state.apply([{"op": "erase", "index": 4, "x": 60, "y": 45, "radius": 3}])
+    assert state.palette[45, 60] == 0
+    top, left, bottom, right = touched[4]
+    assert top >= 42 and bottom <= 48 and left >= 57 and right <= 63
+
+def test_invalid_patch_is_atomic(blobs):
+    state = PaletteState(blobs)
+    with pytest.raises(ValueError):
+        state.apply([{"op": "delete", "index": 1}, {"op": "delete", "index": 99}])
+    assert np.array_equal(state.palette, blobs) and state.version == 0
+    mask = np.ones(blobs.shape, dtype=bool)
+    with pytest.raises(ValueError):
+        state.apply([{"op": "add", **region(mask, (0, 0, 10, 10)), "box": [0, 0, 11, 10]}])
+    with pytest.raises(ValueError):
+        state.apply([{"op": "explode", "index": 1}])
+    assert state.max_index == 5 and state.version == 0
+
+@pytest.mark.parametrize("edit", [
+    {"op": "paint", "index": 1},
+    {"op": "add", "box": [0, 0, 4, 4]},
+    {"op": "erase", "index": 1, "x": 3, "y": None},
+    {"op": "merge", "index": 1, "indexes": None},
+    {"op": "delete", "index": None},
+])
+def test_missing_fields_leave_palette_unchanged(blobs, edit):
+    state = PaletteState(blobs)
+    with pytest.raises(ValueError, match="needs"):
+        state.apply([{"op": "delete", "index": 2}, edit])
+    assert np.array_equal(state.palette, blobs) and state.version == 0
+
+def test_failed_edit_undoes_earlier_edits(blobs):
+    state = PaletteState(blobs)
+    mask = np.zeros(blobs.shape, dtype=bool)
+    mask[0:20, 0:40] = True
+    with pytest.raises(ValueError):
+        state.apply([
+            {"op": "add", "invasive": True, **region(mask, (0, 0, 20, 40))},
+            {"op": "merge", "index": 3, "indexes": [4, 5]},
+            {"op": "erase", "index": 1, "x": 10, "y": 10},
+            {"op": "add", **region(mask, (0, 0, 20, 40)), "bits": "AAAA"},
+        ])
+    assert np.array_equal(state.palette, blobs) and state.max_index == 5 and state.version == 0
+
+def test_changes_since(blobs):
+    state = PaletteState(blobs, max_history=2)
+    assert state.changes_since(0) == {}
+    state.apply([{"op": "delete", "index": 1}])
+    state.apply([{"op": "delete", "index": 2}])
+    assert state.changes_since(0) == {1: (5, 5, 15, 20), 2: (10, 30, 30, 45)}
+    assert state.changes_since(1) == {2: (10, 30, 30, 45)}
+    state.apply([{"op": "delete", "index": 3}])
+    # the history no longer reaches back to version 0
+    assert state.changes_since(0) is None
+    assert set(state.changes_since(1)) == {2, 3}
+    assert state.changes_since(4) is None
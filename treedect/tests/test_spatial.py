@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from palette import PaletteState
+from spatial import SegmentIndex, points_in_polygon
+
+@pytest.fixture
+def crowns():
+    '''
+    random discs on a 300x400 palette, with their labels
+    '''
+    rng = np.random.default_rng(1)
+    palette = np.zeros((300, 400), dtype=np.int32)
+    yy, xx = np.mgrid[:300, :400]
+    for index in range(1, 121):
+        cy, cx, r = rng.integers(0, 300), rng.integers(0, 400), rng.integers(4, 15)
+        palette[(yy - cy) ** 2 + (xx - cx) ** 2 <= r * r] = index
+    return palette, rng.integers(0, 4, 120)
+
+def reference(palette):
+    '''
+    area and centroid [x, y] per palette value, by brute force
+    '''
+    stats = {}
+    for index in np.unique(palette[palette > 0]):
+        rows, cols = np.nonzero(palette == index)
+        stats[int(index)] = (len(rows), np.array([cols.mean(), rows.mean()]))
+    return stats
+
+def test_scan_matches_brute_force(crowns):
+    palette, _ = crowns
+    index = SegmentIndex(palette, band_rows=37)
+    stats = reference(palette)
+    assert set(np.flatnonzero(index.area)) == set(stats)
+    for i, (area, centroid) in stats.items():
+        assert index.area[i] == area
+        assert np.allclose(index.centroid[i], centroid)
+        rows, cols = np.nonzero(palette == i)
+        assert tuple(index.bbox[i]) == (rows.min(), cols.min(), rows.max() + 1, cols.max() + 1)
+
+def test_select_and_count(crowns):
+    palette, labels = crowns
+    index = SegmentIndex(palette, labels)
+    stats = reference(palette)
+    for box in [(0, 0, 400, 300), (50, 20, 180, 140), (390, 290, 400, 300), (-10, -10, 5, 5)]:
+        x0, y0, x1, y1 = box
+        expected = sorted(i for i, (_, (x, y)) in stats.items() if x0 <= x < x1 and y0 <= y < y1)
+        assert sorted(index.select(box).tolist()) == expected
+        result = index.count(box, with_indexes=True)
+        assert result["indexes"] == expected
+        assert result["count"] == len(expected)
+        assert result["area"] == sum(stats[i][0] for i in expected)
+        assert sum(cluster["count"] for cluster in result["clusters"]) == len(expected)
+
+def test_polygon(crowns):
+    palette, _ = crowns
+    index = SegmentIndex(palette)
+    triangle = [[10, 10], [390, 10], [10, 290]]
+    selected = set(index.select(polygon=triangle).tolist())
+    for i in np.flatnonzero(index.area):
+        x, y = index.centroid[i]
+        assert (i in selected) == ((x - 10) / 380 + (y - 10) / 280 < 1 and x >= 10 and y >= 10)
+    square = np.array([[0, 0], [2, 0], [2, 2], [0, 2]], dtype=np.float64)
+    assert points_in_polygon(np.array([1.0, 3.0]), np.array([1.0, 1.0]), square).tolist() == [True, False]
+
+def test_hit_and_nearest(crowns):
+    palette, labels = crowns
+    index = SegmentIndex(palette, labels)
+    rows, cols = np.nonzero(palette)
+    assert index.hit(int(cols[0]), int(rows[0]))["index"] == palette[rows[0], cols[0]]
+    assert index.hit(-1, 0) is None
+    live = np.flatnonzero(index.area)
+    distances = np.hypot(index.centroid[live, 0] - 200, index.centroid[live, 1] - 150)
+    nearest = index.nearest(200, 150, k=5)
+    assert [segment["index"] for segment in nearest] == live[np.argsort(distances)[:5]].tolist()
+    of_label = index.nearest(200, 150, k=3, label=2)
+    assert all(segment["label"] == 2 for segment in of_label)
+    assert index.nearest(200, 150, k=5, max_distance=0.001) == []
+
+def test_refresh_matches_rebuild(crowns):
+    palette, labels = crowns
+    state = PaletteState(palette)
+    index = SegmentIndex(state.palette, labels, version=state.version)
+    state.apply([{"op": "delete", "index": 3}, {"op": "merge", "index": 7, "indexes": [8, 9]}])
+    state.apply([{"op": "erase", "index": 10, "x": int(index.centroid[10, 0]), "y": int(index.centroid[10, 1]), "radius": 4}])
+    state.apply([{"op": "add", "x": 5, "y": 5, "radius": 5}])
+    index.refresh(state.changes_since(index.version), state.version)
+    rebuilt = SegmentIndex(state.palette)
+    assert index.version == state.version
+    assert np.array_equal(index.area, rebuilt.area)
+    assert np.array_equal(index.bbox[index.area > 0], rebuilt.bbox[rebuilt.area > 0])
+    assert np.allclose(index.centroid, rebuilt.centroid)
+    assert index.labels[3] == labels[2] and index.labels[121] == -1
+    assert sorted(index.select((0, 0, 400, 300)).tolist()) == sorted(rebuilt.select((0, 0, 400, 300)).tolist())
+
+def test_set_labels_checks_version(crowns):
+    palette, labels = crowns
+    index = SegmentIndex(palette, version=2)
+    index.set_labels(labels, version=2)
+    assert index.labels[1:].tolist() == labels.tolist()
+    with pytest.raises(ValueError):
+        index.set_labels(labels, version=1)
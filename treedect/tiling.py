@@ -0,0 +1,296 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+from masks import MaskStore
+from prompt import grid_prompt_order, predict_points_adaptive, predict_points_batched
+from session import bind_features, encode_image
+
+if TYPE_CHECKING:
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+Box = Tuple[int, int, int, int]     # [top, left, bottom, right), exclusive ends
+
+# ------------------------------------------------------------
+# windowed mosaic reading
+# ------------------------------------------------------------
+def open_mosaic(path: str, work_dir: str, band_rows: int = 1024) -> Tuple[np.ndarray, List[str]]:
+    '''
+    open a large image as a read-only HxWx3 uint8 RGB array without decoding it into memory.
+    returns (image, files created in work_dir, to be deleted with the session).
+    - .npy is memory-mapped directly
+    - uncompressed 8-bit RGB(A) TIFF is memory-mapped directly with tifffile
+    - any other raster rasterio can open (compressed / tiled GeoTIFF, 16-bit, grayscale) is read in bands of
+      band_rows rows into a .npy in work_dir, which is then memory-mapped
+    - everything else is decoded once with cv2 and spilled to work_dir, so at least the session does not keep it
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npy":
+        image = _as_rgb_view(np.load(path, mmap_mode="r"))
+        if image is not None:
+            return image, []
+    if ext in (".tif", ".tiff"):
+        try:
+            import tifffile
+            image = _as_rgb_view(tifffile.memmap(path, mode="r"))
+            if image is not None:
+                return image, []
+        except (ImportError, ValueError):
+            pass
+
+    os.makedirs(work_dir, exist_ok=True)
+    target = os.path.join(work_dir, f"{uuid.uuid4().hex}.npy")
+    try:
+        import rasterio
+        from rasterio.windows import Window
+    except ImportError:
+        rasterio = None
+    if rasterio is not None and ext in (".tif", ".tiff", ".jp2", ".img", ".vrt"):
+        with rasterio.open(path) as src:
+            image = np.lib.format.open_memmap(target, mode="w+", dtype=np.uint8, shape=(src.height, src.width, 3))
+            bands = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+            for top in range(0, src.height, band_rows):
+                rows = min(band_rows, src.height - top)
+                window = src.read(bands, window=Window(0, top, src.width, rows))
+                image[top:top + rows] = _to_uint8(window.transpose(1, 2, 0))
+            image.flush()
+            del image
+    else:
+        decoded = cv2.imread(path, cv2.IMREAD_COLOR)
+        if decoded is None:
+            raise ValueError(f"cannot read image: {path}")
+        image = np.lib.format.open_memmap(target, mode="w+", dtype=np.uint8, shape=decoded.shape)
+        image[...] = cv2.cvtColor(decoded, cv2.COLOR_BGR2RGB)
+        image.flush()
+        del image, decoded
+    return np.load(target, mmap_mode="r"), [target]
+
+def _as_rgb_view(array: np.ndarray) -> Optional[np.ndarray]:
+    '''
+    HxWx3 uint8 view of a memory-mapped array (RGB, RGBA or planar), None if that needs a conversion
+    '''
+    if array.dtype != np.uint8 or array.ndim != 3:
+        return None
+    if array.shape[-1] in (3, 4):
+        return array[..., :3]
+    if array.shape[0] in (3, 4):
+        return array[:3].transpose(1, 2, 0)
+    return None
+
+def _to_uint8(window: np.ndarray) -> np.ndarray:
+    if window.dtype == np.uint8:
+        return window
+    if window.dtype == np.uint16:
+        return (window // 257).astype(np.uint8)
+    return np.clip(window, 0, 255).astype(np.uint8)
+
+# ------------------------------------------------------------
+# tiles
+# ------------------------------------------------------------
+def tile_windows(height: int, width: int, tile_size: int, overlap: int) -> List[Tuple[Box, Box]]:
+    '''
+    overlapping tiles covering the image, row by row. returns [(window, core)]: windows overlap by overlap
+    pixels, cores split the overlaps in the middle and partition the image, so every pixel (and every
+    prompt point) belongs to the core of exactly one tile.
+    '''
+    def spans(size):
+        # as few tiles as keep the overlap, spread evenly so the last one does not hug its neighbour
+        count = max(1, -(-(size - overlap) // (tile_size - overlap)))
+        starts = [round(i * (size - tile_size) / (count - 1)) for i in range(count)] if count > 1 else [0]
+        result = []
+        for i, start in enumerate(starts):
+            end = min(start + tile_size, size)
+            core_start = 0 if i == 0 else (start + starts[i - 1] + tile_size) // 2
+            core_end = size if i == len(starts) - 1 else (starts[i + 1] + end) // 2
+            result.append((start, end, core_start, core_end))
+        return result
+
+    tiles = []
+    for top, bottom, core_top, core_bottom in spans(height):
+        for left, right, core_left, core_right in spans(width):
+            tiles.append(((top, left, bottom, right), (core_top, core_left, core_bottom, core_right)))
+    return tiles
+
+def stitch_tile_masks(
+    store: MaskStore,
+    points: np.ndarray,
+    tiles: np.ndarray,
+    cut: np.ndarray,
+    windows: List[Box],
+    stitch_iou: float = 0.5,
+) -> Tuple[np.ndarray, MaskStore]:
+    '''
+    join the masks of different tiles that are one segment cut by a seam.
+    a cut mask (one touching an inner edge of its tile) is joined with every mask of another tile whose pixels
+    inside the shared window of the two tiles overlap it by IoU >= stitch_iou. joined masks become one mask at
+    the position of their first member. returns (points, masks) in the original order otherwise.
+    '''
+    parent = list(range(len(store)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    boxes = store.boxes
+    for i in np.flatnonzero(cut):
+        top, left, bottom, right = boxes[i]
+        intersects = (boxes[:, 0] < bottom) & (boxes[:, 2] > top) & (boxes[:, 1] < right) & (boxes[:, 3] > left)
+        for j in np.flatnonzero(intersects & (tiles != tiles[i])):
+            window = intersect_box(windows[tiles[i]], windows[tiles[j]])
+            a = window_crop(store, i, window)
+            b = window_crop(store, j, window)
+            union = np.count_nonzero(a | b)
+            if union > 0 and np.count_nonzero(a & b) / union >= stitch_iou:
+                # the root stays the earliest member
+                ri, rj = find(i), find(j)
+                parent[max(ri, rj)] = min(ri, rj)
+
+    groups: Dict[int, List[int]] = {}
+    for i in range(len(store)):
+        groups.setdefault(find(i), []).append(i)
+    stitched = MaskStore(store.height, store.width)
+    for root in sorted(groups):
+        members = groups[root]
+        if len(members) == 1:
+            box, crop = store.crop(root)
+        else:
+            top, left = boxes[members, 0].min(), boxes[members, 1].min()
+            bottom, right = boxes[members, 2].max(), boxes[members, 3].max()
+            crop = np.zeros((bottom - top, right - left), dtype=bool)
+            for m in members:
+                (t, l, b, r), member_crop = store.crop(m)
+                crop[t - top:b - top, l - left:r - left] |= member_crop
+            box = (top, left, bottom, right)
+        stitched.append_cropped(box, crop)
+    return points[sorted(groups)], stitched
+
+def intersect_box(a: Box, b: Box) -> Box:
+    top, left = max(a[0], b[0]), max(a[1], b[1])
+    return (top, left, max(top, min(a[2], b[2])), max(left, min(a[3], b[3])))
+
+def window_crop(store: MaskStore, index: int, window: Box) -> np.ndarray:
+    '''
+    pixels of mask index inside window, as a window-sized boolean array
+    '''
+    (top, left, bottom, right), crop = store.crop(index)
+    out = np.zeros((window[2] - window[0], window[3] - window[1]), dtype=bool)
+    t, l, b, r = intersect_box((top, left, bottom, right), window)
+    if t < b and l < r:
+        out[t - window[0]:b - window[0], l - window[1]:r - window[1]] = crop[t - top:b - top, l - left:r - left]
+    return out
+
+def predict_tiled(
+    predictor: "SAM2ImagePredictor",
+    image: np.ndarray,
+    point_grid: np.ndarray,
+    ratio: float,
+    tile_size: int = 1024,
+    overlap: int = 256,
+    batch_size: int = 16,
+    selection: str = "first",
+    schedule: str = "full",
+    refine_levels: int = 0,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    memory_bytes: int = 2 * 1024 ** 3,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[np.ndarray, MaskStore, Dict[str, int]]:
+    '''
+    prompt the point grid tile by tile, so SAM2 sees every tile at (close to) full resolution.
+    every grid point is prompted once, in the tile whose core holds it, with the rest of the window as context.
+    the masks are moved to image coordinates, stitched across seams, and returned in grid_prompt_order
+    (column by column over the whole grid), ready for filter_and_build_palette with the same ratio.
+    a segment is recovered whole as long as overlap / 2 exceeds its radius or a grid point of every tile it
+    crosses falls on it; choose overlap around the largest crown diameter.
+
+    the shared predictor encodes one tile at a time; window reads and the mask post-processing of finished
+    tiles run on a thread pool, with as many tiles in flight as memory_bytes allows.
+    must be called with predictor_lock held.
+    '''
+    height, width = image.shape[:2]
+    tiles = tile_windows(height, width, tile_size, overlap)
+    # window copy, masks of the tile and working copies. a rough upper bound per tile in flight
+    tile_bytes = tile_size * tile_size * (3 + 3 + 4)
+    in_flight = int(max(1, min(len(tiles), memory_bytes // tile_bytes)))
+
+    grid_x, grid_y = point_grid[0, :, 0], point_grid[:, 0, 1]
+
+    def read(window: Box) -> np.ndarray:
+        top, left, bottom, right = window
+        return np.ascontiguousarray(image[top:bottom, left:right])
+
+    def to_image(t: int, window: Box, points: np.ndarray, masks: MaskStore):
+        top, left, bottom, right = window
+        store = MaskStore(height, width)
+        cut = np.zeros(len(masks), dtype=bool)
+        for i in range(len(masks)):
+            (t0, l0, b0, r0), crop = masks.crop(i)
+            if b0 > t0:
+                cut[i] = (t0 == 0 and top > 0) or (l0 == 0 and left > 0) or \
+                         (b0 == bottom - top and bottom < height) or (r0 == right - left and right < width)
+                store.append_cropped((t0 + top, l0 + left, b0 + top, r0 + left), crop)
+            else:
+                store.append_cropped((0, 0, 0, 0), crop)
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 2) + np.array([left, top])
+        return t, points, store, cut
+
+    stats = {"tiles": len(tiles), "tiles_in_flight": in_flight, "grid_points": 0, "decoded_points": 0, "decoder_batches": 0, "skipped_points": 0}
+    results = []
+    with ThreadPoolExecutor(max_workers=in_flight, thread_name_prefix="treedect-tile") as pool:
+        reads = [pool.submit(read, window) for window, _ in tiles[:in_flight]]
+        posts = []
+        for t, (window, core) in enumerate(tiles):
+            tile_image = reads[t].result()
+            reads[t] = None
+            if t + in_flight < len(tiles):
+                reads.append(pool.submit(read, tiles[t + in_flight][0]))
+
+            # the grid points of the core, a sub-grid since cores are rectangles
+            cols = np.flatnonzero((grid_x >= core[1]) & (grid_x < core[3]))
+            rows = np.flatnonzero((grid_y >= core[0]) & (grid_y < core[2]))
+            if len(rows) > 0 and len(cols) > 0:
+                tile_grid = point_grid[rows[:, None], cols[None, :]] - np.array([window[1], window[0]])
+                bind_features(predictor, *encode_image(predictor, tile_image, embedding_cache))
+                if schedule == "adaptive":
+                    tile_points, tile_masks, tile_stats = predict_points_adaptive(
+                        predictor, tile_grid, ratio, batch_size, selection, refine_levels)
+                else:
+                    tile_points = grid_prompt_order(tile_grid)
+                    tile_masks = predict_points_batched(predictor, tile_points, batch_size, selection)
+                    tile_stats = {"grid_points": len(tile_points), "decoded_points": len(tile_points), "decoder_batches": -(-len(tile_points) // batch_size), "skipped_points": 0}
+                for key in ("grid_points", "decoded_points", "decoder_batches", "skipped_points"):
+                    stats[key] += tile_stats[key]
+                posts.append(pool.submit(to_image, t, window, tile_points, tile_masks))
+            del tile_image
+            # keep finished tiles from piling up beyond the budget
+            while len(posts) > in_flight:
+                results.append(posts.pop(0).result())
+            if progress is not None:
+                progress(t + 1, len(tiles))
+        results.extend(post.result() for post in posts)
+
+    store = MaskStore(height, width)
+    points, tile_ids, cut = [], [], []
+    for t, tile_points, tile_store, tile_cut in results:
+        for i in range(len(tile_store)):
+            store.append_cropped(*tile_store.crop(i))
+        points.append(tile_points)
+        tile_ids.append(np.full(len(tile_store), t))
+        cut.append(tile_cut)
+    if len(store) == 0:
+        return np.zeros((0, 2), dtype=np.int64), store, stats
+    points, tile_ids, cut = np.concatenate(points), np.concatenate(tile_ids), np.concatenate(cut)
+
+    # global grid_prompt_order: column by column, i.e. by x then y
+    order = np.lexsort((points[:, 1], points[:, 0]))
+    store, points, tile_ids, cut = store.subset(order), points[order], tile_ids[order], cut[order]
+    stats["cut_masks"] = int(cut.sum())
+    points, store = stitch_tile_masks(store, points, tile_ids, cut, [window for window, _ in tiles])
+    stats["stitched_masks"] = int(len(order) - len(store))
+    return points, store, stats
@@ -1,9 +1,10 @@
 import numpy as np
-from sam2.sam2_image_predictor import SAM2ImagePredictor
-from typing import List, Tuple
+from typing import List, Tuple, Union
 import numba
 from scipy import sparse
 
+from masks import MaskStore
+
 def generation_sample_grid(height: int, width: int, ROW_SAMPLE_INTERVAL: int, COL_SAMPLE_INTERVAL: int):
     """
     生成一个二维网格点阵，用于在图像上进行采样。
@@ -47,122 +48,143 @@ def generation_sample_grid(height: int, width: int, ROW_SAMPLE_INTERVAL: int, CO
     point_grid = np.stack([x_grid, y_grid], axis=-1)    # [column_idx, row_idx, sample_x, sample_y]
     return point_grid
 
+@numba.jit(nopython=True, cache=True)
+def _paint_masks(boxes, payload, offsets, ratio, palette):
+    '''
+    walk the masks in order over their own bbox. palette doubles as the coverage raster:
+    a mask is rejected if the covered fraction of its pixels reaches ratio, otherwise it gets the next
+    index and paints the pixels nobody owns yet (first writer wins).
+    payload holds every bbox bit-packed along rows, as MaskStore.packed returns it.
+    '''
+    num_masks = boxes.shape[0]
+    keep = np.zeros(num_masks, dtype=np.bool_)
+    label = 0
+    for m in range(num_masks):
+        top, left, bottom, right = boxes[m, 0], boxes[m, 1], boxes[m, 2], boxes[m, 3]
+        row_bytes = (right - left + 7) // 8
+        area = 0
+        overlap = 0
+        for r in range(top, bottom):
+            row_start = offsets[m] + (r - top) * row_bytes
+            for c in range(left, right):
+                x = c - left
+                if (payload[row_start + (x >> 3)] >> (7 - (x & 7))) & 1:
+                    area += 1
+                    if palette[r, c] != 0:
+                        overlap += 1
+        if area > 0 and overlap / area >= ratio:
+            continue
+        keep[m] = True
+        label += 1
+        for r in range(top, bottom):
+            row_start = offsets[m] + (r - top) * row_bytes
+            for c in range(left, right):
+                x = c - left
+                if (payload[row_start + (x >> 3)] >> (7 - (x & 7))) & 1 and palette[r, c] == 0:
+                    palette[r, c] = label
+    return keep
+
+def filter_and_build_palette(
+    point_grid: np.ndarray,
+    masks: Union[MaskStore, List[sparse.csr_matrix]],
+    height: int,
+    width: int,
+    ratio: float
+) -> Tuple[List[np.ndarray], Union[MaskStore, List[sparse.csr_matrix]], np.ndarray]:
+    '''
+    filter_overlap_segments and masks_to_palette in a single pass over the mask pixels.
+    masks are in grid_prompt_order (column by column), as a MaskStore or a list of full-frame sparse masks.
+    returns (legal_sample_points, filtered_masks, palette); filtered_masks has the same type as masks.
+    '''
+    store = masks if isinstance(masks, MaskStore) else MaskStore.from_masks(masks, height, width)
+    palette = np.zeros((height, width), dtype=np.int32)
+    if len(store) == 0:
+        return [], masks[:0] if isinstance(masks, list) else store, palette
+    keep = np.flatnonzero(_paint_masks(*store.packed(), ratio, palette))
+    points = point_grid.transpose(1, 0, 2).reshape(-1, 2)
+    legal_sample_points = [points[i] for i in keep]
+    filtered_masks = store.subset(keep) if isinstance(masks, MaskStore) else [masks[i] for i in keep]
+    return legal_sample_points, filtered_masks, palette
+
+def warmup_kernels():
+    '''
+    run the numba kernels once on a toy input, which compiles them or loads them from the numba cache
+    '''
+    masks = MaskStore.from_masks([np.ones((4, 4), dtype=bool)], 4, 4)
+    filter_and_build_palette(np.zeros((1, 1, 2), dtype=np.int64), masks, 4, 4, 0.5)
+
 def filter_overlap_segments(
     point_grid: List[np.ndarray], 
-    masks: List[sparse.csr_matrix], 
+    masks: Union[MaskStore, List[sparse.csr_matrix]], 
     height: int,
     width: int,
     ratio: float
-) -> Tuple[List[np.ndarray], List[sparse.csr_matrix]]:
-
-    filtered_masks = []
-    legal_sample_points = []
-    
-    # Convert masks list to 2D array structure matching point_grid
-    masks_2d = []
-    idx = 0
-    for j in range(point_grid.shape[1]):
-        row_masks = []
-        for i in range(point_grid.shape[0]):
-            row_masks.append(masks[idx])
-            idx += 1
-        masks_2d.append(row_masks)
-    
-    segment_mask = sparse.csr_matrix((height, width), dtype=bool)
-
-    def is_overlap(mask_a: sparse.csr_matrix, mask_b: sparse.csr_matrix, overlap_ratio: float) -> bool:
-        if mask_b.nnz == 0:  # Handle empty masks
-            return False
-        overlap_mask = mask_a.multiply(mask_b)
-        overlap_count = overlap_mask.nnz
-        ratio_val = overlap_count / mask_b.nnz
-        return ratio_val >= overlap_ratio
-
-    for i in range(len(masks_2d)):
-        for j in range(len(masks_2d[i])):
-            current_mask = masks_2d[i][j]
-            
-            if is_overlap(segment_mask, current_mask, ratio):
-                # print(i, j)
-                # segment_mask = segment_mask + current_mask
-                # segment_mask = segment_mask.astype(bool)  # Ensure boolean
-                continue
-
-            filtered_masks.append(current_mask)
-            legal_sample_points.append(point_grid[j, i])  
-            segment_mask = segment_mask + current_mask
-            segment_mask = segment_mask.astype(bool)  # Ensure boolean
-    
+) -> Tuple[List[np.ndarray], Union[MaskStore, List[sparse.csr_matrix]]]:
+    '''
+    drop masks whose pixels are already covered by earlier accepted masks for at least ratio of their area.
+    '''
+    legal_sample_points, filtered_masks, _ = filter_and_build_palette(point_grid, masks, height, width, ratio)
     return legal_sample_points, filtered_masks
 
-def masks_to_palette(masks: List[sparse.csr_matrix], height: int, width: int) -> np.ndarray:
-
+def masks_to_palette(masks: Union[MaskStore, List[sparse.csr_matrix]], height: int, width: int) -> np.ndarray:
+    '''
+    1. new mask will not overwrite existing masks
+    2. new mask is presented by idx (start from 1)
+    '''
+    store = masks if isinstance(masks, MaskStore) else MaskStore.from_masks(masks, height, width)
     palette = np.zeros((height, width), dtype=np.int32)
-    for i, mask in enumerate(masks, start=1):
-        # Convert sparse mask to dense for the operation
-        mask_dense = mask.toarray().astype(bool)
-        # 1. new mask will not overwrite existing masks
-        # 2. new mask is presented by idx
-        palette_mask = (palette == 0)
-        palette = palette + i * (mask_dense & palette_mask)
-    
-    return palette.astype(np.int32)
-
-def create_block_mask_in_bbox(bbox_top, bbox_bottom, bbox_left, bbox_right, palette, index, n_patch):
-    '''
-    the bounding box of a segment (marked by index on palette) is divided into n_patch x n_patch blocks.
-    this function found the patch that really contains the segment, and return in raster scan order.
-    actually bbox_* is not computationally necessary, but it has already been computed in the previous step.
-    '''
-    # synthetic sanity check passed
-    valid_blocks = set()
-    patch_width = (bbox_right - bbox_left + 1) / n_patch
-    patch_height = (bbox_bottom - bbox_top + 1) / n_patch
-    for x in range(bbox_top, bbox_bottom + 1):
-        for y in range(bbox_left, bbox_right + 1):
-            if palette[x, y] == index:
-                block_x = (x - bbox_top) // patch_height
-                block_y = (y - bbox_left) // patch_width
-                valid_blocks.add(int(block_x * n_patch + block_y))
-    return sorted(list(valid_blocks))
-
-@numba.jit(nopython=True)
-def create_block_mask_in_global(bbox_top, bbox_bottom, bbox_left, bbox_right, palette, index, n_patch):
+    if len(store) > 0:
+        _paint_masks(*store.packed(), np.inf, palette)
+    return palette
+
+def block_area_in_bbox(mask: np.ndarray, n_patch: int) -> np.ndarray:
+    '''
+    the bounding box of a segment (mask, cropped to the bbox) is divided into n_patch x n_patch blocks.
+    this function counts the segment pixels of every block, i.e. the segment mask area-pooled to patch
+    resolution, and returns it flattened in raster scan order.
+    '''
+    height, width = mask.shape
+    block_rows = (np.arange(height) * n_patch) // height
+    block_cols = (np.arange(width) * n_patch) // width
+    block_index = block_rows[:, None] * n_patch + block_cols[None, :]
+    return np.bincount(block_index[mask], minlength=n_patch * n_patch)
+
+def count_blocks_in_global(bbox_top, bbox_bottom, bbox_left, bbox_right, palette, n_patch):
     '''
     the whole palette is divided into n_patch x n_patch blocks.
-    this function found the patch that really contains the segment, and return in raster scan order.
-    actually bbox_* is not computationally necessary, but it has already been computed in the previous step.
+    this function counts, for every segment at once, the number of blocks that really contain the segment.
+    bbox_* are arrays over segments (segment i is index i + 1 on palette); a segment whose bbox falls in a
+    single block is counted as 1 without looking at the pixels.
     '''
+    num_segs = len(bbox_top)
     patch_height = palette.shape[1] // n_patch
     patch_width = palette.shape[0] // n_patch
-    patch_idx_start = bbox_top // patch_height
-    patch_idx_end = bbox_bottom // patch_height
-    patch_idy_start = bbox_left // patch_width
-    patch_idy_end = bbox_right // patch_width
-    
-    # fast checking. many cases should fall into this condition, which does not need extra computation
-    if patch_idx_start == patch_idx_end and patch_idy_start == patch_idy_end:
+    n_block_rows = (palette.shape[0] - 1) // patch_height + 1
+    n_block_cols = (palette.shape[1] - 1) // patch_width + 1
+    n_blocks = n_block_rows * n_block_cols
+
+    # one labelled pass: key = segment index * n_blocks + block index
+    block_index = (np.arange(palette.shape[0]) // patch_height)[:, None] * n_block_cols + (np.arange(palette.shape[1]) // patch_width)[None, :]
+    keys = palette.astype(np.int64) * n_blocks + block_index
+    present = np.zeros((num_segs + 1) * n_blocks, dtype=bool)
+    present[keys.ravel()] = True
+    block_count = present.reshape(num_segs + 1, n_blocks)[1:].sum(axis=1)
+
+    # fast checking. many cases should fall into this condition
+    single = (np.asarray(bbox_top) // patch_height == np.asarray(bbox_bottom) // patch_height) & \
+             (np.asarray(bbox_left) // patch_width == np.asarray(bbox_right) // patch_width)
+    return np.where(single, 1, block_count).astype(np.int64)
+
+def count_segment_blocks(rows, cols, bbox_top, bbox_bottom, bbox_left, bbox_right, shape, n_patch):
+    '''
+    count_blocks_in_global for a single segment given its pixel coordinates.
+    '''
+    patch_height = shape[1] // n_patch
+    patch_width = shape[0] // n_patch
+    if bbox_top // patch_height == bbox_bottom // patch_height and bbox_left // patch_width == bbox_right // patch_width:
         return 1
-
-    block_count = 0
-
-    for patch_idx in range(patch_idx_start, patch_idx_end + 1):
-        for patch_idy in range(patch_idy_start, patch_idy_end + 1):
-            # scan the bounding box for evidence
-            done = False
-            for x in range(bbox_top, bbox_bottom + 1):
-                for y in range(bbox_left, bbox_right + 1):
-                    if palette[x, y] == index:
-                        block_x = x // patch_height
-                        block_y = y // patch_width
-                        if block_x == patch_idx and block_y == patch_idy:
-                            block_count += 1
-                            done = True
-                            break
-                if done:
-                    break
-    
-    return block_count
+    n_block_cols = (shape[1] - 1) // patch_width + 1
+    return len(np.unique((rows // patch_height) * n_block_cols + cols // patch_width))
 
 if __name__ == '__main__':
     palette = np.array([
@@ -174,19 +196,12 @@ if __name__ == '__main__':
         [4, 0, 4, 0, 0, 0]
     ])
 
-    # bbox_left = 2
-    # bbox_right = 5
-    # bbox_top = 1
-    # bbox_bottom = 4
-    # n_patch = 2
-    # index = 2
-
-    bbox_left = 1
-    bbox_right = 4
-    bbox_top = 0
-    bbox_bottom = 3
+    bbox_left = np.array([1, 2, 3, 0])
+    bbox_right = np.array([4, 5, 5, 2])
+    bbox_top = np.array([0, 1, 1, 4])
+    bbox_bottom = np.array([3, 4, 3, 5])
     n_patch = 3
     index = 1
 
-    # print(create_block_mask_in_bbox(bbox_top, bbox_bottom, bbox_left, bbox_right, palette, index, n_patch))
-    print(create_block_mask_in_global(bbox_top, bbox_bottom, bbox_left, bbox_right, palette, index, n_patch))
+    print(block_area_in_bbox(palette[bbox_top[index - 1]:bbox_bottom[index - 1] + 1, bbox_left[index - 1]:bbox_right[index - 1] + 1] == index, n_patch))
+    print(count_blocks_in_global(bbox_top, bbox_bottom, bbox_left, bbox_right, palette, n_patch))